@@ -0,0 +1,98 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the cold start (module init) time of the handlers.
+
+Each handler module is imported in a fresh interpreter, for each deployment
+mode (encryption on/off, post actions on/off), and the best time is reported,
+as with timeit, since the noise from other processes only ever adds time.
+Pass --src more than once to compare trees, for example a checkout of the
+previous commit against this one:
+
+    git worktree add /tmp/before HEAD~1
+    python benchmarks/cold_start.py --src /tmp/before/src --src src
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+HANDLERS = ['create_urls', 'process_callback']
+
+MODES = [
+    ('encryption, post actions', {'KEY_ID': 'alias/benchmark'}),
+    ('encryption, no post actions', {'KEY_ID': 'alias/benchmark', 'DISABLE_POST_ACTIONS': 'true'}),
+    ('no encryption, post actions', {}),
+    ('no encryption, no post actions', {'DISABLE_POST_ACTIONS': 'true'}),
+]
+
+# Runs in the fresh interpreter, prints the init time in seconds
+INIT_SCRIPT = """
+import time, sys, importlib
+start = time.perf_counter()
+importlib.import_module(sys.argv[1])
+print(time.perf_counter() - start)
+"""
+
+def measure_init(src, handler, mode_env, runs):
+    env = {k: v for k, v in os.environ.items() if k not in ('KEY_ID', 'DISABLE_POST_ACTIONS')}
+    env.update({
+        'PYTHONPATH': os.path.abspath(src),
+        'PYTHONDONTWRITEBYTECODE': '',
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'AWS_ACCESS_KEY_ID': 'benchmark',
+        'AWS_SECRET_ACCESS_KEY': 'benchmark',
+    })
+    env.update(mode_env)
+    times = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', INIT_SCRIPT, handler],
+            env=env, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        times.append(float(output.strip().splitlines()[-1]))
+    return min(times)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure handler cold start time')
+    parser.add_argument('--src', action='append',
+        help='Source directory to measure, can be given more than once (default: src)')
+    parser.add_argument('--runs', type=int, default=10,
+        help='Fresh interpreters per measurement (default: %(default)s)')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args(argv)
+
+    srcs = args.src or [os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')]
+
+    results = []
+    for handler in HANDLERS:
+        for mode_name, mode_env in MODES:
+            results.append({
+                'handler': handler,
+                'mode': mode_name,
+                'init_ms': [measure_init(src, handler, mode_env, args.runs) * 1000 for src in srcs],
+            })
+
+    if args.json:
+        print(json.dumps({'srcs': srcs, 'results': results}, indent=2))
+        return
+
+    header = f'{"handler":<18}{"mode":<32}' + ''.join(f'{s[-24:]:>26}' for s in srcs)
+    print(header)
+    for result in results:
+        times = ''.join(f'{t:>24.1f}ms' for t in result['init_ms'])
+        print(f'{result["handler"]:<18}{result["mode"]:<32}{times}')
+
+if __name__ == '__main__':
+    main()
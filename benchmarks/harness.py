@@ -0,0 +1,151 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Shared setup and measurement for the benchmarks.
+
+The handlers are imported with a fake AWS environment, and their KMS and
+Step Functions clients are replaced with the stand-ins from
+sfn_callback_urls.fakes, so nothing leaves the machine.
+"""
+
+import os
+import sys
+import json
+import time
+import tracemalloc
+import contextlib
+from collections import namedtuple
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+from sfn_callback_urls.fakes import (set_fake_environment, get_fake_kms_key_provider,
+    FakeStepFunctionsClient, get_proxy_event)
+
+# Set before the config is loaded and the handlers are imported, since they build their clients at import
+set_fake_environment('benchmark', 'benchmark')
+
+with contextlib.redirect_stdout(open(os.devnull, 'w')):
+    import create_urls
+    import process_callback
+
+from sfn_callback_urls.payload import get_caching_materials_manager
+from sfn_callback_urls.stores import MemoryStore
+
+DEFAULT_API_INFO = create_urls.DefaultApiInfo(region='us-east-1', api_id='benchmark', stage='benchmark')
+
+Result = namedtuple('Result', ['name', 'iterations', 'ops_per_sec', 'p50_ms', 'p99_ms', 'peak_kb'])
+
+def configure_handlers(encryption=True, data_key_max_age=300, kms_latency=0, sfn_latency=0,
+        kms_fault_rate=0, sfn_fault_rate=0):
+    """Point the handlers at fresh fakes, returning (key provider, Step Functions client)"""
+    key_provider = None
+    materials_manager = None
+    if encryption:
+        key_provider = get_fake_kms_key_provider(latency=kms_latency, fault_rate=kms_fault_rate)
+        materials_manager = key_provider
+        if data_key_max_age:
+            materials_manager = get_caching_materials_manager(key_provider, data_key_max_age)
+    sfn_client = FakeStepFunctionsClient(latency=sfn_latency, fault_rate=sfn_fault_rate, record=False)
+
+    create_urls.MATERIALS_MANAGER = materials_manager
+    # every iteration sends the same request, which would otherwise be answered from the cache
+    create_urls.IDEMPOTENCY_CACHE = None
+    process_callback.MASTER_KEY_PROVIDER = key_provider
+    process_callback.STEP_FUNCTIONS_CLIENT = sfn_client
+    # for outputs too big to fit in a URL
+    payload_store = MemoryStore()
+    create_urls.PAYLOAD_STORE = payload_store
+    process_callback.PAYLOAD_STORE = payload_store
+    return key_provider, sfn_client
+
+def create(event):
+    """Call create_urls the way the direct handler does, returning the response body"""
+    return create_urls.process_event(event, None, DEFAULT_API_INFO, lambda status_code, headers, body: body)
+
+def create_url(action, token='benchmark-token'):
+    """Create a URL for the action, which is a short URL if the payload is too long for a URL,
+    as a caller would have to do"""
+    response = create({'token': token, 'actions': [action]})
+    if response.get('error') == 'PayloadTooLong':
+        response = create({'token': token, 'actions': [action], 'short_urls': True})
+    if 'urls' not in response:
+        raise RuntimeError(f'Creating the URL failed: {response}')
+    return response['urls'][action['name']]
+
+def callback(url, method='GET', body=None):
+    """Call process_callback with the request API Gateway would send for the URL"""
+    return process_callback.handler(get_proxy_event(url, method=method, body=body), None)
+
+def check_callback(response):
+    """Raise if the callback failed, so the error path isn't measured instead"""
+    if response['statusCode'] != 200:
+        raise RuntimeError(f'Callback failed: {response}')
+    return response
+
+@contextlib.contextmanager
+def quiet():
+    """The handlers print a log event for every request, and tracebacks for unexpected errors"""
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        yield
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def measure(name, func, min_time=1.0, min_iterations=20, warmup=5, memory_iterations=5):
+    """Time func repeatedly for at least min_time seconds, then measure the peak
+    memory allocated during a call with tracemalloc (which slows it down, so it's separate)"""
+    with quiet():
+        for _ in range(warmup):
+            func()
+
+        latencies = []
+        start = time.perf_counter()
+        while len(latencies) < min_iterations or time.perf_counter() - start < min_time:
+            op_start = time.perf_counter()
+            func()
+            latencies.append(time.perf_counter() - op_start)
+        total_time = time.perf_counter() - start
+
+        peaks = []
+        for _ in range(memory_iterations):
+            tracemalloc.start()
+            baseline = tracemalloc.get_traced_memory()[0]
+            func()
+            peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+            tracemalloc.stop()
+
+    latencies.sort()
+    return Result(
+        name=name,
+        iterations=len(latencies),
+        ops_per_sec=len(latencies) / total_time,
+        p50_ms=percentile(latencies, 0.5) * 1000,
+        p99_ms=percentile(latencies, 0.99) * 1000,
+        peak_kb=max(peaks) / 1024,
+    )
+
+def print_results(results, file=None):
+    file = file or sys.stdout
+    width = max([len(r.name) for r in results] + [9])
+    print(f'{"benchmark":<{width}}  {"ops/s":>10}  {"p50 ms":>9}  {"p99 ms":>9}  {"peak KB":>9}', file=file)
+    for r in results:
+        print(f'{r.name:<{width}}  {r.ops_per_sec:>10.1f}  {r.p50_ms:>9.3f}  {r.p99_ms:>9.3f}  {r.peak_kb:>9.1f}',
+            file=file)
+
+def dump_results(results, path):
+    with open(path, 'w') as fp:
+        json.dump([r._asdict() for r in results], fp, indent=2)
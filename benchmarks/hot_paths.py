@@ -0,0 +1,150 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark the create URLs and callback hot paths offline.
+
+Drives create_urls.process_event and process_callback.handler against the
+fake KMS and Step Functions, sweeping one parameter at a time from a base
+case (1 action, 100 byte output, 3 post outcomes), with encryption on and
+off. Reports ops/s, p50/p99 latency and peak memory allocated per call.
+
+    python benchmarks/hot_paths.py [--filter callback] [--json results.json]
+"""
+
+import argparse
+
+import harness
+
+ACTION_COUNTS = [1, 5, 20]
+OUTPUT_SIZES = [100, 10 * 1024, 100 * 1024]
+OUTCOME_COUNTS = [1, 5, 20]
+
+BASE_ACTION_COUNT = 1
+BASE_OUTPUT_SIZE = 100
+BASE_OUTCOME_COUNT = 3
+
+def get_output(size):
+    return {'data': 'x' * size}
+
+def get_success_action(name, output_size):
+    return {
+        'name': name,
+        'type': 'success',
+        'output': get_output(output_size),
+    }
+
+def get_post_action(name, outcome_count, output_size):
+    # the body matches the last outcome, so every outcome schema is checked
+    return {
+        'name': name,
+        'type': 'post',
+        'outcomes': [
+            {
+                'name': f'outcome{i}',
+                'type': 'success',
+                'schema': {
+                    'type': 'object',
+                    'properties': {
+                        'choice': {'const': i},
+                        'data': {'type': 'string'},
+                    },
+                    'required': ['choice'],
+                },
+                'output_path': '$.data',
+            } for i in range(outcome_count)
+        ]
+    }
+
+def get_post_body(outcome_count, output_size):
+    return {
+        'choice': outcome_count - 1,
+        'data': 'x' * output_size,
+    }
+
+def get_create_event(action_count, output_size):
+    return {
+        'token': 'benchmark-token',
+        'actions': [get_success_action(f'action{i}', output_size) for i in range(action_count)],
+    }
+
+def bench_create(encryption, action_count, output_size, **kwargs):
+    event = get_create_event(action_count, output_size)
+    def run():
+        return harness.create(event)
+    with harness.quiet():
+        response = run()
+        # payloads too long for a URL need short URLs, as they would for a caller
+        if response.get('error') == 'PayloadTooLong':
+            event['short_urls'] = True
+            response = run()
+    if 'urls' not in response:
+        raise RuntimeError(f'Creating URLs failed: {response}')
+    return run
+
+def bench_callback(encryption, output_size, **kwargs):
+    with harness.quiet():
+        url = harness.create_url(get_success_action('action', output_size))
+        harness.check_callback(harness.callback(url))
+    return lambda: harness.callback(url)
+
+def bench_post_callback(encryption, outcome_count, output_size, **kwargs):
+    body = get_post_body(outcome_count, output_size)
+    with harness.quiet():
+        url = harness.create_url(get_post_action('action', outcome_count, output_size))
+        harness.check_callback(harness.callback(url, method='POST', body=body))
+    return lambda: harness.callback(url, method='POST', body=body)
+
+def get_cases():
+    """(name, setup function, parameters), sweeping each parameter from the base case"""
+    cases = []
+    for encryption in [True, False]:
+        mode = 'encrypted' if encryption else 'unencrypted'
+        for action_count in ACTION_COUNTS:
+            cases.append((f'create/{mode}/actions={action_count}', bench_create,
+                dict(encryption=encryption, action_count=action_count, output_size=BASE_OUTPUT_SIZE)))
+        for output_size in OUTPUT_SIZES:
+            cases.append((f'create/{mode}/output={output_size}', bench_create,
+                dict(encryption=encryption, action_count=BASE_ACTION_COUNT, output_size=output_size)))
+        for output_size in OUTPUT_SIZES:
+            cases.append((f'callback/{mode}/output={output_size}', bench_callback,
+                dict(encryption=encryption, output_size=output_size)))
+        for outcome_count in OUTCOME_COUNTS:
+            cases.append((f'post_callback/{mode}/outcomes={outcome_count}', bench_post_callback,
+                dict(encryption=encryption, outcome_count=outcome_count, output_size=BASE_OUTPUT_SIZE)))
+    return cases
+
+def run(name_filter=None, min_time=1.0):
+    results = []
+    for name, setup, params in get_cases():
+        if name_filter and name_filter not in name:
+            continue
+        harness.configure_handlers(encryption=params['encryption'])
+        results.append(harness.measure(name, setup(**params), min_time=min_time))
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the create URLs and callback hot paths')
+    parser.add_argument('--filter', help='Only run benchmarks with names containing this')
+    parser.add_argument('--min-time', type=float, default=1.0,
+        help='Seconds to run each benchmark for (default: %(default)s)')
+    parser.add_argument('--json', metavar='FILE', help='Also write the results to this file')
+    args = parser.parse_args(argv)
+
+    results = run(args.filter, args.min_time)
+    harness.print_results(results)
+    if args.json:
+        harness.dump_results(results, args.json)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare the HTTP server with Lambda's one request at a time per instance.
+
+A Lambda instance handles one invocation at a time, so the callback handler
+is called directly, one request at a time, for the throughput of a single
+instance. Then the same callbacks are sent concurrently over HTTP to the
+server, run in this process, with each number of workers. Both use the fake
+KMS and Step Functions, with the given latency, which is where the server's
+concurrency pays off. The report includes how many Lambda instances it
+would take to match each server's throughput.
+
+    python benchmarks/http_server.py --workers 1 4 16 --concurrency 16 --sfn-latency 20
+"""
+
+import sys
+import argparse
+import threading
+
+import harness
+import load
+
+import server
+
+def run_lambda(urls, total_requests):
+    with harness.quiet():
+        return load.run_load(urls, load.call_in_process, total_requests, concurrency=1)
+
+def run_server(args, workers):
+    http_server = server.make_server('127.0.0.1', 0, workers=workers)
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        base_url = f'http://127.0.0.1:{http_server.server_address[1]}'
+        urls = load.mint_urls(args.urls, args.output_size, base_url=base_url)
+        with harness.quiet():
+            return load.run_load(urls, load.call_http, args.requests, args.concurrency)
+    finally:
+        http_server.shutdown()
+        http_server.server_close()
+
+def print_row(name, recorder, elapsed, lambda_throughput=None, file=None):
+    latencies = sorted(recorder.latencies)
+    throughput = len(latencies) / elapsed
+    errors = sum(v for k, v in recorder.statuses.items() if k != 200) + sum(recorder.exceptions.values())
+    instances = f'{throughput / lambda_throughput:>9.1f}' if lambda_throughput else f'{"1":>9}'
+    print(f'{name:<18}  {throughput:>10.1f}  {harness.percentile(latencies, 0.5) * 1000:>9.2f}  '
+        f'{harness.percentile(latencies, 0.99) * 1000:>9.2f}  {errors:>6}  {instances}', file=file or sys.stdout)
+    return throughput
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare the HTTP server with per-invocation Lambda')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16],
+        help='Server worker counts to run (default: %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=16,
+        help='Requests in flight at once against the server (default: %(default)s)')
+    parser.add_argument('--urls', type=int, default=200, help='Number of URLs to mint (default: %(default)s)')
+    parser.add_argument('--requests', type=int, default=1000,
+        help='Callbacks to send in each run (default: %(default)s)')
+    parser.add_argument('--output-size', type=int, default=100,
+        help='Bytes of output in each action (default: %(default)s)')
+    parser.add_argument('--no-encryption', action='store_true', help='Mint unencrypted URLs')
+    parser.add_argument('--kms-latency', type=float, default=10,
+        help='Milliseconds added to each fake KMS call (default: %(default)s)')
+    parser.add_argument('--sfn-latency', type=float, default=20,
+        help='Milliseconds added to each fake Step Functions call (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    harness.configure_handlers(
+        encryption=not args.no_encryption,
+        kms_latency=args.kms_latency / 1000,
+        sfn_latency=args.sfn_latency / 1000,
+    )
+
+    print(f'{"mode":<18}  {"requests/s":>10}  {"p50 ms":>9}  {"p99 ms":>9}  {"errors":>6}  {"instances":>9}')
+    urls = load.mint_urls(args.urls, args.output_size)
+    recorder, elapsed = run_lambda(urls, args.requests)
+    lambda_throughput = print_row('lambda', recorder, elapsed)
+    for workers in args.workers:
+        recorder, elapsed = run_server(args, workers)
+        print_row(f'server workers={workers}', recorder, elapsed, lambda_throughput)
+
+if __name__ == '__main__':
+    main()
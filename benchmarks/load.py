@@ -0,0 +1,195 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Generate sustained callback load against a single container.
+
+Mints callback URLs through create_urls, then fires them concurrently at
+process_callback.handler in this process, with the fake KMS and Step
+Functions adding the given latency. With --target, the URLs point at a
+local HTTP adapter instead and are sent over HTTP; the target needs to be
+able to decode them, so use --no-encryption unless it shares the key.
+Reports throughput, status codes and a latency histogram.
+
+    python benchmarks/load.py --requests 5000 --concurrency 8 --kms-latency 10 --sfn-latency 20
+"""
+
+import sys
+import time
+import argparse
+import threading
+import urllib.error
+import urllib.request
+import concurrent.futures
+from collections import Counter
+
+import harness
+
+# upper bounds of the histogram buckets, in milliseconds
+HISTOGRAM_BUCKETS = [0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+def mint_urls(count, output_size, base_url=None):
+    """Create callback URLs in batches, each with a distinct token"""
+    urls = []
+    batch_size = 100
+    with harness.quiet():
+        for batch_start in range(0, count, batch_size):
+            events = []
+            for i in range(batch_start, min(count, batch_start + batch_size)):
+                event = {
+                    'token': f'load-token-{i}',
+                    'actions': [
+                        {
+                            'name': 'approve',
+                            'type': 'success',
+                            'output': {'data': 'x' * output_size},
+                        },
+                    ],
+                }
+                if base_url:
+                    event['base_url'] = base_url
+                events.append(event)
+            response = harness.create_urls.process_batch_event(events, None, harness.DEFAULT_API_INFO,
+                lambda status_code, headers, body: body)
+            for result in response['results']:
+                if 'urls' not in result:
+                    raise RuntimeError(f'Creating URLs failed: {result}')
+                urls.append(result['urls']['approve'])
+    return urls
+
+def call_in_process(url):
+    return harness.callback(url)['statusCode']
+
+def call_http(url, timeout=30):
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+class Recorder:
+    def __init__(self):
+        self.latencies = []
+        self.statuses = Counter()
+        self.exceptions = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, latency, status=None, exception=None):
+        with self._lock:
+            self.latencies.append(latency)
+            if exception is not None:
+                self.exceptions[type(exception).__name__] += 1
+            else:
+                self.statuses[status] += 1
+
+def run_load(urls, call, total_requests, concurrency):
+    recorder = Recorder()
+
+    def worker(index):
+        url = urls[index % len(urls)]
+        start = time.perf_counter()
+        try:
+            status = call(url)
+            recorder.record(time.perf_counter() - start, status=status)
+        except Exception as e:
+            recorder.record(time.perf_counter() - start, exception=e)
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # map consumes the whole range up front, which is fine for the request counts used here
+        list(executor.map(worker, range(total_requests)))
+    elapsed = time.perf_counter() - start
+    return recorder, elapsed
+
+def format_histogram(latencies, width=50):
+    counts = Counter()
+    for latency in latencies:
+        latency_ms = latency * 1000
+        for bound in HISTOGRAM_BUCKETS:
+            if latency_ms <= bound:
+                counts[bound] += 1
+                break
+        else:
+            counts[None] += 1
+    largest = max(counts.values()) if counts else 1
+    lines = []
+    previous = 0
+    for bound in HISTOGRAM_BUCKETS + [None]:
+        label = f'> {previous} ms' if bound is None else f'<= {bound} ms'
+        count = counts.get(bound, 0)
+        if bound is not None:
+            previous = bound
+        if not count and not lines:
+            continue # skip empty leading buckets
+        bar = '#' * int(round(width * count / largest))
+        lines.append(f'{label:>12} {count:>8} {bar}')
+    # drop empty trailing buckets
+    while lines and lines[-1].split()[-1] == '0':
+        lines.pop()
+    return '\n'.join(lines)
+
+def print_report(recorder, elapsed, file=None):
+    file = file or sys.stdout
+    latencies = sorted(recorder.latencies)
+    completed = len(latencies)
+    print(f'{completed} requests in {elapsed:.2f}s, {completed / elapsed:.1f} requests/s', file=file)
+    if latencies:
+        print('latency ms: ' + ', '.join(
+            f'{name} {harness.percentile(latencies, fraction) * 1000:.2f}'
+            for name, fraction in [('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1)]), file=file)
+    print('status codes: ' + ', '.join(f'{k}: {v}' for k, v in sorted(recorder.statuses.items())), file=file)
+    if recorder.exceptions:
+        print('exceptions: ' + ', '.join(f'{k}: {v}' for k, v in recorder.exceptions.most_common()), file=file)
+    print(format_histogram(latencies), file=file)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fire callbacks concurrently at one container')
+    parser.add_argument('--urls', type=int, default=1000, help='Number of URLs to mint (default: %(default)s)')
+    parser.add_argument('--requests', type=int, default=5000,
+        help='Total callbacks to send, cycling through the URLs (default: %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=8,
+        help='Callbacks in flight at once (default: %(default)s)')
+    parser.add_argument('--output-size', type=int, default=100,
+        help='Bytes of output in each action (default: %(default)s)')
+    parser.add_argument('--no-encryption', action='store_true', help='Mint unencrypted URLs')
+    parser.add_argument('--kms-latency', type=float, default=0,
+        help='Milliseconds added to each fake KMS call (default: %(default)s)')
+    parser.add_argument('--sfn-latency', type=float, default=0,
+        help='Milliseconds added to each fake Step Functions call (default: %(default)s)')
+    parser.add_argument('--kms-fault-rate', type=float, default=0, help='Fraction of fake KMS calls that fail')
+    parser.add_argument('--sfn-fault-rate', type=float, default=0,
+        help='Fraction of fake Step Functions calls that fail')
+    parser.add_argument('--target', metavar='BASE_URL',
+        help='Send the callbacks over HTTP to this base URL, instead of calling the handler')
+    args = parser.parse_args(argv)
+
+    harness.configure_handlers(
+        encryption=not args.no_encryption,
+        kms_latency=args.kms_latency / 1000,
+        sfn_latency=args.sfn_latency / 1000,
+        kms_fault_rate=args.kms_fault_rate,
+        sfn_fault_rate=args.sfn_fault_rate,
+    )
+
+    mint_start = time.perf_counter()
+    urls = mint_urls(args.urls, args.output_size, base_url=args.target)
+    print(f'Minted {len(urls)} URLs in {time.perf_counter() - mint_start:.2f}s', file=sys.stderr)
+
+    call = call_http if args.target else call_in_process
+    with harness.quiet():
+        recorder, elapsed = run_load(urls, call, args.requests, args.concurrency)
+    print_report(recorder, elapsed)
+
+if __name__ == '__main__':
+    main()
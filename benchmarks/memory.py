@@ -0,0 +1,212 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the memory each phase of a request allocates, for large outputs.
+
+For outputs and POST bodies from 1 KB to 256 KB, each phase that copies
+them is run under tracemalloc: serializing, encrypting and base64 encoding
+the payload, then decoding, decrypting, parsing and validating it, and
+building the Step Functions output and the response. The encode and
+decode phases follow the steps of encode_payload and decode_payload. For
+each phase, the peak memory allocated, the memory still allocated at the
+end, and the net number of blocks allocated are reported, along with each
+handler's peak for the whole request. The peak as a multiple of the output
+size shows how many copies are alive at once.
+
+The process's maximum RSS is reported at the end, as the figure to compare
+with the function's MemorySize.
+
+    python benchmarks/memory.py [--sizes 1 16 256] [--no-encryption] [--json results.json]
+"""
+
+import sys
+import json
+import base64
+import argparse
+import resource
+import datetime
+import tracemalloc
+from collections import namedtuple
+
+import harness
+
+from sfn_callback_urls.payload import (
+    PayloadBuilder,
+    get_encryption_client,
+    _get_key_args,
+    validate_payload_schema,
+)
+from sfn_callback_urls.callbacks import (
+    get_url,
+    load_from_request,
+    prepare_method_params,
+    format_response,
+)
+from sfn_callback_urls.post_actions import load_post_action_body, _process_post_action
+from sfn_callback_urls.fakes import get_proxy_event
+
+SIZES_KB = [1, 4, 16, 64, 256]
+
+Phase = namedtuple('Phase', ['size_kb', 'path', 'phase', 'peak_kb', 'retained_kb', 'blocks'])
+
+def get_output(size):
+    """An object of about size bytes of JSON, made of many small strings,
+    so formatting it with parameters has to rebuild the whole thing"""
+    item_text = 'x' * 100
+    item_size = len(json.dumps({'id': 0, 'text': item_text})) + 2
+    return {'items': [{'id': i, 'text': item_text} for i in range(max(1, size // item_size))]}
+
+class Profiler:
+    """Runs each phase under tracemalloc, collecting what it allocated"""
+    def __init__(self, size_kb, path):
+        self.size_kb = size_kb
+        self.path = path
+        self.phases = []
+
+    def run(self, name, func, *args, **kwargs):
+        if not tracemalloc.is_tracing():
+            return func(*args, **kwargs) # warming up
+        # snapshots rather than get_traced_memory, for the block counts
+        before_blocks = len(tracemalloc.take_snapshot().traces)
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        result = func(*args, **kwargs)
+        current, peak = tracemalloc.get_traced_memory()
+        after_blocks = len(tracemalloc.take_snapshot().traces)
+        self.phases.append(Phase(
+            size_kb=self.size_kb,
+            path=self.path,
+            phase=name,
+            peak_kb=(peak - before) / 1024,
+            retained_kb=(current - before) / 1024,
+            blocks=after_blocks - before_blocks,
+        ))
+        return result
+
+def profile_get(size_kb, key_provider):
+    """The phases of creating a URL for a success action, then calling it"""
+    profiler = Profiler(size_kb, 'get')
+    action = {
+        'name': 'approve',
+        'type': 'success',
+        'output': get_output(size_kb * 1024),
+    }
+    builder = PayloadBuilder('tid', datetime.datetime.now(datetime.timezone.utc), 'token',
+        enable_output_parameters=True)
+
+    payload = profiler.run('build_payload', builder.build, action)
+    payload_bytes = profiler.run('serialize', lambda: json.dumps(payload).encode())
+    if key_provider:
+        payload_bytes = profiler.run('encrypt', lambda: get_encryption_client().encrypt(
+            source=payload_bytes, **_get_key_args(key_provider))[0])
+    encoded_payload = profiler.run('base64_encode',
+        lambda: ('2-' if key_provider else '1-') + str(base64.urlsafe_b64encode(payload_bytes), 'ascii'))
+    url = profiler.run('get_url', get_url, 'https://example.com', 'approve', 'success', encoded_payload)
+
+    request = get_proxy_event(url)
+    _, _, encoded_payload, parameters = profiler.run('load_from_request', load_from_request, request)
+    payload_bytes = profiler.run('base64_decode', base64.urlsafe_b64decode, encoded_payload.split('-', 1)[1])
+    if key_provider:
+        payload_bytes = profiler.run('decrypt', lambda: get_encryption_client().decrypt(
+            source=payload_bytes, **_get_key_args(key_provider))[0])
+    payload = profiler.run('parse', json.loads, payload_bytes)
+    profiler.run('validate_schema', validate_payload_schema, payload)
+    profiler.run('prepare_method_params', prepare_method_params, payload['action'], parameters)
+    profiler.run('format_response', format_response, 200, {'transaction_id': 'tid'}, request, {}, parameters)
+    return profiler.phases
+
+def profile_post(size_kb):
+    """The phases of handling a POST body that is the output"""
+    profiler = Profiler(size_kb, 'post')
+    action = {
+        'name': 'submit',
+        'type': 'post',
+        'outcomes': [
+            {
+                'name': 'submitted',
+                'type': 'success',
+                'schema': {'type': 'object', 'required': ['items']},
+                'output_body': True,
+            },
+        ],
+    }
+    request = get_proxy_event('https://example.com/respond', method='POST', body=get_output(size_kb * 1024))
+    body = profiler.run('load_post_action_body', load_post_action_body, request)
+    profiler.run('process_post_action', _process_post_action, action, body, None)
+    return profiler.phases
+
+def profile_handlers(size_kb):
+    """Each handler as a single phase, for the peak of the whole request"""
+    action = {
+        'name': 'approve',
+        'type': 'success',
+        'output': get_output(size_kb * 1024),
+    }
+    profiler = Profiler(size_kb, 'handler')
+    url = profiler.run('create_urls', harness.create_url, action)
+    harness.check_callback(profiler.run('process_callback', harness.callback, url))
+    return profiler.phases
+
+def run(sizes_kb, encryption=True):
+    key_provider, _ = harness.configure_handlers(encryption=encryption)
+    phases = []
+    with harness.quiet():
+        # once at the smallest size first, so building validators and parsers isn't counted
+        profile_get(1, key_provider)
+        profile_post(1)
+        profile_handlers(1)
+
+        tracemalloc.start()
+        try:
+            for size_kb in sizes_kb:
+                phases.extend(profile_get(size_kb, key_provider))
+                phases.extend(profile_post(size_kb))
+                phases.extend(profile_handlers(size_kb))
+        finally:
+            tracemalloc.stop()
+    return phases
+
+def print_phases(phases, file=None):
+    file = file or sys.stdout
+    width = max([len(f'{p.path}/{p.phase}') for p in phases] + [5])
+    print(f'{"size":>6}  {"phase":<{width}}  {"peak KB":>9}  {"copies":>6}  {"retained KB":>11}  {"blocks":>7}',
+        file=file)
+    for p in phases:
+        name = f'{p.path}/{p.phase}'
+        print(f'{str(p.size_kb) + "K":>6}  {name:<{width}}  {p.peak_kb:>9.1f}  {p.peak_kb / p.size_kb:>6.1f}  '
+            f'{p.retained_kb:>11.1f}  {p.blocks:>7}', file=file)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure memory allocated per phase for large outputs')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES_KB, metavar='KB',
+        help='Output sizes in KB (default: %(default)s)')
+    parser.add_argument('--no-encryption', action='store_true', help='Use unencrypted payloads')
+    parser.add_argument('--json', metavar='FILE', help='Also write the results to this file')
+    args = parser.parse_args(argv)
+
+    phases = run(args.sizes, encryption=not args.no_encryption)
+    print_phases(phases)
+    # ru_maxrss is in KB on Linux
+    max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f'max RSS: {max_rss_mb:.1f} MB (includes the interpreter, imports and tracemalloc)')
+
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump({
+                'phases': [p._asdict() for p in phases],
+                'max_rss_mb': max_rss_mb,
+            }, fp, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Fail when a hot path is slower than its stored baseline.
+
+Each benchmark is timed in several samples, and each sample is paired with
+a sample of a stdlib-only calibration workload. The ratio between them is
+compared with benchmarks/baseline.json, so the baseline holds on a faster
+or slower machine, and on one whose speed drifts during the run. A
+benchmark fails when it's slower than the baseline by more than the
+tolerance, widened by the noise in both runs, up to a limit so a noisy run
+can't hide a doubling in latency. Benchmarks that fail are measured again
+before the run fails, keeping their best result.
+
+Dependency versions are recorded with the baseline, and any that differ are
+shown, since upgrades of jsonschema and the Encryption SDK are the usual
+cause of a regression.
+
+    python benchmarks/regression.py            # compare, exit 1 on a regression
+    python benchmarks/regression.py --update   # record a new baseline
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import importlib.metadata
+
+import harness
+
+from sfn_callback_urls.payload import encode_payload, decode_payload
+from sfn_callback_urls.callbacks import format_response
+from sfn_callback_urls.post_actions import _process_post_action
+from sfn_callback_urls.fakes import get_fake_kms_key_provider, get_proxy_event
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+PACKAGES = ['aws-encryption-sdk', 'cryptography', 'jsonschema', 'jsonpath-rw', 'boto3']
+
+# slower than the baseline by at least this fraction of ops/s fails
+DEFAULT_TOLERANCE = 0.2
+# the noise can widen the tolerance up to this; 0.5 would be twice the latency
+MAX_TOLERANCE = 0.4
+
+def get_payload():
+    return {
+        'iat': 1577836800,
+        'tid': 'c8d1a0c2b1d54e8e9a0d3f6b7e2a1c4d',
+        'token': 'AAAAKgAAAAIAAAAAAAAAA' * 20,
+        'exp': 1893456000,
+        'action': {
+            'name': 'approve',
+            'type': 'success',
+            'output': {'data': 'x' * 100},
+        },
+    }
+
+def get_post_action():
+    return {
+        'name': 'choose',
+        'type': 'post',
+        'outcomes': [
+            {
+                'name': f'outcome{i}',
+                'type': 'success',
+                'schema': {
+                    'type': 'object',
+                    'properties': {
+                        'choice': {'const': i},
+                        'data': {'type': 'string'},
+                    },
+                    'required': ['choice'],
+                },
+                'output_path': '$.data',
+            } for i in range(3)
+        ]
+    }
+
+def get_cases():
+    """(name, function) for each benchmark"""
+    key_provider = get_fake_kms_key_provider()
+    payload = get_payload()
+    encrypted_payload = encode_payload(payload, key_provider)
+    unencrypted_payload = encode_payload(payload, None)
+
+    response = {
+        'transaction_id': payload['tid'],
+        'action': {'name': 'approve', 'type': 'success'},
+    }
+    json_request = get_proxy_event('https://example.com/respond', headers={'Accept': 'application/json'})
+    html_request = get_proxy_event('https://example.com/respond', headers={'Accept': 'text/html'})
+
+    post_action = get_post_action()
+    post_body = {'choice': 2, 'data': 'x' * 100}
+
+    return [
+        ('encode_payload/encrypted', lambda: encode_payload(payload, key_provider)),
+        ('encode_payload/unencrypted', lambda: encode_payload(payload, None)),
+        ('decode_payload/encrypted', lambda: decode_payload(encrypted_payload, key_provider)),
+        ('decode_payload/unencrypted', lambda: decode_payload(unencrypted_payload, None)),
+        ('format_response/json', lambda: format_response(200, response, json_request, {}, None, {})),
+        ('format_response/html', lambda: format_response(200, response, html_request, {}, None, {})),
+        ('_process_post_action/outcomes=3', lambda: _process_post_action(post_action, post_body, None, {})),
+    ]
+
+CALIBRATION_DOCUMENT = {'items': [{'id': i, 'name': f'item{i}', 'tags': ['a', 'b', 'c']} for i in range(50)]}
+
+def calibrate():
+    json.loads(json.dumps(CALIBRATION_DOCUMENT))
+
+def time_sample(func, min_time):
+    """ops/s over at least min_time seconds"""
+    count = 0
+    start = time.perf_counter()
+    while True:
+        for _ in range(10):
+            func()
+        count += 10
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return count / elapsed
+
+def measure(func, samples, min_time):
+    """Time func in samples, each paired with a sample of the calibration
+    right before it, so the ratio between them follows the machine's speed as
+    it changes during the run. Returns the best ops/s, the median ratio, and
+    the spread of the ratios relative to it (the noise)."""
+    with harness.quiet():
+        for _ in range(20):
+            func()
+        values = []
+        ratios = []
+        for _ in range(samples):
+            calibration = time_sample(calibrate, min_time / 4)
+            value = time_sample(func, min_time)
+            values.append(value)
+            ratios.append(value / calibration)
+    relative = statistics.median(ratios)
+    return {
+        'ops_per_sec': max(values),
+        'relative': relative,
+        'noise': (max(ratios) - min(ratios)) / (2 * relative),
+    }
+
+def get_environment():
+    packages = {}
+    for name in PACKAGES:
+        try:
+            packages[name] = importlib.metadata.version(name)
+        except importlib.metadata.PackageNotFoundError:
+            packages[name] = None
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'packages': packages,
+    }
+
+def run(samples, min_time, name_filter=None):
+    results = {
+        'environment': get_environment(),
+        'benchmarks': {},
+    }
+    for name, func in get_cases():
+        if name_filter and name_filter not in name:
+            continue
+        results['benchmarks'][name] = measure(func, samples, min_time)
+    return results
+
+def remeasure(results, names, samples, min_time):
+    """Measure the named benchmarks again, keeping the faster result for each"""
+    funcs = dict(get_cases())
+    for name in names:
+        result = measure(funcs[name], samples, min_time)
+        if result['relative'] > results['benchmarks'][name]['relative']:
+            results['benchmarks'][name] = result
+
+def get_allowed_slowdown(baseline_noise, noise, tolerance):
+    return min(max(tolerance, baseline_noise + noise), max(tolerance, MAX_TOLERANCE))
+
+def compare(baseline, results, tolerance=DEFAULT_TOLERANCE, calibrate=True, file=None):
+    """Print the comparison, returning the names of the benchmarks that regressed"""
+    file = file or sys.stdout
+
+    for name, version in results['environment']['packages'].items():
+        baseline_version = baseline['environment']['packages'].get(name)
+        if version != baseline_version:
+            print(f'{name} is {version}, the baseline used {baseline_version}', file=file)
+
+    # relative to the calibration, unless comparing on the machine that recorded the baseline
+    key = 'relative' if calibrate else 'ops_per_sec'
+
+    regressions = []
+    width = max([len(name) for name in results['benchmarks']] + [9])
+    print(f'{"benchmark":<{width}}  {"baseline":>10}  {"ops/s":>10}  {"change":>8}  {"allowed":>8}', file=file)
+    for name, result in results['benchmarks'].items():
+        if name not in baseline['benchmarks']:
+            print(f'{name:<{width}}  {"-":>10}  {result["ops_per_sec"]:>10.1f}  (not in the baseline)', file=file)
+            continue
+        change = result[key] / baseline['benchmarks'][name][key] - 1
+        allowed = get_allowed_slowdown(baseline['benchmarks'][name]['noise'], result['noise'], tolerance)
+        regressed = change < -allowed
+        if regressed:
+            regressions.append(name)
+        print(f'{name:<{width}}  {baseline["benchmarks"][name]["ops_per_sec"]:>10.1f}  '
+            f'{result["ops_per_sec"]:>10.1f}  {change:>+8.1%}  '
+            f'{-allowed:>+8.1%}{"  REGRESSED" if regressed else ""}', file=file)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare the hot paths with the stored baseline')
+    parser.add_argument('--update', action='store_true', help='Record the results as the new baseline')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='The baseline file (default: benchmarks/baseline.json)')
+    parser.add_argument('--filter', help='Only run benchmarks with names containing this')
+    parser.add_argument('--samples', type=int, default=5, help='Samples of each benchmark (default: %(default)s)')
+    parser.add_argument('--min-time', type=float, default=0.2,
+        help='Seconds in each sample (default: %(default)s)')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+        help='Fraction of ops/s a benchmark can lose before failing, when the runs are quiet (default: %(default)s)')
+    parser.add_argument('--retries', type=int, default=2,
+        help='Times to measure regressed benchmarks again before failing (default: %(default)s)')
+    parser.add_argument('--no-calibrate', action='store_true',
+        help='Compare with the baseline directly, for the machine that recorded it')
+    args = parser.parse_args(argv)
+
+    results = run(args.samples, args.min_time, args.filter)
+
+    if args.update:
+        with open(args.baseline, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+            fp.write('\n')
+        print(f'Wrote {len(results["benchmarks"])} benchmarks to {args.baseline}')
+        return 0
+
+    with open(args.baseline) as fp:
+        baseline = json.load(fp)
+
+    # a regression caused by something else on the machine usually goes away when measured again
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(args.retries):
+            regressions = compare(baseline, results, args.tolerance, calibrate=not args.no_calibrate, file=devnull)
+            if not regressions:
+                break
+            remeasure(results, regressions, args.samples, args.min_time)
+
+    regressions = compare(baseline, results, args.tolerance, calibrate=not args.no_calibrate)
+    if regressions:
+        print(f'{len(regressions)} regressed: {", ".join(regressions)}')
+        return 1
+    print('No regressions')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
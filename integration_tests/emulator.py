@@ -0,0 +1,301 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""An offline stand-in for the deployed app and test stacks.
+
+The handlers run in this process. API Gateway is emulated by routing
+requests to them as proxy events, KMS by the fake key provider, and the
+test state machine by an in-memory registry of executions and their task
+tokens, which puts each token on an in-memory queue the way the deployed
+state machine puts it on SQS. KMS and Step Functions calls can have
+latency added and faults injected.
+"""
+
+import os
+import sys
+import io
+import json
+import uuid
+import datetime
+import threading
+import contextlib
+import urllib.parse
+from collections import OrderedDict
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+REGION = 'us-east-1'
+API_ID = 'emulator'
+STAGE = 'emulator'
+FUNCTION_NAME = 'CreateUrls'
+STATE_MACHINE_ARN = f'arn:aws:states:{REGION}:123456789012:stateMachine:Emulator'
+QUEUE_URL = f'https://sqs.{REGION}.amazonaws.com/123456789012/Emulator'
+
+from sfn_callback_urls.fakes import (set_fake_environment, get_fake_kms_key_provider,
+    FakeStepFunctionsClient, get_proxy_event)
+
+# Set before the config is loaded and the handlers are imported, since they build their clients at import
+set_fake_environment(API_ID, STAGE, REGION)
+
+with contextlib.redirect_stdout(open(os.devnull, 'w')):
+    import create_urls
+    import process_callback
+
+import botocore.exceptions
+
+from sfn_callback_urls.common import get_data_key_cache_max_age
+from sfn_callback_urls.callbacks import get_api_gateway_url
+from sfn_callback_urls.payload import get_caching_materials_manager
+
+API_URL = get_api_gateway_url(API_ID, STAGE, REGION)
+
+def _client_error(code, message, operation_name):
+    return botocore.exceptions.ClientError({
+        'Error': {
+            'Code': code,
+            'Message': message,
+        }
+    }, operation_name)
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+class Message:
+    """An SQS message, as returned by Queue.receive_messages"""
+    def __init__(self, queue, body):
+        self.queue = queue
+        self.body = body
+        self.message_id = uuid.uuid4().hex
+
+    def delete(self):
+        self.queue._delete(self)
+
+class Queue:
+    """An in-memory SQS queue. Received messages stay on the queue until
+    they are deleted, but aren't received again, like a long visibility timeout."""
+    def __init__(self, url=QUEUE_URL):
+        self.url = url
+        self._messages = OrderedDict()
+        self._received = set()
+        self._lock = threading.Lock()
+
+    def send(self, body):
+        message = Message(self, body)
+        with self._lock:
+            self._messages[message.message_id] = message
+        return message
+
+    def receive_messages(self, MaxNumberOfMessages=1, WaitTimeSeconds=0, **kwargs):
+        # nothing else can put messages on the queue while waiting, so don't
+        with self._lock:
+            messages = [m for m in self._messages.values() if m.message_id not in self._received]
+            messages = messages[:MaxNumberOfMessages]
+            self._received.update(m.message_id for m in messages)
+        return messages
+
+    def _delete(self, message):
+        with self._lock:
+            self._messages.pop(message.message_id, None)
+            self._received.discard(message.message_id)
+
+class StepFunctions(FakeStepFunctionsClient):
+    """The test state machine and the Step Functions client calls on it.
+    Each execution waits on a task token that is sent to the queue, and
+    ends when the token gets a success or failure, like a
+    waitForTaskToken task. Latency and faults apply to the task token calls."""
+    def __init__(self, queue, state_machine_arn=STATE_MACHINE_ARN, **kwargs):
+        super().__init__(**kwargs)
+        self.queue = queue
+        self.state_machine_arn = state_machine_arn
+        self.executions = OrderedDict()
+        self._tokens = {}
+
+    def start_execution(self, stateMachineArn, input='{}', name=None):
+        name = name or uuid.uuid4().hex
+        execution_arn = stateMachineArn.replace(':stateMachine:', ':execution:') + ':' + name
+        token = uuid.uuid4().hex
+        with self._lock:
+            if execution_arn in self.executions:
+                raise _client_error('ExecutionAlreadyExists', f'Execution already exists: {execution_arn}',
+                    'StartExecution')
+            self.executions[execution_arn] = {
+                'executionArn': execution_arn,
+                'stateMachineArn': stateMachineArn,
+                'name': name,
+                'status': 'RUNNING',
+                'startDate': _now(),
+                'input': input,
+            }
+            self._tokens[token] = execution_arn
+        self.queue.send(json.dumps({
+            'Input': json.loads(input),
+            'TaskToken': token,
+        }))
+        return {
+            'executionArn': execution_arn,
+            'startDate': self.executions[execution_arn]['startDate'],
+        }
+
+    def describe_execution(self, executionArn):
+        with self._lock:
+            if executionArn not in self.executions:
+                raise _client_error('ExecutionDoesNotExist', f'Execution does not exist: {executionArn}',
+                    'DescribeExecution')
+            return dict(self.executions[executionArn])
+
+    def list_executions(self, stateMachineArn, statusFilter=None, nextToken=None, **kwargs):
+        with self._lock:
+            executions = [dict(e) for e in self.executions.values()
+                if e['stateMachineArn'] == stateMachineArn and (not statusFilter or e['status'] == statusFilter)]
+        return {'executions': executions}
+
+    def stop_execution(self, executionArn, error=None, cause=None):
+        with self._lock:
+            self._finish(executionArn, 'ABORTED', error=error, cause=cause)
+        return {'stopDate': _now()}
+
+    def _finish(self, execution_arn, status, **fields):
+        execution = self.executions[execution_arn]
+        if execution['status'] != 'RUNNING':
+            return
+        execution['status'] = status
+        execution['stopDate'] = _now()
+        execution.update((k, v) for k, v in fields.items() if v is not None)
+
+    def _get_running_execution_arn(self, operation_name, token):
+        # call with the lock held
+        if token not in self._tokens:
+            raise _client_error('InvalidToken', 'Invalid token', operation_name)
+        execution_arn = self._tokens[token]
+        if self.executions[execution_arn]['status'] != 'RUNNING':
+            raise _client_error('TaskTimedOut', 'Provided task does not exist anymore', operation_name)
+        return execution_arn
+
+    def send_task_success(self, **kwargs):
+        super().send_task_success(**kwargs)
+        try:
+            json.loads(kwargs['output'])
+        except json.JSONDecodeError as e:
+            raise _client_error('InvalidOutput', f'Invalid JSON output: {e}', 'SendTaskSuccess')
+        with self._lock:
+            execution_arn = self._get_running_execution_arn('SendTaskSuccess', kwargs['taskToken'])
+            self._finish(execution_arn, 'SUCCEEDED', output=kwargs['output'])
+        return {}
+
+    def send_task_failure(self, **kwargs):
+        super().send_task_failure(**kwargs)
+        with self._lock:
+            execution_arn = self._get_running_execution_arn('SendTaskFailure', kwargs['taskToken'])
+            self._finish(execution_arn, 'FAILED', error=kwargs.get('error'), cause=kwargs.get('cause'))
+        return {}
+
+    def send_task_heartbeat(self, **kwargs):
+        super().send_task_heartbeat(**kwargs)
+        with self._lock:
+            self._get_running_execution_arn('SendTaskHeartbeat', kwargs['taskToken'])
+        return {}
+
+class Lambda:
+    """Invokes the create URLs function directly"""
+    def invoke(self, FunctionName, Payload, **kwargs):
+        if FunctionName != FUNCTION_NAME:
+            raise _client_error('ResourceNotFoundException', f'Function not found: {FunctionName}', 'Invoke')
+        response = create_urls.direct_handler(json.loads(Payload), None)
+        return {
+            'StatusCode': 200,
+            'Payload': io.BytesIO(json.dumps(response).encode('utf-8')),
+        }
+
+class Response:
+    """The parts of a requests.Response that the tests use"""
+    def __init__(self, status_code, headers=None, body=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = body or ''
+
+    def json(self):
+        return json.loads(self.text)
+
+class Emulator:
+    """The deployed stacks, in this process. In the integration tests, it
+    takes the place of both the boto3 session (through client()) and
+    requests (through get() and post())."""
+    def __init__(self, encryption=True, kms_latency=0, kms_fault_rate=0, sfn_latency=0, sfn_fault_rate=0):
+        self.region_name = REGION
+        self.api_url = API_URL
+        self.function_name = FUNCTION_NAME
+        self.queue = Queue()
+        self.stepfunctions = StepFunctions(self.queue, latency=sfn_latency, fault_rate=sfn_fault_rate,
+            record=False)
+        self.key_provider = None
+        if encryption:
+            self.key_provider = get_fake_kms_key_provider(latency=kms_latency, fault_rate=kms_fault_rate)
+        self.install()
+
+    def install(self):
+        """Point the handlers at this emulator's KMS and Step Functions"""
+        materials_manager = None
+        if self.key_provider:
+            materials_manager = get_caching_materials_manager(self.key_provider, get_data_key_cache_max_age())
+        create_urls.MATERIALS_MANAGER = materials_manager
+        create_urls.IDEMPOTENCY_CACHE = None
+        process_callback.MASTER_KEY_PROVIDER = self.key_provider
+        process_callback.STEP_FUNCTIONS_CLIENT = self.stepfunctions
+
+    def client(self, service_name):
+        if service_name == 'stepfunctions':
+            return self.stepfunctions
+        if service_name == 'lambda':
+            return Lambda()
+        raise ValueError(f'The emulator has no {service_name} client')
+
+    def request(self, method, url, **kwargs):
+        """Send a request to the API, the way requests would. Only the json
+        and headers arguments are used; auth is ignored, as it always passes."""
+        request_headers = {}
+        body = None
+        if kwargs.get('json') is not None:
+            body = json.dumps(kwargs['json'])
+            request_headers['Content-Type'] = 'application/json'
+        for key, value in (kwargs.get('headers') or {}).items():
+            # requests headers are case-insensitive, so these replace the default
+            request_headers = {k: v for k, v in request_headers.items() if k.lower() != key.lower()}
+            request_headers[key] = value
+
+        if not url.startswith(self.api_url + '/'):
+            raise ValueError(f'The emulator can only call its own API, not {url}')
+        path = urllib.parse.urlsplit(url).path[len(urllib.parse.urlsplit(self.api_url).path):]
+
+        event = get_proxy_event(url, method=method.upper(), body=body, headers=request_headers,
+            api_id=API_ID, stage=STAGE)
+        if (path, event['httpMethod']) == ('/urls', 'POST'):
+            response = create_urls.api_handler(event, None)
+        elif path == '/respond' and event['httpMethod'] in ['GET', 'POST']:
+            response = process_callback.handler(event, None)
+        else:
+            # what API Gateway returns for routes that don't exist
+            response = {
+                'statusCode': 403,
+                'headers': {'Content-Type': 'application/json'},
+                'body': json.dumps({'message': 'Missing Authentication Token'}),
+            }
+        return Response(response['statusCode'], response.get('headers'), response.get('body'))
+
+    def get(self, url, **kwargs):
+        return self.request('get', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('post', url, **kwargs)
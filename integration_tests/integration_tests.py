@@ -23,20 +23,38 @@ from collections import namedtuple
 
 import boto3
 import aws_encryption_sdk
-import requests
-from requests_aws4auth import AWS4Auth
+
+# Set USE_EMULATOR=true to run against emulator.py instead of deployed stacks
+USE_EMULATOR = os.environ.get('USE_EMULATOR', '').lower() in ['1', 'true']
+
+if USE_EMULATOR:
+    import emulator
+else:
+    import requests
+    from requests_aws4auth import AWS4Auth
 
 def assert_dicts_equal(a, b):
     assert json.dumps(a, sort_keys=True) == json.dumps(b, sort_keys=True)
 
 Resources = namedtuple('Resources', ['app_stack', 'test_stack', 'state_machine_arn', 'queue'])
 
+def get_http(session):
+    """What to make HTTP requests with, which is the emulator when it's in use"""
+    if USE_EMULATOR:
+        return session
+    return requests
+
 @pytest.fixture(scope='session')
 def session():
+    if USE_EMULATOR:
+        return emulator.Emulator()
     return boto3.Session()
 
 @pytest.fixture(scope='session')
 def resources(session):
+    if USE_EMULATOR:
+        return get_emulator_resources(session)
+
     cfn = session.resource('cloudformation')
     app_stack = cfn.Stack(os.environ['STACK_NAME'])
     test_stack = cfn.Stack(os.environ['TEST_STACK_NAME'])
@@ -62,6 +80,23 @@ def resources(session):
         queue
     )
 
+def get_emulator_resources(emulator_session):
+    app_stack = Stack(emulator_session.api_url, emulator_session.function_name)
+    return Resources(
+        app_stack,
+        None,
+        emulator_session.stepfunctions.state_machine_arn,
+        emulator_session.queue
+    )
+
+class Stack:
+    """The outputs of the app stack, for the emulator"""
+    def __init__(self, api_url, function_name):
+        self.outputs = [
+            {'OutputKey': 'Api', 'OutputValue': api_url},
+            {'OutputKey': 'Function', 'OutputValue': function_name},
+        ]
+
 @pytest.fixture(scope='session')
 def drain(resources, session):
     step_functions = session.client('stepfunctions')
@@ -108,6 +143,16 @@ StateMachineExecution = namedtuple('StateMachineExecution', ['correlation_id', '
 
 @pytest.fixture
 def state_machine_execution(resources, session):
+    execution, message = start_execution(resources, session)
+
+    yield execution
+
+    print('Deleting queue message')
+    message.delete()
+
+def start_execution(resources, session):
+    """Start an execution and get its task token from the queue,
+    returning the execution and the message to delete when done"""
     step_functions = session.client('stepfunctions')
 
     correlation_id = uuid.uuid4().hex
@@ -145,10 +190,7 @@ def state_machine_execution(resources, session):
     token = payload['TaskToken']
     print(f'Got the token: {token}')
 
-    yield StateMachineExecution(correlation_id, token, execution_arn)
-
-    print('Deleting queue message')
-    message.delete()
+    return StateMachineExecution(correlation_id, token, execution_arn), message
 
 def create_urls_with_api(create_urls_input, resources, session, return_raw_response=False):
     for output in resources.app_stack.outputs:
@@ -156,14 +198,16 @@ def create_urls_with_api(create_urls_input, resources, session, return_raw_respo
             api_url = output['OutputValue']
             break
 
-    creds = session.get_credentials().get_frozen_credentials()
-
-    auth = AWS4Auth(creds.access_key, creds.secret_key, session.region_name, 'execute-api', session_token=creds.token)
+    if USE_EMULATOR:
+        auth = None
+    else:
+        creds = session.get_credentials().get_frozen_credentials()
+        auth = AWS4Auth(creds.access_key, creds.secret_key, session.region_name, 'execute-api', session_token=creds.token)
 
     url = f'{api_url}/urls'
     print(f'Getting URLs: {url}')
     print(f'Body: {json.dumps(create_urls_input)}')
-    response = requests.post(url,
+    response = get_http(session).post(url,
         auth=auth,
         json=create_urls_input
     )
@@ -188,7 +232,7 @@ def create_urls_with_lambda(create_urls_input, resources, session, return_raw_re
             function_name = output['OutputValue']
             break
 
-    response = boto3.client('lambda').invoke(
+    response = session.client('lambda').invoke(
         FunctionName=function_name,
         Payload=json.dumps(create_urls_input)
     )
@@ -247,9 +291,9 @@ def _run_test(
         if post_body:
             kwargs['json'] = post_body
             kwargs['headers'] = {'content-type': 'application/json;charset=utf-8'}
-        callback_response = requests.post(url, **kwargs)
+        callback_response = get_http(session).post(url, **kwargs)
     elif callback_method == 'get':
-        callback_response = requests.get(url)
+        callback_response = get_http(session).get(url)
     else:
         raise ValueError(f'bad response_method {callback_method}')
 
@@ -419,12 +463,12 @@ def test_call_twice(state_machine_execution, resources, session, drain):
     url = response['urls'][action_name]
 
     print(f'Calling URL {url}')
-    response = requests.get(url)
+    response = get_http(session).get(url)
 
     assert response.status_code == 200
 
     print(f'Calling URL again')
-    response = requests.get(url)
+    response = get_http(session).get(url)
     assert response.status_code == 400
 
 def test_post_action(state_machine_execution, resources, session, drain):
@@ -0,0 +1,126 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Run the integration test scenarios repeatedly against the emulator, timing them.
+
+Each run starts an execution, gets its token from the queue, and runs the
+scenario end to end: creating the URLs, calling one, and checking the
+execution. Latency can be added to, and faults injected in, the emulated
+KMS and Step Functions; with faults, some runs are expected to fail, and
+the failures are counted by exception type.
+
+    python integration_tests/performance.py --iterations 200 --kms-latency 10 --sfn-latency 20
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import contextlib
+from collections import Counter, namedtuple
+
+os.environ['USE_EMULATOR'] = 'true'
+
+import integration_tests
+import emulator
+
+Result = namedtuple('Result', ['name', 'iterations', 'runs_per_sec', 'p50_ms', 'p99_ms', 'failures'])
+
+def get_scenarios():
+    return [(name[len('test_'):], func) for name, func in vars(integration_tests).items()
+        if name.startswith('test_') and callable(func)]
+
+@contextlib.contextmanager
+def quiet():
+    """The scenarios print every step, and the handlers print a log event for every request"""
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        yield
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def run_scenario(name, scenario, session, iterations):
+    resources = integration_tests.get_emulator_resources(session)
+    latencies = []
+    failures = Counter()
+    with quiet():
+        for _ in range(iterations):
+            start = time.perf_counter()
+            execution, message = integration_tests.start_execution(resources, session)
+            try:
+                scenario(execution, resources, session, None)
+            except Exception as e:
+                failures[type(e).__name__] += 1
+            finally:
+                message.delete()
+            latencies.append(time.perf_counter() - start)
+    total_time = sum(latencies)
+    latencies.sort()
+    return Result(
+        name=name,
+        iterations=iterations,
+        runs_per_sec=iterations / total_time,
+        p50_ms=percentile(latencies, 0.5) * 1000,
+        p99_ms=percentile(latencies, 0.99) * 1000,
+        failures=dict(failures),
+    )
+
+def print_results(results, file=None):
+    file = file or sys.stdout
+    width = max([len(r.name) for r in results] + [8])
+    print(f'{"scenario":<{width}}  {"runs/s":>8}  {"p50 ms":>9}  {"p99 ms":>9}  failures', file=file)
+    for r in results:
+        failures = ', '.join(f'{k}: {v}' for k, v in sorted(r.failures.items())) or '-'
+        print(f'{r.name:<{width}}  {r.runs_per_sec:>8.1f}  {r.p50_ms:>9.3f}  {r.p99_ms:>9.3f}  {failures}',
+            file=file)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time the integration test scenarios against the emulator')
+    parser.add_argument('--iterations', type=int, default=100,
+        help='Runs of each scenario (default: %(default)s)')
+    parser.add_argument('--filter', help='Only run scenarios with names containing this')
+    parser.add_argument('--no-encryption', action='store_true', help='Create unencrypted URLs')
+    parser.add_argument('--kms-latency', type=float, default=0,
+        help='Milliseconds added to each emulated KMS call (default: %(default)s)')
+    parser.add_argument('--sfn-latency', type=float, default=0,
+        help='Milliseconds added to each emulated Step Functions task token call (default: %(default)s)')
+    parser.add_argument('--kms-fault-rate', type=float, default=0, help='Fraction of KMS calls that fail')
+    parser.add_argument('--sfn-fault-rate', type=float, default=0,
+        help='Fraction of Step Functions task token calls that fail')
+    parser.add_argument('--json', metavar='FILE', help='Also write the results to this file')
+    args = parser.parse_args(argv)
+
+    session = emulator.Emulator(
+        encryption=not args.no_encryption,
+        kms_latency=args.kms_latency / 1000,
+        kms_fault_rate=args.kms_fault_rate,
+        sfn_latency=args.sfn_latency / 1000,
+        sfn_fault_rate=args.sfn_fault_rate,
+    )
+
+    results = []
+    for name, scenario in get_scenarios():
+        if args.filter and args.filter not in name:
+            continue
+        results.append(run_scenario(name, scenario, session, args.iterations))
+
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump([r._asdict() for r in results], fp, indent=2)
+
+if __name__ == '__main__':
+    main()
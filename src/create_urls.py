@@ -12,70 +12,141 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+# Start profiling the cold start before anything else is imported
+from sfn_callback_urls.init_profile import InitProfile
+INIT_PROFILE = InitProfile()
+
 import json
-import base64
+import binascii
 import datetime
-import os
 import uuid
-import sys
 import traceback
+import time
+import concurrent.futures
 from collections import namedtuple
 
-import dateutil.parser
 import boto3
-import botocore.exceptions
-import aws_encryption_sdk
 import jsonschema
 
-from sfn_callback_urls.payload import PayloadBuilder, encode_payload
-from sfn_callback_urls.callbacks import get_api_gateway_url, get_url
-from sfn_callback_urls.common import send_log_event, get_header, is_verbose, get_disable_post_actions
-from sfn_callback_urls.post_actions import validate_post_action
-
-from sfn_callback_urls.exceptions import (
-    BaseError,
-    DuplicateActionName,
-    InvalidAction,
-    InvalidDate,
-    PostActionsDisabled
+from sfn_callback_urls.payload import (
+    PayloadBuilder,
+    encode_payload,
+    get_master_key_provider,
+    get_caching_materials_manager,
+    get_kms_materials_manager,
+    EncryptionProcessPool
+)
+from sfn_callback_urls.callbacks import get_api_gateway_url
+from sfn_callback_urls.create import create_urls, get_event_base_url
+from sfn_callback_urls.events import get_method, get_body, get_api_url
+from sfn_callback_urls.common import (
+    get_config,
+    parse_datetime,
+    send_log_event,
+    get_header,
+    get_data_key_cache_max_age,
+    get_idempotency_ttl,
+    get_idempotency_store_spec,
+    get_payload_store_spec,
+    load_payload_mac_keys
 )
+from sfn_callback_urls.action_templates import load_action_templates
+from sfn_callback_urls.idempotency import IdempotencyCache, get_idempotency_key
+from sfn_callback_urls.stores import get_store
+from sfn_callback_urls.log import LOGGER, LazyJson, set_transaction_id
+from sfn_callback_urls.warmup import is_warmup_event, is_provisioned_concurrency_init, handle_warmup_event
+
+from sfn_callback_urls.exceptions import BaseError
 
 from sfn_callback_urls.schemas.create_urls import create_urls_input_schema
 
 # See schemas.create_urls for example event
 
-BOTO3_SESSION = boto3.Session()
+with INIT_PROFILE.time_client('boto3_session'):
+    BOTO3_SESSION = boto3.Session()
 MASTER_KEY_PROVIDER = None
-if 'KEY_ID' in os.environ:
-    MASTER_KEY_PROVIDER = aws_encryption_sdk.KMSMasterKeyProvider(
-        key_ids = [os.environ['KEY_ID']],
-        botocore_session = BOTO3_SESSION._session
-    )
+if get_config().key_id:
+    with INIT_PROFILE.time_client('master_key_provider'):
+        MASTER_KEY_PROVIDER = get_master_key_provider(get_config().key_id, BOTO3_SESSION._session)
+
+# The MAC keys are a SecureString, kept out of the environment
+if get_config().payload_mac_keys_parameter:
+    with INIT_PROFILE.time_client('payload_mac_keys'):
+        load_payload_mac_keys(BOTO3_SESSION)
+
+# Payloads are encrypted through a data key cache, so that all the actions in a request
+# (or all the requests in a batch) don't each need a call to KMS.
+MATERIALS_MANAGER = MASTER_KEY_PROVIDER
+if MASTER_KEY_PROVIDER and get_data_key_cache_max_age():
+    with INIT_PROFILE.time_client('caching_materials_manager'):
+        MATERIALS_MANAGER = get_caching_materials_manager(MASTER_KEY_PROVIDER, get_data_key_cache_max_age())
+
+# The actions in a request are encrypted concurrently, in threads while calls to KMS
+# are the bottleneck, or in processes (outside Lambda) when the CPU is.
+ENCRYPTION_EXECUTOR = None
+if MASTER_KEY_PROVIDER and get_config().encryption_processes:
+    ENCRYPTION_EXECUTOR = EncryptionProcessPool(get_config().encryption_processes, get_kms_materials_manager,
+        get_config().key_id, BOTO3_SESSION.region_name, get_data_key_cache_max_age())
+elif MASTER_KEY_PROVIDER and get_config().encryption_threads > 1:
+    ENCRYPTION_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=get_config().encryption_threads)
+
+with INIT_PROFILE.time_client('action_templates'):
+    ACTION_TEMPLATES = load_action_templates()
+
+# Step Functions retries of the same request get the same response
+IDEMPOTENCY_CACHE = None
+if get_idempotency_ttl():
+    with INIT_PROFILE.time_client('idempotency_cache'):
+        IDEMPOTENCY_CACHE = IdempotencyCache(get_idempotency_ttl(),
+            shared_store=get_store(get_idempotency_store_spec(), BOTO3_SESSION) if get_idempotency_store_spec() else None
+        )
+
+# For short URLs, payloads are put in the store and the URL refers to them by id
+PAYLOAD_STORE = None
+if get_payload_store_spec():
+    with INIT_PROFILE.time_client('payload_store'):
+        PAYLOAD_STORE = get_store(get_payload_store_spec(), BOTO3_SESSION)
 
-DefaultApiInfo = namedtuple('DefaultApiInfo', ['region', 'api_id', 'stage'])
+# Build the validator once rather than on every request
+with INIT_PROFILE.time_client('create_urls_input_validator'):
+    CREATE_URLS_INPUT_VALIDATOR = jsonschema.validators.validator_for(create_urls_input_schema)(create_urls_input_schema)
+
+INIT_PROFILE.finish()
+
+# base_url is set for HTTP APIs, which aren't always reached at their execute-api URL
+DefaultApiInfo = namedtuple('DefaultApiInfo', ['region', 'api_id', 'stage', 'base_url'], defaults=[None])
 
 def direct_handler(event, context):
     """The handler for the CreateUrls Lambda, directly invoked by users"""
+    set_transaction_id(None)
+    if is_warmup_event(event):
+        return warm_up()
     default_api_info = DefaultApiInfo(
         region=BOTO3_SESSION.region_name,
-        api_id=os.environ['API_ID'],
-        stage=os.environ['STAGE']
+        api_id=get_config().api_id,
+        stage=get_config().stage
     )
 
     def response_formatter(statusCode, headers, body):
         return body
     
+    if isinstance(event, list):
+        return process_batch_event(event, context, default_api_info, response_formatter)
     return process_event(event, context, default_api_info, response_formatter)
 
 def api_handler(event, context):
-    """The handler for create URLs calls that come through API Gateway"""
-    if is_verbose():
-        print(f'Request: {event}')
+    """The handler for create URLs calls that come through API Gateway, either a REST API
+    or an HTTP API, or through a function URL"""
+    set_transaction_id(None)
+    if is_warmup_event(event):
+        return warm_up()
+    LOGGER.debug('Request: %s', LazyJson(event))
 
     default_api_info = DefaultApiInfo(
         region=BOTO3_SESSION.region_name,
         api_id=event['requestContext']['apiId'],
-        stage=event['requestContext']['stage']
+        stage=event['requestContext']['stage'],
+        base_url=get_api_url(event)
     )
 
     def response_formatter(statusCode, headers, body):
@@ -85,12 +156,12 @@ def api_handler(event, context):
         h.update(headers)
         return {
             'statusCode': statusCode,
-            'headers': headers,
+            'headers': h,
             'body': json.dumps(body) if body else ''
         }
 
     # Only allow POST
-    if event['httpMethod'] != 'POST':
+    if get_method(event) != 'POST':
         return {
             'statusCode': 405,
             'headers': {
@@ -108,8 +179,9 @@ def api_handler(event, context):
         }
     
     try:
-        event = json.loads(event['body'])
-    except json.JSONDecodeError as e:
+        event = json.loads(get_body(event))
+    # a base64 body may not decode, or not be UTF-8
+    except (json.JSONDecodeError, binascii.Error, UnicodeDecodeError) as e:
         return {
             'statusCode': 400,
             'headers': {
@@ -121,115 +193,145 @@ def api_handler(event, context):
             })
         }
     
+    if isinstance(event, list):
+        return process_batch_event(event, context, default_api_info, response_formatter)
     return process_event(event, context, default_api_info, response_formatter)
 
+def validate_event(event):
+    error = jsonschema.exceptions.best_match(CREATE_URLS_INPUT_VALIDATOR.iter_errors(event))
+    if error is not None:
+        raise error
+
+def process_batch_event(events, context, default_api_info, response_formatter):
+    """Create URLs for many tokens at once. Each entry in the batch is an
+    individual create URLs request, and gets its own result (URLs or error)
+    in the same position in the response."""
+    LOGGER.debug('Batch input: %s', LazyJson(events))
+
+    if not events:
+        return response_formatter(400, {}, {
+            'error': 'InvalidJSON',
+            'message': 'Batch must contain at least one request',
+        })
+
+    batch_id = uuid.uuid4().hex
+
+    results = []
+    for batch_index, event in enumerate(events):
+        status_code, result = _process_request(event, context, default_api_info,
+            log_event_fields={
+                'batch_id': batch_id,
+                'batch_index': batch_index,
+            })
+        results.append(result)
+
+    set_transaction_id(None)
+
+    return_value = response_formatter(200, {}, {
+        'batch_id': batch_id,
+        'results': results,
+    })
+
+    LOGGER.debug('Response: %s', LazyJson(return_value))
+
+    return return_value
+
 def process_event(event, context, default_api_info, response_formatter):
-    if is_verbose():
-        print(f'Input: {event}')
-        
+    status_code, response = _process_request(event, context, default_api_info)
+
+    return_value = response_formatter(status_code, {}, response)
+
+    LOGGER.debug('Response: %s', LazyJson(return_value))
+
+    return return_value
+
+def _process_request(event, context, default_api_info, log_event_fields={}):
+    """Create the URLs for a single request, returning the status code and response body"""
+    start_time = time.perf_counter()
+
     try:
-        jsonschema.validate(event, create_urls_input_schema)
+        schema_validation_start = time.perf_counter()
+        validate_event(event)
+        schema_validation_finish = time.perf_counter()
     except jsonschema.ValidationError as e:
-        return response_formatter(400, {}, {
-                    'error': 'InvalidJSON',
-                    'message': f'{str(e)}',
-                })
+        LOGGER.debug('Invalid input: %s', LazyJson(event))
+        return 400, {
+            'error': 'InvalidJSON',
+            'message': f'{str(e)}',
+        }
+
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    event_base_url = get_event_base_url(event, default_api_info.region)
+    if event_base_url:
+        base_url, region, api_id, stage = event_base_url
+    elif get_config().base_url:
+        # not behind API Gateway, like the HTTP server
+        base_url = get_config().base_url
+        region = api_id = stage = None
+    else:
+        region = default_api_info.region
+        api_id = default_api_info.api_id
+        stage = default_api_info.stage
+        base_url = default_api_info.base_url or get_api_gateway_url(api_id, stage, region)
+
+    idempotency_key = None
+    if IDEMPOTENCY_CACHE:
+        # the base URL is part of the key, so a replay's URLs always point where this request asked
+        idempotency_key = get_idempotency_key(event, base_url)
+        cached_response = IDEMPOTENCY_CACHE.get(idempotency_key)
+        # an expired response is processed again, so it gets the same error a new request would
+        if (cached_response is not None and 'expiration' in cached_response
+                and parse_datetime(cached_response['expiration']) <= timestamp):
+            cached_response = None
+        if cached_response is not None:
+            set_transaction_id(cached_response['transaction_id'])
+            LOGGER.debug('Input: %s', LazyJson(event))
+            log_event = {
+                'handler': 'create_urls',
+                'transaction_id': cached_response['transaction_id'],
+                'timestamp': timestamp.isoformat(),
+                'idempotent_replay': True,
+            }
+            INIT_PROFILE.add_to_log_event(log_event)
+            log_event.update(log_event_fields)
+            send_log_event(log_event, start_time)
+            return 200, cached_response
 
     transaction_id = uuid.uuid4().hex
-    timestamp = datetime.datetime.now()
+    set_transaction_id(transaction_id)
+    LOGGER.debug('Input: %s', LazyJson(event))
 
     log_event = {
+        'handler': 'create_urls',
         'transaction_id': transaction_id,
         'timestamp': timestamp.isoformat(),
         'actions': [],
+        'schema_validation_time': (schema_validation_finish - schema_validation_start),
     }
+    INIT_PROFILE.add_to_log_event(log_event)
+    log_event.update(log_event_fields)
 
     try:
-        # Allow the user to specify another URL endpoint, either for a separate sfn-callback-urls
-        # deployment, for example in a multi-region or multi-account scenario. The user is on
-        # their own for getting the same KMS key in both places.
-        if 'base_url' in event:
-            if isinstance(event['base_url'], str):
-                base_url = event['base_url']
-            else:
-                api_spec = event['base_url']
-                region = api_spec.get('region', default_api_info.region)
-                api_id = api_spec['api_id']
-                stage = api_spec['stage']
-
-                base_url = get_api_gateway_url(api_id, stage, region)
-        else:
-            region = default_api_info.region
-            api_id = default_api_info.api_id
-            stage = default_api_info.stage
-            base_url = get_api_gateway_url(api_id, stage, region)
-        
         log_event.update({
             'api_id': api_id,
             'stage': stage,
             'region': region,
         })
 
-        response = {
-            'transaction_id': transaction_id,
-            'urls': {},
-        }
-        
-        expiration = None
-        if 'expiration' in event:
-            try:
-                expiration = dateutil.parser.parse(event['expiration'])
-            except Exception as e:
-                raise InvalidDate(f'Invalid expiration: {str(e)}')
-            expiration_delta = (expiration - timestamp).total_seconds()
-            log_event['expiration_delta'] = expiration_delta
-            if expiration_delta <= 0:
-                raise InvalidDate('Expiration is in the past')
-            response['expiration'] = expiration.isoformat()
-        
-        payload_builder = PayloadBuilder(transaction_id, timestamp, event['token'],
-            enable_output_parameters=event.get('enable_output_parameters'),
-            expiration=expiration,
-            issuer=getattr(context, 'invoked_function_arn', None)
+        response = create_urls(event, transaction_id, timestamp, base_url, MATERIALS_MANAGER, ACTION_TEMPLATES,
+            payload_store=PAYLOAD_STORE,
+            executor=ENCRYPTION_EXECUTOR,
+            issuer=getattr(context, 'invoked_function_arn', None),
+            log_event=log_event
         )
 
-        actions_for_log = {}
-        for action in event['actions']:
-            action_name = action['name']
-            action_type = action['type']
-
-            if action_name in actions_for_log:
-                raise DuplicateActionName(f'Action {action_name} provided more than once')
-
-            if action_type == 'post':
-                validate_post_action(action)
-
-            actions_for_log[action_name] = action_type
-
-            action_response = action.get('response', {})
-            if 'redirect' in action_response:
-                log_event['redirect'] = True
-            elif any(v in action_response for v in ['json', 'html', 'text']):
-                log_event['response_override'] = True
-            
-            payload = payload_builder.build(action,
-                    log_event=log_event)
+        if idempotency_key:
+            IDEMPOTENCY_CACHE.put(idempotency_key, response)
 
-            encoded_payload = encode_payload(payload, MASTER_KEY_PROVIDER)
+        send_log_event(log_event, start_time)
 
-            response['urls'][action_name] = get_url(
-                    base_url, action_name, action_type, encoded_payload, log_event=log_event)
-
-        log_event['actions'] = actions_for_log
-        
-        return_value = response_formatter(200, {}, response)
-
-        send_log_event(log_event)
-
-        if is_verbose():
-            print(f'Response: {json.dumps(return_value)}')
-
-        return return_value
+        return 200, response
     except BaseError as e:
         response = {
             'transaction_id': transaction_id,
@@ -241,11 +343,8 @@ def process_event(event, context, default_api_info, response_formatter):
             'error': e.code(),
             'message': e.message(),
         }
-        return_value = response_formatter(400, {}, response)
-        send_log_event(log_event)
-        if is_verbose():
-            print(f'Response: {json.dumps(return_value)}')
-        return return_value
+        send_log_event(log_event, start_time)
+        return 400, response
     except Exception as e:
         traceback.print_exc()
         error_class_name = type(e).__module__ + '.' + type(e).__name__
@@ -258,8 +357,38 @@ def process_event(event, context, default_api_info, response_formatter):
             'error': error_class_name,
             'message': str(e),
         }
-        return_value = response_formatter(500, {}, response)
-        send_log_event(log_event)
-        if is_verbose():
-            print(f'Response: {json.dumps(return_value)}')
-        return return_value
+        send_log_event(log_event, start_time)
+        return 500, response
+
+WARMUP_EVENT = {
+    'token': 'warmup',
+    'actions': [
+        {
+            'name': 'warmup',
+            'type': 'heartbeat',
+        }
+    ]
+}
+
+def _warm_data_key():
+    # With the caching materials manager, the data key this generates is reused for real requests
+    payload_builder = PayloadBuilder('warmup', datetime.datetime.now(datetime.timezone.utc), WARMUP_EVENT['token'])
+    encode_payload(payload_builder.build(WARMUP_EVENT['actions'][0]), MATERIALS_MANAGER)
+
+def warm_up():
+    """Do the work that would otherwise slow down the first request"""
+    steps = [
+        ('create_urls_input_validator', lambda: validate_event(WARMUP_EVENT)),
+    ]
+    if MATERIALS_MANAGER:
+        steps.append(('data_key', _warm_data_key))
+    if IDEMPOTENCY_CACHE and IDEMPOTENCY_CACHE.shared_store:
+        # opens the connection
+        steps.append(('idempotency_store', lambda: IDEMPOTENCY_CACHE.shared_store.get('warmup')))
+    if PAYLOAD_STORE:
+        steps.append(('payload_store', lambda: PAYLOAD_STORE.get('warmup')))
+    return handle_warmup_event('create_urls', steps, INIT_PROFILE)
+
+# Provisioned concurrency inits the container well before it gets a request
+if is_provisioned_concurrency_init():
+    warm_up()
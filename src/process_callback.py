@@ -12,20 +12,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import json
-import base64
+# Start profiling the cold start before anything else is imported
+from sfn_callback_urls.init_profile import InitProfile
+INIT_PROFILE = InitProfile()
+
+import asyncio
 import datetime
-import os
-import uuid
-import sys
 import traceback
-from collections import namedtuple, OrderedDict
+from collections import OrderedDict
 import time
 
 import boto3
 import botocore.exceptions
-import aws_encryption_sdk
-import jsonschema
 
 from sfn_callback_urls.callbacks import (
     load_from_request,
@@ -34,183 +32,354 @@ from sfn_callback_urls.callbacks import (
 )
 from sfn_callback_urls.payload import (
     decode_payload,
+    resolve_payload,
+    check_payload_length,
+    get_master_key_provider,
     validate_payload_schema,
     validate_payload_expiration
 )
 from sfn_callback_urls.post_actions import (
-    load_post_action_body,
-    process_post_action
+    process_post_action,
+    prepare_json_path_parser
 )
 from sfn_callback_urls.common import (
+    get_config,
     send_log_event,
     get_force_disable_parameters,
     get_disable_post_actions,
-    is_verbose,
-    get_header
+    get_payload_store_spec,
+    get_rate_limit_store_spec,
+    load_payload_mac_keys
+)
+from sfn_callback_urls.stores import get_store, CachingStore
+from sfn_callback_urls.admission import AdmissionControl
+from sfn_callback_urls.aio import (
+    ThreadedAsyncClient,
+    ThreadedPayloadDecoder,
+    resolve_payload_async,
+    call_admission_control
 )
+from sfn_callback_urls.log import LOGGER, LazyJson, set_transaction_id
+from sfn_callback_urls.warmup import is_warmup_event, is_provisioned_concurrency_init, handle_warmup_event
 
 from sfn_callback_urls.exceptions import (
     ReturnHttpResponse,
     BaseError,
     ActionMismatched,
     ParametersDisabled,
-    PostActionsDisabled,
-    InvalidPostActionBody,
+    RejectedPayload,
     StepFunctionsError
 )
 
-BOTO3_SESSION = boto3.Session()
-STEP_FUNCTIONS_CLIENT = BOTO3_SESSION.client('stepfunctions')
+with INIT_PROFILE.time_client('boto3_session'):
+    BOTO3_SESSION = boto3.Session()
+with INIT_PROFILE.time_client('stepfunctions'):
+    STEP_FUNCTIONS_CLIENT = BOTO3_SESSION.client('stepfunctions')
 MASTER_KEY_PROVIDER = None
-if 'KEY_ID' in os.environ:
-    MASTER_KEY_PROVIDER = aws_encryption_sdk.KMSMasterKeyProvider(
-        key_ids = [os.environ['KEY_ID']],
-        botocore_session = BOTO3_SESSION._session
-    )
+if get_config().key_id:
+    with INIT_PROFILE.time_client('master_key_provider'):
+        MASTER_KEY_PROVIDER = get_master_key_provider(get_config().key_id, BOTO3_SESSION._session)
 
-def handler(request, context):
-    if is_verbose():
-        print(f'Request: {json.dumps(request)}')
+# The MAC keys are a SecureString, kept out of the environment
+if get_config().payload_mac_keys_parameter:
+    with INIT_PROFILE.time_client('payload_mac_keys'):
+        load_payload_mac_keys(BOTO3_SESSION)
 
-    timestamp = datetime.datetime.now()
+# Payloads for short URLs don't change once they're stored, so they can be cached
+PAYLOAD_STORE = None
+if get_payload_store_spec():
+    with INIT_PROFILE.time_client('payload_store'):
+        PAYLOAD_STORE = CachingStore(get_store(get_payload_store_spec(), BOTO3_SESSION))
 
-    log_event = {
-        'timestamp': timestamp.isoformat(),
-    }
+# Rate limits by source IP and transaction, checked before the KMS and Step Functions calls
+ADMISSION_CONTROL = None
+if get_config().source_rate_limit or get_config().transaction_rate_limit:
+    with INIT_PROFILE.time_client('admission_control'):
+        ADMISSION_CONTROL = AdmissionControl(
+            get_config().source_rate_limit,
+            get_config().transaction_rate_limit,
+            shared_store=get_store(get_rate_limit_store_spec(), BOTO3_SESSION) if get_rate_limit_store_spec() else None
+        )
+
+# Awaitable clients for async_handler, which otherwise runs the clients above in threads
+ASYNC_PAYLOAD_DECODER = None
+ASYNC_STEP_FUNCTIONS_CLIENT = None
+
+INIT_PROFILE.finish()
+
+def handler(request, context):
+    set_transaction_id(None)
+    if is_warmup_event(request):
+        return warm_up()
+    LOGGER.debug('Request: %s', LazyJson(request))
+
+    start_time = time.perf_counter()
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+    log_event = _new_log_event(timestamp)
 
     try:
         response = OrderedDict() # ordered so it appears sensibly in the HTML output
 
+        if ADMISSION_CONTROL:
+            ADMISSION_CONTROL.check_source(request, log_event)
+
         (
             action_name_from_url,
             action_type_from_url,
-            encoded_payload,
+            url_payload,
             parameters
         ) = load_from_request(request)
 
+        check_payload_length(url_payload)
+
+        known_transaction_id = None
+        if ADMISSION_CONTROL:
+            known_transaction_id = ADMISSION_CONTROL.check_payload(url_payload, log_event)
+
+        resolve_start = time.perf_counter()
+        encoded_payload = resolve_payload(url_payload, PAYLOAD_STORE)
+        resolve_finish = time.perf_counter()
+        log_event['resolve_time'] = (resolve_finish - resolve_start)
+
         decode_start = time.perf_counter()
-        payload = decode_payload(encoded_payload, MASTER_KEY_PROVIDER)
+        payload = decode_payload(encoded_payload, MASTER_KEY_PROVIDER, get_config().key_id)
         decode_finish = time.perf_counter()
         log_event['decode_time'] = (decode_finish - decode_start)
 
-        validate_payload_schema(payload)
+        _validate_payload(payload, log_event)
 
-        if is_verbose():
-            print(f'Payload: {json.dumps(payload)}')
-        
-        # use the same transaction id given out in the create urls call
-        log_event['transaction_id'] = payload['tid']
-        response['transaction_id'] = payload['tid']
-        
-        validate_payload_expiration(payload, timestamp)
-        
-        # we put the action name and type in the query string directly for convenience
-        # but we only trust the version that's in the payload. If the query string
-        # versions differ from the payload, something funny is going on and we reject
-        # the request. But if they are absent, it's not a problem.
-
-        action_name_in_payload = payload['action']['name']
-        if action_name_from_url and action_name_from_url != action_name_in_payload:
-            raise ActionMismatched(f'The action name says {action_name_from_url} in the url but {action_name_in_payload} in the payload')
-        action_name = action_name_in_payload
-
-        action_type_in_payload = payload['action']['type']
-        if action_type_from_url and action_type_from_url != action_type_in_payload:
-            raise ActionMismatched(f'The action type says {action_type_in_payload} in the url but {action_type_in_payload} in the payload')
-        action_type = action_type_in_payload
-
-        log_event['action'] = {
-            'name': action_name,
-            'type': action_type
-        }
-        response['action'] = OrderedDict((
-            ('name', action_name),
-            ('type', action_type),
-        ))
+        # before the payload is checked against the request, so that repeats of a URL
+        # that fails those checks, like an expired one, aren't decrypted again
+        if ADMISSION_CONTROL:
+            ADMISSION_CONTROL.check_transaction(url_payload, payload['tid'], known_transaction_id, log_event)
 
-        # If parameters are disabled, refuse to service a request
-        # that has parameters enabled, even though it was presumably
-        # valid at creation time to have parameters enabled.
-        force_disable_parameters = get_force_disable_parameters()
-        use_parameters = payload.get('param', False)
-        if use_parameters and force_disable_parameters:
-            raise ParametersDisabled('Parameters are disabled')
-        if not use_parameters:
-            parameters = None
-        
-        action = payload['action']
-
-        response_spec = action.get('response', {})
-
-        outcome_name = action_name
-        outcome_type = action_type
-
-        if action_type == 'post':
-            (
-                post_outcome_name,
-                post_outcome_type,
-                outcome_response_spec,
-                method_params
-            ) = process_post_action(action, request, parameters, log_event)
-            outcome_name = outcome_name + '.' + post_outcome_name
-            outcome_type = post_outcome_type
-            
-            if outcome_response_spec is not None:
-                response_spec = outcome_response_spec
-        else:
-            method_params = prepare_method_params(action, parameters, log_event=log_event)
-        
-        log_event['outcome_name'] = outcome_name
-        log_event['outcome_type'] = outcome_type
+        (
+            method,
+            method_params,
+            response_spec,
+            parameters
+        ) = _prepare_outcome(payload, request, action_name_from_url, action_type_from_url, parameters,
+            timestamp, response, log_event)
+
+        try:
+            sfn_call_start = time.perf_counter()
+            sfn_response = getattr(STEP_FUNCTIONS_CLIENT, method)(**method_params)
+            sfn_call_finish = time.perf_counter()
+            log_event['sfn_call_time'] = (sfn_call_finish-sfn_call_start)
+        except botocore.exceptions.ClientError as e:
+            _raise_step_functions_error(e)
+
+        return _finish(response, request, response_spec, parameters, log_event, start_time)
+    except Exception as e:
+        return _handle_error(e, request, log_event, start_time)
+
+async def async_handler(request, context=None):
+    """handler, for an event loop in a long-lived server. The KMS and Step Functions
+    calls are awaited, through ASYNC_PAYLOAD_DECODER and ASYNC_STEP_FUNCTIONS_CLIENT
+    if they're set, or otherwise the blocking clients run in the default executor."""
+    set_transaction_id(None)
+    loop = asyncio.get_running_loop()
+    if is_warmup_event(request):
+        return await loop.run_in_executor(None, warm_up)
+    LOGGER.debug('Request: %s', LazyJson(request))
+
+    payload_decoder = ASYNC_PAYLOAD_DECODER or ThreadedPayloadDecoder(MASTER_KEY_PROVIDER, key_id=get_config().key_id)
+    step_functions_client = ASYNC_STEP_FUNCTIONS_CLIENT or ThreadedAsyncClient(STEP_FUNCTIONS_CLIENT)
+
+    start_time = time.perf_counter()
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+    log_event = _new_log_event(timestamp)
+
+    try:
+        response = OrderedDict()
+
+        if ADMISSION_CONTROL:
+            await call_admission_control(ADMISSION_CONTROL.check_source, request, log_event)
+
+        (
+            action_name_from_url,
+            action_type_from_url,
+            url_payload,
+            parameters
+        ) = load_from_request(request)
 
-        if is_verbose():
-            print(f'Input for {outcome_type}: {json.dumps(method_params)}')
+        check_payload_length(url_payload)
 
-        method = f'send_task_{outcome_type}'
-        method_params['taskToken'] = payload['token']
+        known_transaction_id = None
+        if ADMISSION_CONTROL:
+            known_transaction_id = await call_admission_control(ADMISSION_CONTROL.check_payload,
+                url_payload, log_event)
+
+        resolve_start = time.perf_counter()
+        encoded_payload = await resolve_payload_async(url_payload, PAYLOAD_STORE)
+        resolve_finish = time.perf_counter()
+        log_event['resolve_time'] = (resolve_finish - resolve_start)
+
+        decode_start = time.perf_counter()
+        payload = await payload_decoder.decode(encoded_payload)
+        decode_finish = time.perf_counter()
+        log_event['decode_time'] = (decode_finish - decode_start)
+
+        _validate_payload(payload, log_event)
+
+        if ADMISSION_CONTROL:
+            await call_admission_control(ADMISSION_CONTROL.check_transaction,
+                url_payload, payload['tid'], known_transaction_id, log_event)
+
+        (
+            method,
+            method_params,
+            response_spec,
+            parameters
+        ) = _prepare_outcome(payload, request, action_name_from_url, action_type_from_url, parameters,
+            timestamp, response, log_event)
 
         try:
             sfn_call_start = time.perf_counter()
-            sfn_response = getattr(STEP_FUNCTIONS_CLIENT, method)(**method_params)
+            sfn_response = await getattr(step_functions_client, method)(**method_params)
             sfn_call_finish = time.perf_counter()
             log_event['sfn_call_time'] = (sfn_call_finish-sfn_call_start)
         except botocore.exceptions.ClientError as e:
-            error_code = e.response['Error']['Code']
-            error_msg = e.response['Error']['Message']
-            # These errors are related to the state machine itself, and
-            # should be 400 errors.
-            # Other ClientErrors, like invalid permissions, should be
-            # considered 500 errors.
-            errors = [
-                'InvalidOutput',
-                'InvalidToken',
-                'TaskDoesNotExist',
-                'TaskTimedOut',
-            ]
-            if error_code in errors:
-                raise StepFunctionsError(f'{error_code}:{error_msg}')
-            raise
-
-        return_value = format_response(200, response, request, response_spec, parameters, log_event)
-
-        send_log_event(log_event)
-
-        if is_verbose():
-            print(f'Response: {json.dumps(return_value)}')
-
-        return return_value
-    except ReturnHttpResponse as e:
+            _raise_step_functions_error(e)
+
+        return _finish(response, request, response_spec, parameters, log_event, start_time)
+    except Exception as e:
+        return _handle_error(e, request, log_event, start_time)
+
+def _new_log_event(timestamp):
+    log_event = {
+        'handler': 'process_callback',
+        'timestamp': timestamp.isoformat(),
+    }
+    INIT_PROFILE.add_to_log_event(log_event)
+    return log_event
+
+def _validate_payload(payload, log_event):
+    validation_start = time.perf_counter()
+    validate_payload_schema(payload)
+    validation_finish = time.perf_counter()
+    log_event['validation_time'] = (validation_finish - validation_start)
+
+def _prepare_outcome(payload, request, action_name_from_url, action_type_from_url, parameters,
+        timestamp, response, log_event):
+    """Check the decoded and validated payload against the request, returning the Step Functions
+    method and its parameters, the response spec, and the parameters for the response"""
+    # use the same transaction id given out in the create urls call
+    set_transaction_id(payload['tid'])
+    LOGGER.debug('Payload: %s', LazyJson(payload))
+
+    log_event['transaction_id'] = payload['tid']
+    response['transaction_id'] = payload['tid']
+    
+    validate_payload_expiration(payload, timestamp)
+    
+    # we put the action name and type in the query string directly for convenience
+    # but we only trust the version that's in the payload. If the query string
+    # versions differ from the payload, something funny is going on and we reject
+    # the request. But if they are absent, it's not a problem.
+
+    action_name_in_payload = payload['action']['name']
+    if action_name_from_url and action_name_from_url != action_name_in_payload:
+        raise ActionMismatched(f'The action name says {action_name_from_url} in the url but {action_name_in_payload} in the payload')
+    action_name = action_name_in_payload
+
+    action_type_in_payload = payload['action']['type']
+    if action_type_from_url and action_type_from_url != action_type_in_payload:
+        raise ActionMismatched(f'The action type says {action_type_in_payload} in the url but {action_type_in_payload} in the payload')
+    action_type = action_type_in_payload
+
+    log_event['action'] = {
+        'name': action_name,
+        'type': action_type
+    }
+    log_event['action_type'] = action_type
+    response['action'] = OrderedDict((
+        ('name', action_name),
+        ('type', action_type),
+    ))
+
+    # If parameters are disabled, refuse to service a request
+    # that has parameters enabled, even though it was presumably
+    # valid at creation time to have parameters enabled.
+    force_disable_parameters = get_force_disable_parameters()
+    use_parameters = payload.get('param', False)
+    if use_parameters and force_disable_parameters:
+        raise ParametersDisabled('Parameters are disabled')
+    if not use_parameters:
+        parameters = None
+    
+    action = payload['action']
+
+    response_spec = action.get('response', {})
+
+    outcome_name = action_name
+    outcome_type = action_type
+
+    if action_type == 'post':
+        (
+            post_outcome_name,
+            post_outcome_type,
+            outcome_response_spec,
+            method_params
+        ) = process_post_action(action, request, parameters, log_event)
+        outcome_name = outcome_name + '.' + post_outcome_name
+        outcome_type = post_outcome_type
+        
+        if outcome_response_spec is not None:
+            response_spec = outcome_response_spec
+    else:
+        method_params = prepare_method_params(action, parameters, log_event=log_event)
+    
+    log_event['outcome_name'] = outcome_name
+    log_event['outcome_type'] = outcome_type
+
+    LOGGER.debug('Input for %s: %s', outcome_type, LazyJson(method_params))
+
+    method = f'send_task_{outcome_type}'
+    method_params['taskToken'] = payload['token']
+
+    return method, method_params, response_spec, parameters
+
+def _raise_step_functions_error(e):
+    error_code = e.response['Error']['Code']
+    error_msg = e.response['Error']['Message']
+    # These errors are related to the state machine itself, and
+    # should be 400 errors.
+    # Other ClientErrors, like invalid permissions, should be
+    # considered 500 errors.
+    errors = [
+        'InvalidOutput',
+        'InvalidToken',
+        'TaskDoesNotExist',
+        'TaskTimedOut',
+    ]
+    if error_code in errors:
+        raise StepFunctionsError(f'{error_code}:{error_msg}')
+    raise e
+
+def _finish(response, request, response_spec, parameters, log_event, start_time):
+    return_value = format_response(200, response, request, response_spec, parameters, log_event)
+
+    send_log_event(log_event, start_time)
+
+    LOGGER.debug('Response: %s', LazyJson(return_value))
+
+    return return_value
+
+def _handle_error(e, request, log_event, start_time):
+    """The response for an exception, called from the except block"""
+    if isinstance(e, RejectedPayload):
+        # counted separately, as these are the callbacks that didn't cost a KMS call
+        log_event['payload_rejected'] = 1
+        log_event['payload_rejection_reason'] = e.reason
+    if isinstance(e, ReturnHttpResponse):
         log_event['error'] = {
             'type': e.TYPE,
             'error': e.code(),
             'message': e.message(),
         }
         return_value = e.get_response()
-        send_log_event(log_event)
-        if is_verbose():
-            print(f'Response: {json.dumps(return_value)}')
-        return return_value
-    except BaseError as e:
+    elif isinstance(e, BaseError):
         response = OrderedDict((
             ('error', e.code()),
             ('message', e.message()),
@@ -221,11 +390,7 @@ def handler(request, context):
             'message': e.message(),
         }
         return_value = format_response(400, response, request, {}, None, log_event)
-        send_log_event(log_event)
-        if is_verbose():
-            print(f'Response: {json.dumps(return_value)}')
-        return return_value
-    except Exception as e:
+    else:
         traceback.print_exc()
         error_class_name = type(e).__module__ + '.' + type(e).__name__
         response = OrderedDict((
@@ -238,7 +403,41 @@ def handler(request, context):
             'message': str(e),
         }
         return_value = format_response(500, response, request, {}, None, log_event)
-        send_log_event(log_event)
-        if is_verbose():
-            print(f'Response: {json.dumps(return_value)}')
-        return return_value
+    send_log_event(log_event, start_time)
+    LOGGER.debug('Response: %s', LazyJson(return_value))
+    return return_value
+
+WARMUP_PAYLOAD = {
+    'iat': 0,
+    'tid': 'warmup',
+    'token': 'warmup',
+    'action': {
+        'name': 'warmup',
+        'type': 'heartbeat',
+    },
+}
+
+def _open_step_functions_connection():
+    # A call with an invalid token needs no extra permissions, and leaves the connection open
+    try:
+        STEP_FUNCTIONS_CLIENT.send_task_heartbeat(taskToken='warmup')
+    except botocore.exceptions.ClientError:
+        pass
+
+def warm_up():
+    """Do the work that would otherwise slow down the first request"""
+    steps = [
+        ('payload_validator', lambda: validate_payload_schema(WARMUP_PAYLOAD)),
+        ('stepfunctions', _open_step_functions_connection),
+    ]
+    if not get_disable_post_actions():
+        steps.append(('json_path_parser', prepare_json_path_parser))
+    if PAYLOAD_STORE:
+        steps.append(('payload_store', lambda: PAYLOAD_STORE.get('warmup')))
+    if ADMISSION_CONTROL and ADMISSION_CONTROL.shared_store is not None:
+        steps.append(('rate_limit_store', lambda: ADMISSION_CONTROL.shared_store.get('warmup')))
+    return handle_warmup_event('process_callback', steps, INIT_PROFILE)
+
+# Provisioned concurrency inits the container well before it gets a request
+if is_provisioned_concurrency_init():
+    warm_up()
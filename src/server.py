@@ -0,0 +1,327 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Serve the API over HTTP, for running in a container rather than Lambda.
+
+Requests are turned into the API Gateway proxy events that the Lambda
+handlers take, and the handlers' responses into HTTP responses. The
+handlers are imported once, so their clients, data keys and caches are
+shared by every request, and up to SERVER_WORKERS requests are handled at
+once. BASE_URL should be set to the URL the server is reached at, so the
+callback URLs point back to it.
+
+The create URLs endpoint has no auth of its own, unlike behind API Gateway,
+so it's only served if SERVER_CREATE_URLS is true. Whatever is in front of
+the server needs to restrict who can call it.
+
+Run it with the built-in WSGI server:
+
+    python server.py --port 8080
+
+or use application (WSGI) or asgi_application (ASGI) with another server.
+Under ASGI, callbacks are handled on the event loop by the async callback
+handler, which awaits KMS and Step Functions, so a single worker can have
+many callbacks in flight.
+"""
+
+import sys
+import json
+import uuid
+import base64
+import asyncio
+import argparse
+import threading
+import urllib.parse
+import concurrent.futures
+import wsgiref.simple_server
+from http import HTTPStatus
+
+import create_urls
+import process_callback
+
+from sfn_callback_urls.common import get_config
+from sfn_callback_urls.callbacks import CALLBACK_PATH
+
+CREATE_URLS_PATH = 'urls'
+
+API_ID = 'server'
+
+def get_routes():
+    """{(path, method): handler}, with paths relative to the base URL"""
+    routes = {
+        ('/' + CALLBACK_PATH, 'GET'): process_callback.handler,
+        ('/' + CALLBACK_PATH, 'POST'): process_callback.handler,
+    }
+    if get_config().server_create_urls:
+        routes[('/' + CREATE_URLS_PATH, 'POST')] = create_urls.api_handler
+    return routes
+
+def get_base_path():
+    if not get_config().base_url:
+        return ''
+    return urllib.parse.urlsplit(get_config().base_url).path.rstrip('/')
+
+def get_proxy_event(method, path, query_string, headers, body, source_ip=None):
+    """The API Gateway proxy event for the request. headers is a list of (name, value)."""
+    query = urllib.parse.parse_qs(query_string, keep_blank_values=True)
+
+    multi_value_headers = {}
+    for name, value in headers:
+        multi_value_headers.setdefault(name, []).append(value)
+
+    is_base64_encoded = False
+    if body is not None:
+        try:
+            body = body.decode('utf-8')
+        except UnicodeDecodeError:
+            body = str(base64.b64encode(body), 'ascii')
+            is_base64_encoded = True
+
+    return {
+        'resource': path,
+        'path': path,
+        'httpMethod': method,
+        'headers': {k: v[-1] for k, v in multi_value_headers.items()},
+        'multiValueHeaders': multi_value_headers,
+        'queryStringParameters': {k: v[-1] for k, v in query.items()} or None,
+        'multiValueQueryStringParameters': query or None,
+        'pathParameters': None,
+        'stageVariables': None,
+        'requestContext': {
+            'apiId': API_ID,
+            'stage': '',
+            'httpMethod': method,
+            'path': path,
+            'requestId': uuid.uuid4().hex,
+            'identity': {
+                'sourceIp': source_ip,
+            },
+        },
+        'body': body,
+        'isBase64Encoded': is_base64_encoded,
+    }
+
+def _error_response(status_code, message, headers=None):
+    response_headers = {'Content-Type': 'application/json'}
+    response_headers.update(headers or {})
+    return {
+        'statusCode': status_code,
+        'headers': response_headers,
+        'body': json.dumps({'message': message}),
+    }
+
+def route(method, path):
+    """(handler, path relative to the base URL), or (None, error response)"""
+    base_path = get_base_path()
+    if base_path:
+        if path != base_path and not path.startswith(base_path + '/'):
+            return None, _error_response(404, 'Not Found')
+        path = path[len(base_path):]
+
+    routes = get_routes()
+    handler = routes.get((path, method))
+    if handler is None:
+        allowed_methods = [m for p, m in routes if p == path]
+        if allowed_methods:
+            return None, _error_response(405, 'Method Not Allowed', {'Allow': ', '.join(allowed_methods)})
+        return None, _error_response(404, 'Not Found')
+    return handler, path
+
+def _unhandled_error(e):
+    # the handlers catch their own errors, this is a bug
+    print(f'Unhandled error: {type(e).__name__}: {str(e)}', file=sys.stderr)
+    return _error_response(500, 'Internal Server Error')
+
+def handle(method, path, query_string, headers, body, source_ip=None):
+    """Route the request to a handler, returning its proxy response"""
+    handler, path = route(method, path)
+    if handler is None:
+        return path
+
+    event = get_proxy_event(method, path, query_string, headers, body, source_ip)
+    try:
+        return handler(event, None)
+    except Exception as e:
+        return _unhandled_error(e)
+
+# handlers that have a version that runs on the event loop
+ASYNC_HANDLERS = {
+    process_callback.handler: process_callback.async_handler,
+}
+
+async def handle_async(method, path, query_string, headers, body, source_ip=None):
+    """handle, using the async version of the handler where there is one,
+    and otherwise running the handler in the executor"""
+    handler, path = route(method, path)
+    if handler is None:
+        return path
+
+    event = get_proxy_event(method, path, query_string, headers, body, source_ip)
+    try:
+        if handler in ASYNC_HANDLERS:
+            return await ASYNC_HANDLERS[handler](event, None)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_get_asgi_executor(), handler, event, None)
+    except Exception as e:
+        return _unhandled_error(e)
+
+def _get_response_parts(response):
+    """(status line, header list, body bytes) for a proxy response"""
+    status_code = response['statusCode']
+    status = f'{status_code} {HTTPStatus(status_code).phrase}'
+
+    headers = list((response.get('headers') or {}).items())
+    for name, values in (response.get('multiValueHeaders') or {}).items():
+        headers.extend((name, value) for value in values)
+
+    body = response.get('body') or ''
+    if response.get('isBase64Encoded'):
+        body = base64.b64decode(body)
+    else:
+        body = body.encode('utf-8')
+    return status, headers, body
+
+def application(environ, start_response):
+    """The WSGI application"""
+    headers = []
+    for key, value in environ.items():
+        if key.startswith('HTTP_'):
+            headers.append((key[len('HTTP_'):].replace('_', '-').title(), value))
+    if environ.get('CONTENT_TYPE'):
+        headers.append(('Content-Type', environ['CONTENT_TYPE']))
+
+    body = None
+    content_length = int(environ.get('CONTENT_LENGTH') or 0)
+    if content_length:
+        body = environ['wsgi.input'].read(content_length)
+
+    path = environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
+    response = handle(environ['REQUEST_METHOD'], path, environ.get('QUERY_STRING', ''), headers, body,
+        environ.get('REMOTE_ADDR'))
+
+    status, response_headers, response_body = _get_response_parts(response)
+    response_headers.append(('Content-Length', str(len(response_body))))
+    start_response(status, response_headers)
+    return [response_body]
+
+_ASGI_EXECUTOR = None
+_ASGI_EXECUTOR_LOCK = threading.Lock()
+
+def _get_asgi_executor():
+    # handlers without an async version block, so they run in a pool rather than on the event loop
+    global _ASGI_EXECUTOR
+    with _ASGI_EXECUTOR_LOCK:
+        if _ASGI_EXECUTOR is None:
+            _ASGI_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=get_config().server_workers)
+        return _ASGI_EXECUTOR
+
+async def asgi_application(scope, receive, send):
+    """The ASGI application"""
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if _ASGI_EXECUTOR:
+                    _ASGI_EXECUTOR.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        raise ValueError(f'Unsupported ASGI scope type {scope["type"]}')
+
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    body = b''.join(chunks) or None
+
+    headers = [(name.decode('latin-1').title(), value.decode('latin-1')) for name, value in scope['headers']]
+    path = scope.get('root_path', '') + scope['path']
+    source_ip = scope['client'][0] if scope.get('client') else None
+
+    response = await handle_async(scope['method'], path, scope['query_string'].decode('latin-1'), headers, body,
+        source_ip)
+
+    status, response_headers, response_body = _get_response_parts(response)
+    await send({
+        'type': 'http.response.start',
+        'status': response['statusCode'],
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in response_headers],
+    })
+    await send({
+        'type': 'http.response.body',
+        'body': response_body,
+    })
+
+class WSGIServer(wsgiref.simple_server.WSGIServer):
+    """The stdlib WSGI server, handling requests in a fixed pool of threads"""
+    daemon_threads = True
+
+    def __init__(self, server_address, handler_class, workers):
+        super().__init__(server_address, handler_class)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+class QuietWSGIRequestHandler(wsgiref.simple_server.WSGIRequestHandler):
+    # the handlers log every request themselves
+    def log_request(self, *args, **kwargs):
+        pass
+
+def make_server(host='', port=8080, workers=None):
+    """The stdlib WSGI server for the application; call serve_forever() on it"""
+    server = WSGIServer((host, port), QuietWSGIRequestHandler, workers or get_config().server_workers)
+    server.set_app(application)
+    return server
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the callback URLs API over HTTP')
+    parser.add_argument('--host', default='', help='Address to listen on (default: all)')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on (default: %(default)s)')
+    parser.add_argument('--workers', type=int,
+        help=f'Requests handled at once (default: SERVER_WORKERS, or {get_config().server_workers})')
+    args = parser.parse_args(argv)
+
+    if not get_config().base_url:
+        print('BASE_URL is not set, so callback URLs will point to an API Gateway API that does not exist',
+            file=sys.stderr)
+    server = make_server(args.host, args.port, args.workers)
+    print(f'Serving on {server.server_address[0]}:{server.server_address[1]}', file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
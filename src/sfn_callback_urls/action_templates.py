@@ -0,0 +1,120 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+import jsonschema
+
+from .post_actions import validate_post_action_outcomes
+from .common import (
+    get_config,
+    ACTION_TEMPLATES_ENV_VAR_NAME
+)
+
+from .exceptions import (
+    BaseError,
+    InvalidAction,
+    InvalidActionTemplates,
+    UnknownActionTemplate
+)
+
+from .schemas.action import action_schema
+from .schemas.action_templates import action_templates_schema
+
+ACTION_VALIDATOR = jsonschema.validators.validator_for(action_schema)(action_schema)
+
+def _validate_action(action):
+    error = jsonschema.exceptions.best_match(ACTION_VALIDATOR.iter_errors(action))
+    if error is not None:
+        raise InvalidAction(f'Invalid action {action.get("name")}: {error.message}')
+    if action['type'] == 'post':
+        validate_post_action_outcomes(action)
+
+class ActionTemplates:
+    """Named, versioned lists of actions that are validated once when loaded,
+    so that create URLs requests can refer to them instead of sending them."""
+    def __init__(self, templates):
+        try:
+            jsonschema.validate(templates, action_templates_schema)
+        except jsonschema.ValidationError as e:
+            raise InvalidActionTemplates(f'Invalid action templates: {e.message}')
+
+        self.templates = templates
+        self._templates = {}
+        for template in templates:
+            key = (template['name'], str(template['version']))
+            if key in self._templates:
+                raise InvalidActionTemplates(f'Action template {key[0]} version {key[1]} provided more than once')
+            names = set()
+            for action in template['actions']:
+                if action['name'] in names:
+                    raise InvalidActionTemplates(f'Action {action["name"]} provided more than once in action template {key[0]}')
+                names.add(action['name'])
+                # Whether post actions are disabled is checked when they're used
+                if action['type'] == 'post':
+                    try:
+                        validate_post_action_outcomes(action)
+                    except BaseError as e:
+                        raise InvalidActionTemplates(f'Invalid action {action["name"]} in action template {key[0]}: {e.message()}')
+            self._templates[key] = template['actions']
+
+    def __len__(self):
+        return len(self._templates)
+
+    def get_actions(self, template_reference):
+        """Get the actions for a template reference from a create URLs request.
+        Only the actions that have overrides need to be validated again."""
+        key = (template_reference['name'], str(template_reference['version']))
+        if key not in self._templates:
+            raise UnknownActionTemplate(f'No action template {key[0]} with version {key[1]}')
+        actions = self._templates[key]
+
+        overrides = template_reference.get('overrides', {})
+        unknown = set(overrides) - set(a['name'] for a in actions)
+        if unknown:
+            raise InvalidAction(f'Overrides given for actions not in the template: {", ".join(sorted(unknown))}')
+
+        template_actions = []
+        for action in actions:
+            name = action['name']
+            if name in overrides:
+                action = dict(action)
+                action.update(overrides[name])
+                action['name'] = name
+                _validate_action(action)
+            template_actions.append(action)
+        return template_actions
+
+def load_action_templates():
+    """Load the action templates given inline or as a file through env vars"""
+    config = get_config()
+    if config.action_templates is not None:
+        source = ACTION_TEMPLATES_ENV_VAR_NAME
+        value = config.action_templates
+    elif config.action_templates_file:
+        source = config.action_templates_file
+        try:
+            with open(source) as fp:
+                value = fp.read()
+        except OSError as e:
+            raise InvalidActionTemplates(f'Could not read action templates file: {str(e)}')
+    else:
+        return ActionTemplates([])
+
+    try:
+        templates = json.loads(value)
+    except json.JSONDecodeError as e:
+        raise InvalidActionTemplates(f'Invalid JSON in action templates from {source}: {str(e)}')
+
+    return ActionTemplates(templates)
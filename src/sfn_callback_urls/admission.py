@@ -0,0 +1,163 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Rate limits for the callback endpoint, which has no auth of its own.
+
+Every callback costs an invocation, and most cost KMS and Step Functions
+calls too, so callers over a limit get a 429 before that work is done.
+Limits are token buckets, one per source IP and one per transaction.
+
+The source IP is checked before anything else. The transaction id is only
+in the payload, so it's learned when a payload is decoded: the container
+remembers which transaction each payload belongs to, and when the same
+payload comes again, its transaction is checked before the payload is
+resolved or decrypted. A request with a payload that hasn't been seen yet
+is counted against its transaction as soon as it's decoded, before it's
+checked against the request, so that repeats of a URL that fails those
+checks (like an expired one) aren't decrypted again either.
+
+The buckets are in the container, so each container allows the limit on
+its own. With a shared store, each key is also counted in fixed windows in
+the store, which holds the limit across containers, at the cost of a store
+call for each limit on each request. If the store fails, the request is
+let through.
+"""
+
+import sys
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from .events import get_source_ip
+from .stores import MemoryStore
+from .exceptions import TooManyRequests
+
+DEFAULT_MAX_KEYS = 10000
+
+KEY_PREFIX = 'ratelimit:'
+
+SOURCE_IP = 'source_ip'
+TRANSACTION = 'transaction'
+
+class TokenBuckets:
+    """A token bucket for each key, holding up to count tokens and refilling
+    at count per period seconds. Only the max_keys most recently used buckets
+    are kept, and a key whose bucket was dropped starts with a full one."""
+    def __init__(self, count, period, max_keys=DEFAULT_MAX_KEYS, clock=time.monotonic):
+        self.count = count
+        self.period = period
+        self.max_keys = max_keys
+        self.clock = clock
+        self._rate = count / period
+        self._buckets = OrderedDict() # key: (tokens, time)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def take(self, key):
+        """Take a token for the key, returning 0 if there was one,
+        or otherwise the seconds until there will be"""
+        with self._lock:
+            now = self.clock()
+            tokens, last = self._buckets.pop(key, (self.count, now))
+            tokens = min(self.count, tokens + (now - last) * self._rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / self._rate
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return wait
+
+class SharedCounters:
+    """Counts of requests for each key in a shared store, allowing count
+    in each fixed window of period seconds"""
+    def __init__(self, store, count, period, prefix=KEY_PREFIX, clock=time.time):
+        self.store = store
+        self.count = count
+        self.period = period
+        self.prefix = prefix
+        self.clock = clock
+
+    def take(self, key):
+        """Count a request for the key, returning 0 if it's within the limit,
+        or otherwise the seconds until the next window"""
+        now = self.clock()
+        window = int(now // self.period)
+        try:
+            count = self.store.increment(f'{self.prefix}{key}:{window}', ttl=self.period)
+        except Exception as e:
+            # the in-container limit still applies
+            print(f'Failed to count request: {type(e).__name__}: {str(e)}', file=sys.stderr)
+            return 0
+        if count <= self.count:
+            return 0
+        return (window + 1) * self.period - now
+
+def get_payload_digest(encoded_payload):
+    return hashlib.sha256(encoded_payload.encode()).hexdigest()
+
+class AdmissionControl:
+    """Rate limits for callbacks by source IP and by transaction. Each limit
+    is (requests, seconds), or None for no limit."""
+    def __init__(self, source_limit=None, transaction_limit=None, shared_store=None,
+            max_keys=DEFAULT_MAX_KEYS):
+        self.shared_store = shared_store
+        self._limiters = {}
+        for kind, limit in [(SOURCE_IP, source_limit), (TRANSACTION, transaction_limit)]:
+            if not limit:
+                continue
+            count, period = limit
+            limiters = [TokenBuckets(count, period, max_keys)]
+            if shared_store is not None:
+                limiters.append(SharedCounters(shared_store, count, period, f'{KEY_PREFIX}{kind}:'))
+            self._limiters[kind] = limiters
+        # payload digest: transaction id
+        self._transactions = MemoryStore(max_keys)
+
+    def _take(self, kind, key, log_event):
+        for limiter in self._limiters.get(kind, []):
+            wait = limiter.take(key)
+            if wait:
+                log_event['throttled'] = 1
+                log_event['throttled_by'] = kind
+                raise TooManyRequests(kind, wait)
+
+    def check_source(self, request, log_event={}):
+        """Before anything else, raise TooManyRequests if the source IP is over its limit"""
+        source_ip = get_source_ip(request)
+        if source_ip:
+            self._take(SOURCE_IP, source_ip, log_event)
+
+    def check_payload(self, encoded_payload, log_event={}):
+        """Before resolving and decoding the payload from the URL, raise TooManyRequests if
+        it's from a transaction that's over its limit. Returns the transaction id if it's known."""
+        if TRANSACTION not in self._limiters:
+            return None
+        transaction_id = self._transactions.get(get_payload_digest(encoded_payload))
+        if transaction_id is not None:
+            self._take(TRANSACTION, transaction_id, log_event)
+        return transaction_id
+
+    def check_transaction(self, encoded_payload, transaction_id, known_transaction_id=None, log_event={}):
+        """After decoding, remember the payload's transaction, and if it wasn't known
+        (and so not counted) before, raise TooManyRequests if it's over its limit"""
+        if TRANSACTION not in self._limiters or transaction_id == known_transaction_id:
+            return
+        self._transactions.put(get_payload_digest(encoded_payload), transaction_id)
+        self._take(TRANSACTION, transaction_id, log_event)
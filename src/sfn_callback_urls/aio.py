@@ -0,0 +1,69 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Awaitable clients, for handling callbacks on an event loop.
+
+The async callback handler makes its network calls through two interfaces:
+a Step Functions client whose send_task_* methods are coroutines (like an
+aiobotocore client), and a payload decoder with a decode coroutine, which
+calls KMS. The implementations here wrap the blocking clients, running them
+in a thread pool so the event loop isn't blocked.
+"""
+
+import asyncio
+import functools
+
+from .payload import decode_payload, resolve_payload
+
+class ThreadedAsyncClient:
+    """Makes a blocking boto3 client's methods awaitable, by running them in an executor"""
+    def __init__(self, client, executor=None):
+        self.client = client
+        self.executor = executor
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+        async def call(**kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(method, **kwargs))
+        return call
+
+class ThreadedPayloadDecoder:
+    """Decodes payloads with decode_payload in an executor, since decrypting calls KMS"""
+    def __init__(self, master_key_provider, executor=None, key_id=None):
+        self.master_key_provider = master_key_provider
+        self.executor = executor
+        self.key_id = key_id
+
+    async def decode(self, encoded_payload):
+        if not self.master_key_provider:
+            # no network call, decoding is quicker than handing off to a thread
+            return decode_payload(encoded_payload, None)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, decode_payload, encoded_payload,
+            self.master_key_provider, self.key_id)
+
+async def resolve_payload_async(encoded_payload, store, executor=None):
+    """resolve_payload, in an executor when there is a store to call"""
+    if not store:
+        return resolve_payload(encoded_payload, store)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, resolve_payload, encoded_payload, store)
+
+async def call_admission_control(method, *args, executor=None, **kwargs):
+    """A method of an AdmissionControl, in an executor when it calls a shared store"""
+    if method.__self__.shared_store is None:
+        return method(*args, **kwargs)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(method, *args, **kwargs))
@@ -0,0 +1,269 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Create callback URLs in bulk, without going through the service.
+
+Reads create URLs requests as newline-delimited JSON, and writes one JSON
+result per line, in the same order. Run with:
+
+    python -m sfn_callback_urls.bulk --key-id KEY --base-url URL < requests.ndjson > urls.ndjson
+"""
+
+import sys
+import os
+import json
+import uuid
+import datetime
+import argparse
+import itertools
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import boto3
+import jsonschema
+
+from .payload import get_master_key_provider, get_caching_materials_manager
+from .callbacks import get_api_gateway_url
+from .create import create_urls, get_event_base_url
+from .action_templates import ActionTemplates, load_action_templates
+from .stores import get_store
+from .common import get_config, load_payload_mac_keys
+
+from .exceptions import BaseError
+
+from .schemas.create_urls import create_urls_input_schema
+
+DEFAULT_CHUNK_SIZE = 100
+DEFAULT_STATS_INTERVAL = 10
+
+# Set in each worker process by _init_worker
+_WORKER_STATE = {}
+
+def _init_worker(key_id, region, data_key_max_age, action_templates, payload_store_spec):
+    validator_class = jsonschema.validators.validator_for(create_urls_input_schema)
+    _WORKER_STATE['validator'] = validator_class(create_urls_input_schema)
+    _WORKER_STATE['action_templates'] = ActionTemplates(action_templates)
+    _WORKER_STATE['region'] = region or boto3.Session().region_name
+
+    if get_config().payload_mac_keys_parameter:
+        load_payload_mac_keys(boto3.Session(region_name=region))
+
+    key_provider = None
+    if key_id:
+        session = boto3.Session(region_name=region)
+        key_provider = get_master_key_provider(key_id, session._session)
+        if data_key_max_age:
+            key_provider = get_caching_materials_manager(key_provider, data_key_max_age)
+    _WORKER_STATE['key_provider'] = key_provider
+
+    _WORKER_STATE['payload_store'] = None
+    if payload_store_spec:
+        _WORKER_STATE['payload_store'] = get_store(payload_store_spec, boto3.Session(region_name=region))
+
+def _create_urls(event, base_url):
+    """Create the URLs for one request, raising BaseError for invalid requests"""
+    error = jsonschema.exceptions.best_match(_WORKER_STATE['validator'].iter_errors(event))
+    if error is not None:
+        raise error
+
+    event_base_url = get_event_base_url(event, _WORKER_STATE['region'])
+    if event_base_url:
+        base_url = event_base_url[0]
+
+    return create_urls(event, uuid.uuid4().hex, datetime.datetime.now(datetime.timezone.utc), base_url,
+        _WORKER_STATE['key_provider'], _WORKER_STATE['action_templates'], _WORKER_STATE['payload_store'])
+
+def _process_line(line, base_url):
+    try:
+        event = json.loads(line)
+        return _create_urls(event, base_url)
+    except (json.JSONDecodeError, jsonschema.ValidationError) as e:
+        return {
+            'error': 'InvalidJSON',
+            'message': f'{str(e)}',
+        }
+    except BaseError as e:
+        return {
+            'error': e.code(),
+            'message': e.message(),
+        }
+    except Exception as e:
+        traceback.print_exc()
+        error_class_name = type(e).__module__ + '.' + type(e).__name__
+        return {
+            'error': 'ServiceError',
+            'message': f'{error_class_name}: {str(e)}'
+        }
+
+def _process_chunk(chunk, base_url):
+    """Process (line number, line) pairs, returning the serialized results
+    and the number of them that are errors"""
+    results = []
+    errors = 0
+    for line_number, line in chunk:
+        result = {'line': line_number}
+        result.update(_process_line(line, base_url))
+        if 'error' in result:
+            errors += 1
+        results.append(json.dumps(result))
+    return results, errors
+
+def _read_chunks(input_file, chunk_size):
+    lines = ((n, l) for n, l in enumerate(input_file, 1) if l.strip())
+    while True:
+        chunk = list(itertools.islice(lines, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+class _Stats:
+    def __init__(self, interval, file):
+        self.interval = interval
+        self.file = file
+        self.start = time.perf_counter()
+        self.last_report = self.start
+        self.processed = 0
+        self.errors = 0
+
+    def add(self, results, errors):
+        self.processed += len(results)
+        self.errors += errors
+        now = time.perf_counter()
+        if self.interval and now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report()
+
+    def report(self, final=False):
+        elapsed = time.perf_counter() - self.start
+        rate = self.processed / elapsed if elapsed else 0
+        label = 'Done' if final else 'Progress'
+        print(f'{label}: {self.processed} requests ({self.errors} errors) in {elapsed:.1f}s, {rate:.1f} requests/s',
+            file=self.file, flush=True)
+
+def _get_parser():
+    parser = argparse.ArgumentParser(prog='python -m sfn_callback_urls.bulk',
+        description='Create callback URLs from newline-delimited JSON create URLs requests')
+    parser.add_argument('input', nargs='?', default='-',
+        help='File of requests, one per line (default: stdin)')
+    parser.add_argument('--output', '-o', default='-',
+        help='File to write results to, one per line (default: stdout)')
+
+    parser.add_argument('--base-url', help='The sfn-callback-urls API URL')
+    parser.add_argument('--api-id', help='The sfn-callback-urls API id, instead of --base-url')
+    parser.add_argument('--stage', help='The sfn-callback-urls API stage, with --api-id')
+    parser.add_argument('--region', help='The AWS region for the API and the KMS key')
+
+    encryption_group = parser.add_mutually_exclusive_group()
+    encryption_group.add_argument('--key-id', default=get_config().key_id,
+        help='The KMS key used by the sfn-callback-urls stack (default: $KEY_ID)')
+    encryption_group.add_argument('--no-encryption', action='store_true',
+        help='Create unencrypted payloads, for stacks with encryption disabled')
+    parser.add_argument('--data-key-max-age', type=float, default=get_config().data_key_cache_max_age,
+        help='Seconds a data key is reused for, 0 to disable caching (default: %(default)s)')
+
+    parser.add_argument('--action-templates', metavar='FILE',
+        help='A JSON file of action templates (default: $ACTION_TEMPLATES or $ACTION_TEMPLATES_FILE)')
+
+    parser.add_argument('--payload-store', metavar='STORE', default=get_config().payload_store,
+        help='The payload store for requests with short_urls, like dynamodb:TABLE (default: $PAYLOAD_STORE)')
+
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+        help='Number of worker processes, 0 to process in this process (default: %(default)s)')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+        help='Number of requests sent to a worker at once (default: %(default)s)')
+    parser.add_argument('--stats-interval', type=float, default=DEFAULT_STATS_INTERVAL,
+        help='Seconds between progress reports on stderr, 0 to disable (default: %(default)s)')
+    return parser
+
+def main(argv=None, stdin=None, stdout=None, stderr=None):
+    stdin = stdin or sys.stdin
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+
+    parser = _get_parser()
+    args = parser.parse_args(argv)
+
+    if args.base_url:
+        base_url = args.base_url
+    elif args.api_id and args.stage:
+        region = args.region or boto3.Session().region_name
+        base_url = get_api_gateway_url(args.api_id, args.stage, region)
+    else:
+        parser.error('Either --base-url or --api-id and --stage are required')
+
+    if args.no_encryption:
+        key_id = None
+    elif args.key_id:
+        key_id = args.key_id
+    else:
+        parser.error('Either --key-id or --no-encryption is required')
+
+    if args.chunk_size < 1:
+        parser.error('--chunk-size must be positive')
+
+    if args.action_templates:
+        with open(args.action_templates) as fp:
+            action_templates = json.load(fp)
+        # validate here so that errors show up once rather than in every worker
+        ActionTemplates(action_templates)
+    else:
+        action_templates = load_action_templates().templates
+
+    initargs = (key_id, args.region, args.data_key_max_age, action_templates, args.payload_store)
+
+    input_file = stdin if args.input == '-' else open(args.input)
+    output_file = stdout if args.output == '-' else open(args.output, 'w')
+
+    stats = _Stats(args.stats_interval, stderr)
+
+    def write(chunk_results):
+        results, errors = chunk_results
+        for result in results:
+            output_file.write(result + '\n')
+        stats.add(results, errors)
+
+    try:
+        chunks = _read_chunks(input_file, args.chunk_size)
+        if args.workers == 0:
+            _init_worker(*initargs)
+            for chunk in chunks:
+                write(_process_chunk(chunk, base_url))
+        else:
+            # Keep a bounded number of chunks in flight, so memory stays constant
+            # regardless of input size, and write results in input order.
+            max_in_flight = args.workers * 2
+            with ProcessPoolExecutor(max_workers=args.workers,
+                    initializer=_init_worker, initargs=initargs) as executor:
+                in_flight = deque()
+                for chunk in chunks:
+                    in_flight.append(executor.submit(_process_chunk, chunk, base_url))
+                    if len(in_flight) >= max_in_flight:
+                        write(in_flight.popleft().result())
+                while in_flight:
+                    write(in_flight.popleft().result())
+    finally:
+        output_file.flush()
+        if input_file is not stdin:
+            input_file.close()
+        if output_file is not stdout:
+            output_file.close()
+
+    stats.report(final=True)
+
+    return 1 if stats.errors else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -22,7 +22,9 @@ from .exceptions import (
     InvalidPayload,
     InvalidPostActionBody
 )
-from .common import get_header, is_verbose
+from .common import get_header
+from .events import get_query_parameters
+from .log import LOGGER, LazyJson
 
 ACTION_NAME_QUERY_PARAM = 'action'
 ACTION_TYPE_QUERY_PARAM = 'type'
@@ -58,7 +60,7 @@ def get_url(base_url, action_name, action_type, payload, log_event={}):
     )
 
 def load_from_request(request):
-    query_parameters = request['queryStringParameters']
+    query_parameters = get_query_parameters(request)
 
     # these don't have to be present
     action_name = query_parameters.get(ACTION_NAME_QUERY_PARAM)
@@ -127,8 +129,7 @@ Details:
 """
 
 def format_response(status_code, response, request, response_spec, parameters, log_event={}):
-    if is_verbose():
-        print(f'Response spec: {json.dumps(response_spec)}')
+    LOGGER.debug('Response spec: %s', LazyJson(response_spec))
     if 'redirect' in response_spec:
         log_event['redirect'] = response_spec['redirect']
         return {
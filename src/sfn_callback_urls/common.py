@@ -13,40 +13,371 @@
 # limitations under the License.
 
 import os
-import sys
+import re
 import json
+import time
+import datetime
+import contextlib
+from collections import OrderedDict, namedtuple
 
-def is_verbose():
-    """Check before debug print statements. Too lazy to go full logger"""
-    return os.environ.get('VERBOSE', '').lower() in ['1', 'true']
+from .exceptions import InvalidConfig
+from .env_vars import (
+    DISABLE_PARAMETERS_ENV_VAR_NAME,
+    DISABLE_POST_ACTION_ENV_VAR_NAME,
+    KEY_ID_ENV_VAR_NAME,
+    API_ID_ENV_VAR_NAME,
+    STAGE_ENV_VAR_NAME,
+    BASE_URL_ENV_VAR_NAME,
+    DATA_KEY_CACHE_MAX_AGE_ENV_VAR_NAME,
+    ENCRYPTION_THREADS_ENV_VAR_NAME,
+    ENCRYPTION_PROCESSES_ENV_VAR_NAME,
+    IDEMPOTENCY_TTL_ENV_VAR_NAME,
+    IDEMPOTENCY_STORE_ENV_VAR_NAME,
+    PAYLOAD_STORE_ENV_VAR_NAME,
+    PAYLOAD_MAC_KEYS_ENV_VAR_NAME,
+    PAYLOAD_MAC_KEYS_PARAMETER_ENV_VAR_NAME,
+    MAX_PAYLOAD_LENGTH_ENV_VAR_NAME,
+    SOURCE_RATE_LIMIT_ENV_VAR_NAME,
+    TRANSACTION_RATE_LIMIT_ENV_VAR_NAME,
+    RATE_LIMIT_STORE_ENV_VAR_NAME,
+    ACTION_TEMPLATES_ENV_VAR_NAME,
+    ACTION_TEMPLATES_FILE_ENV_VAR_NAME,
+    LOG_LEVEL_ENV_VAR_NAME,
+    VERBOSE_ENV_VAR_NAME,
+    LOG_SAMPLE_RATE_ENV_VAR_NAME,
+    METRICS_NAMESPACE_ENV_VAR_NAME,
+    SERVER_WORKERS_ENV_VAR_NAME,
+    SERVER_CREATE_URLS_ENV_VAR_NAME
+)
 
-def _get_disable_param(name):
-    return_value = False
-    if name in os.environ:
-        value = os.environ[name]
-        if value.lower() not in ['0', 'false', '1', 'true']:
-            print(f'Invalid value for {name}: {value}', file=sys.stderr)
-        return_value = value.lower() not in ['0', 'false']
-    return return_value
+DEFAULT_DATA_KEY_CACHE_MAX_AGE = 300
+
+# encrypting is CPU-bound once the data key is cached, so threads only help without the cache
+DEFAULT_ENCRYPTION_THREADS = 4
+DEFAULT_ENCRYPTION_THREADS_WITH_DATA_KEY_CACHE = 1
+
+DEFAULT_IDEMPOTENCY_TTL = 900
+
+PAYLOAD_MAC_KEY_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,16}$')
+PAYLOAD_MAC_MIN_SECRET_LENGTH = 16
+
+# API Gateway limits the request line and headers to 10 KB, so no URL it passes on has a longer payload
+DEFAULT_MAX_PAYLOAD_LENGTH = 10240
+
+_RATE_LIMIT_PATTERN = re.compile(r'^\s*(\d+)\s*/\s*(\d+(?:\.\d+)?)\s*$')
+
+DEFAULT_LOG_LEVEL = 'INFO'
+LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
+
+DEFAULT_METRICS_NAMESPACE = 'sfn-callback-urls'
+
+DEFAULT_SERVER_WORKERS = 8
+
+Config = namedtuple('Config', [
+    'force_disable_parameters', # prevent parameterizing the callback fields
+    'disable_post_actions',
+    'key_id', # None if encryption is disabled
+    'api_id', # the default API for URLs from the CreateUrls function
+    'stage',
+    'base_url', # the default base for URLs when not behind API Gateway, takes precedence over api_id and stage
+    'data_key_cache_max_age', # seconds a data key is reused for encrypting payloads, 0 disables caching
+    'encryption_threads', # actions in a request encrypted at once, 1 encrypts them one at a time
+                          # (the default, unless data key caching is disabled)
+    'encryption_processes', # worker processes to encrypt in instead of threads, not supported in Lambda
+    'idempotency_ttl', # seconds a repeated create URLs request gets the same response, 0 disables
+    'idempotency_store', # shared store spec for idempotent responses, in addition to the in-container cache
+    'payload_store', # store spec that payloads are put in for short URLs
+    'max_payload_length', # longer payloads in callback URLs are rejected without decoding them
+    'payload_mac_keys', # ((key id, secret), ...) for tagging payloads, the first is used for new ones
+    'payload_mac_keys_parameter', # SSM parameter the keys are loaded from by load_payload_mac_keys
+    'source_rate_limit', # (requests, seconds) allowed per source IP for callbacks, or None
+    'transaction_rate_limit', # (requests, seconds) allowed per transaction for callbacks, or None
+    'rate_limit_store', # shared store spec for counting callbacks, in addition to the in-container limits
+    'action_templates', # action templates JSON, takes precedence over the file
+    'action_templates_file',
+    'log_level',
+    'log_sample_rate', # fraction of transactions logged at debug level regardless of the log level
+    'metrics_namespace',
+    'server_workers', # requests the HTTP server handles at once
+    'server_create_urls', # serve the create URLs endpoint from the HTTP server, which has no auth of its own
+])
+
+def _parse_bool(environ, name, errors, empty=False):
+    value = environ.get(name)
+    if value is None:
+        return False
+    if not value:
+        return empty
+    if value.lower() not in ['0', 'false', '1', 'true']:
+        errors.append(f'{name} must be true or false, got {value}')
+    return value.lower() not in ['0', 'false']
+
+def _parse_number(environ, name, default, errors, maximum=None):
+    value = environ.get(name)
+    if not value:
+        return default
+    try:
+        number = float(value)
+    except ValueError:
+        errors.append(f'{name} must be a number, got {value}')
+        return default
+    if number < 0 or (maximum is not None and number > maximum):
+        errors.append(f'{name} must be between 0 and {maximum}, got {value}' if maximum is not None
+            else f'{name} must not be negative, got {value}')
+        return default
+    return number
+
+def _parse_payload_mac_keys(value, name, errors):
+    # KEY_ID:SECRET, comma-separated, newest first
+    if not value:
+        return ()
+    keys = []
+    for entry in value.split(','):
+        key_id, _, secret = entry.strip().partition(':')
+        if not PAYLOAD_MAC_KEY_ID_PATTERN.match(key_id):
+            errors.append(f'{name} key ids must be 1-16 letters, digits, - or _')
+        elif len(secret) < PAYLOAD_MAC_MIN_SECRET_LENGTH:
+            errors.append(f'{name} secrets must be at least {PAYLOAD_MAC_MIN_SECRET_LENGTH} characters, '
+                f'key {key_id} is not')
+        elif key_id in dict(keys):
+            errors.append(f'{name} has key {key_id} more than once')
+        else:
+            keys.append((key_id, secret))
+    return tuple(keys)
+
+def _parse_rate_limit(environ, name, errors):
+    # REQUESTS/SECONDS
+    value = environ.get(name)
+    if not value:
+        return None
+    match = _RATE_LIMIT_PATTERN.match(value)
+    if not match or int(match.group(1)) < 1 or float(match.group(2)) <= 0:
+        errors.append(f'{name} must be a number of requests per number of seconds, like 60/60, got {value}')
+        return None
+    return int(match.group(1)), float(match.group(2))
+
+def _parse_log_level(environ, errors):
+    # VERBOSE is the old way of setting DEBUG
+    if _parse_bool(environ, VERBOSE_ENV_VAR_NAME, errors):
+        return 'DEBUG'
+    value = environ.get(LOG_LEVEL_ENV_VAR_NAME)
+    if not value:
+        return DEFAULT_LOG_LEVEL
+    if value.upper() not in LOG_LEVELS:
+        errors.append(f'{LOG_LEVEL_ENV_VAR_NAME} must be one of {", ".join(LOG_LEVELS)}, got {value}')
+        return DEFAULT_LOG_LEVEL
+    return value.upper()
+
+def load_config(environ=None):
+    """Parse the configuration from the environment, raising InvalidConfig for invalid values"""
+    if environ is None:
+        environ = os.environ
+    errors = []
+    data_key_cache_max_age = _parse_number(environ, DATA_KEY_CACHE_MAX_AGE_ENV_VAR_NAME,
+        DEFAULT_DATA_KEY_CACHE_MAX_AGE, errors)
+    config = Config(
+        # set but empty has always meant disabled, so a stack deployed that way stays locked down
+        force_disable_parameters=_parse_bool(environ, DISABLE_PARAMETERS_ENV_VAR_NAME, errors, empty=True),
+        disable_post_actions=_parse_bool(environ, DISABLE_POST_ACTION_ENV_VAR_NAME, errors, empty=True),
+        key_id=environ.get(KEY_ID_ENV_VAR_NAME) or None,
+        api_id=environ.get(API_ID_ENV_VAR_NAME) or None,
+        stage=environ.get(STAGE_ENV_VAR_NAME) or None,
+        base_url=environ.get(BASE_URL_ENV_VAR_NAME) or None,
+        data_key_cache_max_age=data_key_cache_max_age,
+        encryption_threads=int(_parse_number(environ, ENCRYPTION_THREADS_ENV_VAR_NAME,
+            DEFAULT_ENCRYPTION_THREADS_WITH_DATA_KEY_CACHE if data_key_cache_max_age else DEFAULT_ENCRYPTION_THREADS,
+            errors)),
+        encryption_processes=int(_parse_number(environ, ENCRYPTION_PROCESSES_ENV_VAR_NAME, 0, errors)),
+        idempotency_ttl=_parse_number(environ, IDEMPOTENCY_TTL_ENV_VAR_NAME, DEFAULT_IDEMPOTENCY_TTL, errors),
+        idempotency_store=environ.get(IDEMPOTENCY_STORE_ENV_VAR_NAME) or None,
+        payload_store=environ.get(PAYLOAD_STORE_ENV_VAR_NAME) or None,
+        max_payload_length=int(_parse_number(environ, MAX_PAYLOAD_LENGTH_ENV_VAR_NAME,
+            DEFAULT_MAX_PAYLOAD_LENGTH, errors)),
+        payload_mac_keys=_parse_payload_mac_keys(environ.get(PAYLOAD_MAC_KEYS_ENV_VAR_NAME),
+            PAYLOAD_MAC_KEYS_ENV_VAR_NAME, errors),
+        payload_mac_keys_parameter=environ.get(PAYLOAD_MAC_KEYS_PARAMETER_ENV_VAR_NAME) or None,
+        source_rate_limit=_parse_rate_limit(environ, SOURCE_RATE_LIMIT_ENV_VAR_NAME, errors),
+        transaction_rate_limit=_parse_rate_limit(environ, TRANSACTION_RATE_LIMIT_ENV_VAR_NAME, errors),
+        rate_limit_store=environ.get(RATE_LIMIT_STORE_ENV_VAR_NAME) or None,
+        action_templates=environ.get(ACTION_TEMPLATES_ENV_VAR_NAME),
+        action_templates_file=environ.get(ACTION_TEMPLATES_FILE_ENV_VAR_NAME) or None,
+        log_level=_parse_log_level(environ, errors),
+        log_sample_rate=_parse_number(environ, LOG_SAMPLE_RATE_ENV_VAR_NAME, 0, errors, maximum=1),
+        metrics_namespace=environ.get(METRICS_NAMESPACE_ENV_VAR_NAME) or DEFAULT_METRICS_NAMESPACE,
+        server_workers=int(_parse_number(environ, SERVER_WORKERS_ENV_VAR_NAME, DEFAULT_SERVER_WORKERS, errors)),
+        server_create_urls=_parse_bool(environ, SERVER_CREATE_URLS_ENV_VAR_NAME, errors),
+    )
+    if config.server_workers < 1:
+        errors.append(f'{SERVER_WORKERS_ENV_VAR_NAME} must be at least 1, got {config.server_workers}')
+    if config.encryption_threads < 1:
+        errors.append(f'{ENCRYPTION_THREADS_ENV_VAR_NAME} must be at least 1, got {config.encryption_threads}')
+    if errors:
+        raise InvalidConfig('Invalid configuration: ' + '; '.join(errors))
+    return config
+
+# Loaded once, the environment doesn't change during the life of the container
+CONFIG = load_config()
+
+def get_config():
+    return CONFIG
+
+def reload_config():
+    """Load the configuration again after changing the environment, for tests and benchmarks"""
+    global CONFIG
+    CONFIG = load_config()
+    return CONFIG
+
+@contextlib.contextmanager
+def override_config(**kwargs):
+    """Replace config fields for the duration of the context, for tests"""
+    global CONFIG
+    original_config = CONFIG
+    CONFIG = CONFIG._replace(**kwargs)
+    try:
+        yield CONFIG
+    finally:
+        CONFIG = original_config
 
-DISABLE_PARAMETERS_ENV_VAR_NAME = 'DISABLE_OUTPUT_PARAMETERS'
 def get_force_disable_parameters():
-    """Check for the env var that we'll use to prevent parameterizing the callback fields"""
-    return _get_disable_param(DISABLE_PARAMETERS_ENV_VAR_NAME)
+    return CONFIG.force_disable_parameters
 
-DISABLE_POST_ACTION_ENV_VAR_NAME = 'DISABLE_POST_ACTIONS'
 def get_disable_post_actions():
-    """Check for the env var that we'll use to prevent post actions"""
-    return _get_disable_param(DISABLE_POST_ACTION_ENV_VAR_NAME)
+    return CONFIG.disable_post_actions
 
-def send_log_event(log_event: dict):
-    """Dump the log event to stdout, Lambda will put it in CloudWatch"""
+def get_data_key_cache_max_age():
+    return CONFIG.data_key_cache_max_age
+
+def get_idempotency_ttl():
+    return CONFIG.idempotency_ttl
+
+def get_idempotency_store_spec():
+    return CONFIG.idempotency_store
+
+def get_payload_store_spec():
+    return CONFIG.payload_store
+
+def get_max_payload_length():
+    return CONFIG.max_payload_length
+
+def get_payload_mac_keys():
+    return CONFIG.payload_mac_keys
+
+def load_payload_mac_keys(session):
+    """Get the MAC keys from the PAYLOAD_MAC_KEYS_PARAMETER SecureString, in place of any from
+    PAYLOAD_MAC_KEYS, raising InvalidConfig for invalid keys. Called at init, before any payloads are coded."""
+    name = CONFIG.payload_mac_keys_parameter
+    response = session.client('ssm').get_parameter(Name=name, WithDecryption=True)
+    errors = []
+    keys = _parse_payload_mac_keys(response['Parameter']['Value'], f'Parameter {name}', errors)
+    if errors:
+        raise InvalidConfig('Invalid configuration: ' + '; '.join(errors))
+    set_payload_mac_keys(keys)
+    return keys
+
+def set_payload_mac_keys(keys):
+    """Replace the MAC keys, for loading them from somewhere other than the environment"""
+    global CONFIG
+    CONFIG = CONFIG._replace(payload_mac_keys=keys)
+
+def get_rate_limit_store_spec():
+    return CONFIG.rate_limit_store
+
+def get_log_level():
+    return CONFIG.log_level
+
+def get_log_sample_rate():
+    return CONFIG.log_sample_rate
+
+# Log event fields that are extracted as CloudWatch metrics, with their units
+LOG_EVENT_METRICS = OrderedDict((
+    ('total_time', 'Seconds'),
+    ('init_time', 'Seconds'),
+    ('schema_validation_time', 'Seconds'),
+    ('expiration_parse_time', 'Seconds'),
+    ('post_action_validation_time', 'Seconds'),
+    ('payload_build_time', 'Seconds'),
+    ('encryption_time', 'Seconds'),
+    ('store_time', 'Seconds'),
+    ('url_time', 'Seconds'),
+    ('resolve_time', 'Seconds'),
+    ('decode_time', 'Seconds'),
+    ('validation_time', 'Seconds'),
+    ('sfn_call_time', 'Seconds'),
+    ('errors', 'Count'),
+    ('payload_rejected', 'Count'),
+    ('throttled', 'Count'),
+))
+
+# Each dimension set is only used when the log event has all of its dimensions
+LOG_EVENT_METRIC_DIMENSIONS = [
+    ['handler'],
+    ['handler', 'action_type', 'outcome_type'],
+    ['handler', 'error_code'],
+]
+
+def add_metrics(log_event: dict):
+    """Add CloudWatch Embedded Metric Format metadata to the log event, so that
+    the timings and error counts it contains become metrics without any queries"""
+    if 'error' in log_event:
+        log_event['errors'] = 1
+        log_event['error_code'] = log_event['error']['error']
+    else:
+        log_event['errors'] = 0
+
+    metrics = [{'Name': k, 'Unit': u} for k, u in LOG_EVENT_METRICS.items()
+        if isinstance(log_event.get(k), (int, float))]
+    dimensions = [d for d in LOG_EVENT_METRIC_DIMENSIONS
+        if all(isinstance(log_event.get(k), str) for k in d)]
+
+    log_event['_aws'] = {
+        'Timestamp': int(time.time() * 1000),
+        'CloudWatchMetrics': [
+            {
+                'Namespace': CONFIG.metrics_namespace,
+                'Dimensions': dimensions,
+                'Metrics': metrics,
+            }
+        ]
+    }
+    return log_event
+
+def send_log_event(log_event: dict, start_time: float = None, metrics: bool = True):
+    """Dump the log event to stdout, Lambda will put it in CloudWatch.
+    If given the perf_counter() time the request started, the total time is included.
+    Without metrics, the event is only logged, and doesn't count towards any metric."""
+    if start_time is not None:
+        log_event['total_time'] = time.perf_counter() - start_time
+    if metrics:
+        add_metrics(log_event)
     print(json.dumps(log_event))
 
+# RFC 3339 date-time, which is what the "date-time" format in JSON schema means,
+# except that the offset is optional, and UTC if it's missing
+_DATE_TIME_PATTERN = re.compile(
+    r'^(\d{4}-\d{2}-\d{2})[Tt ](\d{2}:\d{2}:\d{2})(?:\.(\d+))?([Zz]|[+-]\d{2}:\d{2})?$')
+
+def parse_datetime(value: str):
+    """Parse an RFC 3339 date-time into an aware datetime, raising ValueError if it's invalid"""
+    match = _DATE_TIME_PATTERN.match(value)
+    if not match:
+        raise ValueError(f'{value} is not an RFC 3339 date-time')
+    date, time_of_day, fraction, offset = match.groups()
+    # fromisoformat checks the ranges of the fields, but (before Python 3.11) doesn't
+    # accept Z or fractional seconds that aren't milliseconds or microseconds
+    if fraction:
+        time_of_day += '.' + fraction[:6].ljust(6, '0')
+    if not offset or offset in 'Zz':
+        offset = '+00:00'
+    return datetime.datetime.fromisoformat(f'{date}T{time_of_day}{offset}')
+
 def get_header(request: dict, name: str):
     """Get a header from the request payload sent by API Gateway proxy integration to Lambda.
     Does not deal with multi-value headers, but that's fine for this app"""
-    for key in request['headers']:
+    headers = request.get('headers') or {}
+    for key in headers:
         if key.lower() == name.lower():
-            return request['headers'][key]
+            return headers[key]
+    # version 2.0 events have the cookies separately
+    if name.lower() == 'cookie' and request.get('cookies'):
+        return '; '.join(request['cookies'])
     return None
@@ -0,0 +1,174 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Create the URLs for a create URLs request.
+
+This is the part of a request shared by the CreateUrls function and bulk
+creation; each validates the request, picks the transaction id and base
+URL, and handles errors and logging in its own way.
+"""
+
+import time
+
+from .payload import (
+    PayloadBuilder,
+    encode_payloads,
+    store_payload,
+    check_url_payload_length
+)
+from .callbacks import get_api_gateway_url, get_url
+from .post_actions import validate_post_action
+from .common import parse_datetime
+
+from .exceptions import (
+    DuplicateActionName,
+    InvalidDate
+)
+
+def get_event_base_url(event, default_region):
+    """(base URL, region, API id, stage) for a request that gives its own base_url,
+    or None. The region, API id and stage are None when it's given as a URL."""
+    # Allow the user to specify another URL endpoint, either for a separate sfn-callback-urls
+    # deployment, for example in a multi-region or multi-account scenario. The user is on
+    # their own for getting the same KMS key in both places.
+    if 'base_url' not in event:
+        return None
+    if isinstance(event['base_url'], str):
+        return event['base_url'], None, None, None
+    api_spec = event['base_url']
+    region = api_spec.get('region', default_region)
+    api_id = api_spec['api_id']
+    stage = api_spec['stage']
+    return get_api_gateway_url(api_id, stage, region), region, api_id, stage
+
+def create_urls(event, transaction_id, timestamp, base_url, materials_manager, action_templates,
+        payload_store=None, executor=None, issuer=None, log_event=None):
+    """Create the URLs for a request that has been validated against the input schema,
+    returning the response, or raising BaseError if the request is invalid. The actions
+    are encrypted with materials_manager, concurrently if there's an executor (see
+    encode_payloads), and the timings of each phase are added to the log event."""
+    if log_event is None:
+        log_event = {}
+
+    response = {
+        'transaction_id': transaction_id,
+        'urls': {},
+    }
+
+    expiration = None
+    if 'expiration' in event:
+        expiration_parse_start = time.perf_counter()
+        try:
+            expiration = parse_datetime(event['expiration'])
+        except ValueError as e:
+            raise InvalidDate(f'Invalid expiration: {str(e)}')
+        expiration_parse_finish = time.perf_counter()
+        log_event['expiration_parse_time'] = (expiration_parse_finish - expiration_parse_start)
+        expiration_delta = (expiration - timestamp).total_seconds()
+        log_event['expiration_delta'] = expiration_delta
+        if expiration_delta <= 0:
+            raise InvalidDate('Expiration is in the past')
+        response['expiration'] = expiration.isoformat()
+
+    payload_builder = PayloadBuilder(transaction_id, timestamp, event['token'],
+        enable_output_parameters=event.get('enable_output_parameters'),
+        expiration=expiration,
+        issuer=issuer
+    )
+
+    actions = []
+    if 'template' in event:
+        actions.extend(action_templates.get_actions(event['template']))
+        log_event['template'] = {
+            'name': event['template']['name'],
+            'version': str(event['template']['version']),
+            'overrides': list(event['template'].get('overrides', {})),
+        }
+    num_template_actions = len(actions)
+    actions.extend(event.get('actions', []))
+
+    # Phase times are summed over the actions, encryption is also broken down per action.
+    # When actions are encrypted concurrently, encryption_wall_time is less than encryption_time.
+    phase_times = {
+        'post_action_validation_time': 0,
+        'payload_build_time': 0,
+        'encryption_time': 0,
+        'url_time': 0,
+    }
+    encryption_times = {}
+
+    # Payloads are all built before any are encrypted, so that invalid requests fail fast
+    actions_for_log = {}
+    payloads = []
+    for action_index, action in enumerate(actions):
+        action_name = action['name']
+        action_type = action['type']
+
+        if action_name in actions_for_log:
+            raise DuplicateActionName(f'Action {action_name} provided more than once')
+
+        if action_type == 'post':
+            # actions from templates have already been validated
+            post_action_validation_start = time.perf_counter()
+            validate_post_action(action, validate_outcomes=action_index >= num_template_actions)
+            post_action_validation_finish = time.perf_counter()
+            phase_times['post_action_validation_time'] += (post_action_validation_finish - post_action_validation_start)
+
+        actions_for_log[action_name] = action_type
+
+        action_response = action.get('response', {})
+        if 'redirect' in action_response:
+            log_event['redirect'] = True
+        elif any(v in action_response for v in ['json', 'html', 'text']):
+            log_event['response_override'] = True
+
+        payload_build_start = time.perf_counter()
+        payloads.append(payload_builder.build(action,
+                log_event=log_event))
+        payload_build_finish = time.perf_counter()
+        phase_times['payload_build_time'] += (payload_build_finish - payload_build_start)
+
+    encryption_start = time.perf_counter()
+    encoded_payloads = encode_payloads(payloads, materials_manager, executor)
+    log_event['encryption_wall_time'] = time.perf_counter() - encryption_start
+
+    # in the order of the actions, so the response is the same however they were encrypted
+    for action, (encoded_payload, encryption_time) in zip(actions, encoded_payloads):
+        action_name = action['name']
+        action_type = action['type']
+
+        encryption_times[action_name] = encryption_time
+        phase_times['encryption_time'] += encryption_time
+
+        if event.get('short_urls'):
+            log_event['short_urls'] = True
+            store_start = time.perf_counter()
+            encoded_payload = store_payload(encoded_payload, payload_store,
+                    expiration=expiration, timestamp=timestamp)
+            store_finish = time.perf_counter()
+            phase_times['store_time'] = phase_times.get('store_time', 0) + (store_finish - store_start)
+        else:
+            check_url_payload_length(action_name, encoded_payload)
+
+        url_start = time.perf_counter()
+        response['urls'][action_name] = get_url(
+                base_url, action_name, action_type, encoded_payload, log_event=log_event)
+        url_finish = time.perf_counter()
+        phase_times['url_time'] += (url_finish - url_start)
+
+    log_event['actions'] = actions_for_log
+    log_event.update(phase_times)
+    log_event['encryption_times'] = encryption_times
+
+    return response
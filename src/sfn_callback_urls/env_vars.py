@@ -0,0 +1,59 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The environment variables the configuration is read from, by common.load_config.
+
+They're kept apart from common, which loads the configuration when it's imported,
+so that the environment can be set up for tests and benchmarks before it is.
+"""
+
+DISABLE_PARAMETERS_ENV_VAR_NAME = 'DISABLE_OUTPUT_PARAMETERS'
+DISABLE_POST_ACTION_ENV_VAR_NAME = 'DISABLE_POST_ACTIONS'
+KEY_ID_ENV_VAR_NAME = 'KEY_ID'
+API_ID_ENV_VAR_NAME = 'API_ID'
+STAGE_ENV_VAR_NAME = 'STAGE'
+BASE_URL_ENV_VAR_NAME = 'BASE_URL'
+
+DATA_KEY_CACHE_MAX_AGE_ENV_VAR_NAME = 'DATA_KEY_CACHE_MAX_AGE'
+ENCRYPTION_THREADS_ENV_VAR_NAME = 'ENCRYPTION_THREADS'
+ENCRYPTION_PROCESSES_ENV_VAR_NAME = 'ENCRYPTION_PROCESSES'
+
+IDEMPOTENCY_TTL_ENV_VAR_NAME = 'IDEMPOTENCY_TTL'
+IDEMPOTENCY_STORE_ENV_VAR_NAME = 'IDEMPOTENCY_STORE'
+
+PAYLOAD_STORE_ENV_VAR_NAME = 'PAYLOAD_STORE'
+
+PAYLOAD_MAC_KEYS_ENV_VAR_NAME = 'PAYLOAD_MAC_KEYS'
+# an SSM SecureString parameter holding the keys, which are then loaded at init, rather than in the environment
+PAYLOAD_MAC_KEYS_PARAMETER_ENV_VAR_NAME = 'PAYLOAD_MAC_KEYS_PARAMETER'
+
+MAX_PAYLOAD_LENGTH_ENV_VAR_NAME = 'MAX_PAYLOAD_LENGTH'
+
+SOURCE_RATE_LIMIT_ENV_VAR_NAME = 'CALLBACK_SOURCE_RATE_LIMIT'
+TRANSACTION_RATE_LIMIT_ENV_VAR_NAME = 'CALLBACK_TRANSACTION_RATE_LIMIT'
+RATE_LIMIT_STORE_ENV_VAR_NAME = 'RATE_LIMIT_STORE'
+
+ACTION_TEMPLATES_ENV_VAR_NAME = 'ACTION_TEMPLATES'
+ACTION_TEMPLATES_FILE_ENV_VAR_NAME = 'ACTION_TEMPLATES_FILE'
+
+LOG_LEVEL_ENV_VAR_NAME = 'LOG_LEVEL'
+VERBOSE_ENV_VAR_NAME = 'VERBOSE'
+LOG_SAMPLE_RATE_ENV_VAR_NAME = 'LOG_SAMPLE_RATE'
+
+METRICS_NAMESPACE_ENV_VAR_NAME = 'METRICS_NAMESPACE'
+
+SERVER_WORKERS_ENV_VAR_NAME = 'SERVER_WORKERS'
+SERVER_CREATE_URLS_ENV_VAR_NAME = 'SERVER_CREATE_URLS'
+
+CONFIG_ENV_VAR_NAMES = [value for name, value in list(globals().items()) if name.endswith('_ENV_VAR_NAME')]
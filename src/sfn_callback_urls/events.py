@@ -0,0 +1,67 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Read requests from the events API Gateway and Lambda send to the handlers.
+
+REST APIs send the version 1.0 proxy event. HTTP APIs and Lambda function
+URLs send version 2.0, which has the method and source IP under
+requestContext.http, the query string unparsed (rawQueryString), and
+cookies separate from the headers. Each function reads only the fields it
+needs, so nothing is parsed that the request doesn't use. Responses are the
+same for both versions.
+"""
+
+import base64
+import urllib.parse
+
+def is_v2_event(request):
+    return request.get('version') == '2.0'
+
+def get_method(request):
+    if is_v2_event(request):
+        return request['requestContext']['http']['method']
+    return request['httpMethod']
+
+def get_query_parameters(request):
+    """{name: value}, with the last value for names that are repeated"""
+    if is_v2_event(request):
+        # queryStringParameters in v2 joins repeated values with commas, which can't be undone
+        return dict(urllib.parse.parse_qsl(request.get('rawQueryString') or '', keep_blank_values=True))
+    return request.get('queryStringParameters') or {}
+
+def get_body(request):
+    """The body as a string, or None. A base64 body that isn't valid, or isn't UTF-8,
+    raises binascii.Error or UnicodeDecodeError."""
+    body = request.get('body')
+    if body is not None and request.get('isBase64Encoded'):
+        body = base64.b64decode(body).decode('utf-8')
+    return body
+
+def get_source_ip(request):
+    if is_v2_event(request):
+        return request['requestContext']['http'].get('sourceIp')
+    return request['requestContext'].get('identity', {}).get('sourceIp')
+
+def get_api_url(request):
+    """The URL of the HTTP API a version 2.0 event came through, including the stage,
+    or None for version 1.0 events. For a function URL, this is the URL of the
+    function that got the request."""
+    if not is_v2_event(request):
+        return None
+    request_context = request['requestContext']
+    url = 'https://' + request_context['domainName']
+    stage = request_context.get('stage')
+    if stage and stage != '$default':
+        url += '/' + stage
+    return url
@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import json
+import math
 
 class BaseError(Exception):
     TYPE = 'GenericError'
@@ -45,6 +46,19 @@ class OutputFormatting(RequestError):
 class InvalidPayload(RequestError):
     pass
 
+class RejectedPayload(InvalidPayload):
+    """An invalid payload that was caught before decrypting it, for the given reason"""
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+    def code(self):
+        # the same to the caller as any other invalid payload
+        return 'InvalidPayload'
+
+class PayloadTooLong(RequestError):
+    pass
+
 class ExpiredPayload(RequestError):
     pass
 
@@ -66,6 +80,12 @@ class InvalidDate(RequestError):
 class ActionMismatched(RequestError):
     pass
 
+class UnknownActionTemplate(RequestError):
+    pass
+
+class ShortUrlsUnavailable(RequestError):
+    pass
+
 class PostActionsDisabled(RequestError):
     pass
 
@@ -78,6 +98,14 @@ class InvalidJsonPath(RequestError):
 class InvalidPostActionBody(RequestError):
     pass
 
+class InvalidActionTemplates(Exception):
+    """The configured action templates could not be loaded"""
+    pass
+
+class InvalidConfig(Exception):
+    """The configuration in the environment is invalid"""
+    pass
+
 class StepFunctionsError(BaseError):
     """Still a 400 error, but resulting from the call to Step Functions"""
     TYPE = 'StepFunctionsError'
@@ -95,8 +123,8 @@ class ReturnHttpResponse(Exception):
     
     def get_response(self):
         body = ''
-        if body is not None:
-            body = body if isinstance(body, str) else json.dumps(body)
+        if self.body is not None:
+            body = self.body if isinstance(self.body, str) else json.dumps(self.body)
         return {
             'statusCode': self.status_code,
             'headers': self.headers,
@@ -108,3 +136,19 @@ class ReturnHttpResponse(Exception):
     
     def message(self):
         return self._message
+
+class TooManyRequests(ReturnHttpResponse):
+    """A 429 for a callback over a rate limit, for the given kind of key"""
+    def __init__(self, kind, wait):
+        message = f'Too many requests for this {kind.replace("_", " ")}'
+        super().__init__('TooManyRequests', message, 429,
+            headers={
+                'Content-Type': 'application/json',
+                'Retry-After': str(max(1, math.ceil(wait))),
+            },
+            body={
+                'error': 'TooManyRequests',
+                'message': message,
+            }
+        )
+        self.kind = kind
@@ -0,0 +1,282 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Stand-ins for AWS, for running the handlers offline in tests and benchmarks.
+
+FakeKmsKeyProvider encrypts with a local AES key in place of KMS, and
+FakeStepFunctionsClient records task token calls. Both can add latency
+and inject faults. FakeAsyncStepFunctionsClient and FakeAsyncPayloadDecoder
+are the awaitable versions, for the async callback handler, which wait
+without blocking a thread. get_proxy_event turns a callback URL into the
+event API Gateway would send to the callback handler. set_fake_environment
+sets up the environment for importing the handlers offline.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import threading
+import urllib.parse
+
+import botocore.exceptions
+import aws_encryption_sdk
+from aws_encryption_sdk.key_providers.raw import RawMasterKeyProvider, RawMasterKey
+from aws_encryption_sdk.identifiers import WrappingAlgorithm, EncryptionKeyType
+from aws_encryption_sdk.internal.crypto.wrapping_keys import WrappingKey
+
+# not common, so that set_fake_environment can run before the config is loaded
+from .env_vars import CONFIG_ENV_VAR_NAMES, API_ID_ENV_VAR_NAME, STAGE_ENV_VAR_NAME
+from .exceptions import InvalidPayload
+
+def _inject(latency, fault_rate, fault):
+    if latency:
+        time.sleep(latency)
+    if fault_rate and random.random() < fault_rate:
+        raise fault()
+
+class _FakeKmsMasterKey(RawMasterKey):
+    # set by the provider
+    latency = 0
+    fault_rate = 0
+
+    def _generate_data_key(self, *args, **kwargs):
+        _inject(self.latency, self.fault_rate,
+            lambda: aws_encryption_sdk.exceptions.GenerateKeyError('Injected fault'))
+        return super()._generate_data_key(*args, **kwargs)
+
+    def _decrypt_data_key(self, *args, **kwargs):
+        _inject(self.latency, self.fault_rate,
+            lambda: aws_encryption_sdk.exceptions.DecryptKeyError('Injected fault'))
+        try:
+            return super()._decrypt_data_key(*args, **kwargs)
+        except Exception as e:
+            # KMS reports the wrong key as a decryption error, rather than the raw InvalidTag
+            raise aws_encryption_sdk.exceptions.DecryptKeyError(f'Could not decrypt data key: {type(e).__name__}')
+
+class FakeKmsKeyProvider(RawMasterKeyProvider):
+    """Stands in for KMS with a raw AES key. Latency (in seconds) is added,
+    and faults are injected, on each data key generation and decryption,
+    where KMS would be called. Create with get_fake_kms_key_provider."""
+    provider_id = 'fake-kms'
+    _master_key_class = _FakeKmsMasterKey
+
+    # the base class passes constructor arguments to its config, so these are set after
+    key = None
+    latency = 0
+    fault_rate = 0
+
+    def __init__(self, **kwargs):
+        pass
+
+    def _get_raw_key(self, key_id):
+        return WrappingKey(
+            wrapping_algorithm=WrappingAlgorithm.AES_256_GCM_IV12_TAG16_NO_PADDING,
+            wrapping_key=self.key,
+            wrapping_key_type=EncryptionKeyType.SYMMETRIC
+        )
+
+    def _new_master_key(self, key_id):
+        master_key = super()._new_master_key(key_id)
+        master_key.latency = self.latency
+        master_key.fault_rate = self.fault_rate
+        return master_key
+
+def get_fake_kms_key_provider(key=None, latency=0, fault_rate=0):
+    key_provider = FakeKmsKeyProvider()
+    key_provider.key = key or os.urandom(32)
+    key_provider.latency = latency
+    key_provider.fault_rate = fault_rate
+    key_provider.add_master_key(b'fake-kms-key')
+    return key_provider
+
+def set_fake_environment(api_id, stage, region='us-east-1'):
+    """Clear the config from the environment, so the handlers get the defaults,
+    and set a fake region, credentials and API. Call before importing the handlers,
+    since they build their clients at import, and before anything else from this
+    package, since the config is loaded when common is imported (it's loaded again
+    if it already has been)."""
+    for name in CONFIG_ENV_VAR_NAMES:
+        os.environ.pop(name, None)
+    os.environ.update({
+        'AWS_DEFAULT_REGION': region,
+        'AWS_ACCESS_KEY_ID': api_id,
+        'AWS_SECRET_ACCESS_KEY': api_id,
+        API_ID_ENV_VAR_NAME: api_id,
+        STAGE_ENV_VAR_NAME: stage,
+    })
+    common = sys.modules.get(__package__ + '.common')
+    if common:
+        common.reload_config()
+
+def _client_error(code, message, operation_name):
+    return botocore.exceptions.ClientError({
+        'Error': {
+            'Code': code,
+            'Message': message,
+        }
+    }, operation_name)
+
+class FakeStepFunctionsClient:
+    """Stands in for the Step Functions client used by the callback handler.
+    Calls are counted, and recorded in calls if record is true. Injected
+    faults raise ClientError with fault_code."""
+    def __init__(self, latency=0, fault_rate=0, fault_code='ServiceUnavailable', record=True):
+        self.latency = latency
+        self.fault_rate = fault_rate
+        self.fault_code = fault_code
+        self.record = record
+        self.calls = []
+        self.call_count = 0
+        self._lock = threading.Lock()
+
+    def _fault(self, operation_name):
+        return _client_error(self.fault_code, 'Injected fault', operation_name)
+
+    def _record(self, operation_name, params):
+        with self._lock:
+            self.call_count += 1
+            if self.record:
+                self.calls.append((operation_name, params))
+        return {}
+
+    def _call(self, operation_name, params):
+        _inject(self.latency, self.fault_rate, lambda: self._fault(operation_name))
+        return self._record(operation_name, params)
+
+    def send_task_success(self, **kwargs):
+        return self._call('SendTaskSuccess', kwargs)
+
+    def send_task_failure(self, **kwargs):
+        return self._call('SendTaskFailure', kwargs)
+
+    def send_task_heartbeat(self, **kwargs):
+        return self._call('SendTaskHeartbeat', kwargs)
+
+async def _inject_async(latency, fault_rate, fault):
+    if latency:
+        await asyncio.sleep(latency)
+    if fault_rate and random.random() < fault_rate:
+        raise fault()
+
+class FakeAsyncStepFunctionsClient(FakeStepFunctionsClient):
+    """FakeStepFunctionsClient with coroutine methods, like an aiobotocore client"""
+    async def _call_async(self, operation_name, params):
+        await _inject_async(self.latency, self.fault_rate, lambda: self._fault(operation_name))
+        return self._record(operation_name, params)
+
+    async def send_task_success(self, **kwargs):
+        return await self._call_async('SendTaskSuccess', kwargs)
+
+    async def send_task_failure(self, **kwargs):
+        return await self._call_async('SendTaskFailure', kwargs)
+
+    async def send_task_heartbeat(self, **kwargs):
+        return await self._call_async('SendTaskHeartbeat', kwargs)
+
+class FakeAsyncPayloadDecoder:
+    """A payload decoder for the async callback handler, with the latency of
+    KMS awaited before decrypting locally with the fake key provider.
+    Injected faults fail the way a KMS error does."""
+    def __init__(self, key_provider, latency=0, fault_rate=0):
+        self.key_provider = key_provider
+        self.latency = latency
+        self.fault_rate = fault_rate
+        self.decode_count = 0
+
+    async def decode(self, encoded_payload):
+        self.decode_count += 1
+        if self.key_provider:
+            await _inject_async(self.latency, self.fault_rate,
+                lambda: InvalidPayload('Decryption error (DecryptKeyError:Injected fault)'))
+        from .payload import decode_payload
+        return decode_payload(encoded_payload, self.key_provider)
+
+def get_proxy_event(url, method='GET', body=None, headers=None, api_id='fakeapi', stage='fake'):
+    """The API Gateway proxy integration event for a request to the URL.
+    A body that isn't a string is sent as JSON."""
+    parsed_url = urllib.parse.urlsplit(url)
+    query = urllib.parse.parse_qs(parsed_url.query)
+
+    request_headers = {
+        'Host': parsed_url.netloc,
+    }
+    if body is not None and not isinstance(body, str):
+        body = json.dumps(body)
+        request_headers['Content-Type'] = 'application/json'
+    request_headers.update(headers or {})
+
+    return {
+        'resource': '/' + parsed_url.path.rsplit('/', 1)[-1],
+        'path': parsed_url.path,
+        'httpMethod': method,
+        'headers': request_headers,
+        'multiValueHeaders': {k: [v] for k, v in request_headers.items()},
+        'queryStringParameters': {k: v[-1] for k, v in query.items()} or None,
+        'multiValueQueryStringParameters': query or None,
+        'requestContext': {
+            'apiId': api_id,
+            'stage': stage,
+            'httpMethod': method,
+            'identity': {
+                'sourceIp': '192.0.2.1',
+            },
+        },
+        'body': body,
+        'isBase64Encoded': False,
+    }
+
+def get_http_api_event(url, method='GET', body=None, headers=None, api_id='fakeapi', stage='$default'):
+    """The version 2.0 event an HTTP API or function URL sends for a request to the URL.
+    A body that isn't a string is sent as JSON."""
+    parsed_url = urllib.parse.urlsplit(url)
+
+    request_headers = {
+        'host': parsed_url.netloc,
+    }
+    if body is not None and not isinstance(body, str):
+        body = json.dumps(body)
+        request_headers['content-type'] = 'application/json'
+    request_headers.update((k.lower(), v) for k, v in (headers or {}).items())
+
+    event = {
+        'version': '2.0',
+        'routeKey': '$default',
+        'rawPath': parsed_url.path,
+        'rawQueryString': parsed_url.query,
+        'headers': request_headers,
+        'requestContext': {
+            'apiId': api_id,
+            'domainName': parsed_url.netloc,
+            'stage': stage,
+            'http': {
+                'method': method,
+                'path': parsed_url.path,
+                'protocol': 'HTTP/1.1',
+                'sourceIp': '192.0.2.1',
+            },
+        },
+        'isBase64Encoded': False,
+    }
+    # the query and cookies are only present when the request has them
+    query = urllib.parse.parse_qs(parsed_url.query)
+    if query:
+        event['queryStringParameters'] = {k: ','.join(v) for k, v in query.items()}
+    if 'cookie' in request_headers:
+        event['cookies'] = [c.strip() for c in request_headers.pop('cookie').split(';')]
+    if body is not None:
+        event['body'] = body
+    return event
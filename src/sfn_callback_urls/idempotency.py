@@ -0,0 +1,67 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import json
+import hashlib
+
+from .stores import MemoryStore
+
+KEY_PREFIX = 'idempotency:'
+
+def get_idempotency_key(event, base_url):
+    """The key for a create URLs request. Callers can give their own key,
+    otherwise it's a hash of the token and the request itself, so that a
+    retried request gets the same key. Either way the token and the base URL
+    the URLs are made for are part of it, so a key reused for another task,
+    or the same request through another API, never gets those URLs."""
+    if 'idempotency_key' in event:
+        key_material = 'key\n' + event['token'] + '\n' + base_url + '\n' + event['idempotency_key']
+    else:
+        body = json.dumps(event, sort_keys=True, separators=(',', ':'))
+        key_material = 'body\n' + event['token'] + '\n' + base_url + '\n' + body
+    return KEY_PREFIX + hashlib.sha256(key_material.encode()).hexdigest()
+
+class IdempotencyCache:
+    """Remembers create URLs responses for a while, so that a retried request
+    returns the same transaction and URLs rather than minting new ones.
+    Responses are kept in the container, and optionally in a shared store
+    so that retries landing on a different container get them too."""
+    def __init__(self, ttl, shared_store=None, local_store=None):
+        self.ttl = ttl
+        self.local_store = local_store or MemoryStore()
+        self.shared_store = shared_store
+
+    def get(self, key):
+        value = self.local_store.get(key)
+        if value is None and self.shared_store:
+            try:
+                value = self.shared_store.get(key)
+            except Exception as e:
+                # the request can still be processed, it just won't be idempotent
+                print(f'Failed to get idempotent response: {type(e).__name__}: {str(e)}', file=sys.stderr)
+            if value is not None:
+                self.local_store.put(key, value, self.ttl)
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def put(self, key, response):
+        value = json.dumps(response)
+        self.local_store.put(key, value, self.ttl)
+        if self.shared_store:
+            try:
+                self.shared_store.put(key, value, self.ttl)
+            except Exception as e:
+                print(f'Failed to put idempotent response: {type(e).__name__}: {str(e)}', file=sys.stderr)
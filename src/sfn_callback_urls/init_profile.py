@@ -0,0 +1,98 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Profile the cold start of a handler module.
+
+Create an InitProfile before any other imports in the handler module, time
+building clients with it, and call finish() at the end of the module. The
+first log event of the container then gets the profile.
+
+Import times are attributed to top-level packages, excluding time spent
+importing other top-level packages, so boto3 doesn't also count botocore.
+
+If the module fails to initialize, and so never calls finish(), the import
+system removes it from sys.modules, and the next import after that stops
+timing imports.
+"""
+
+import sys
+import time
+import builtins
+import contextlib
+
+class InitProfile:
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.init_time = None
+        self.imports = {}
+        self.clients = {}
+        self.reported = False
+
+        self._nested_times = []
+        # the module being profiled, the one creating this
+        self._module_name = sys._getframe(1).f_globals.get('__name__')
+        self._module = sys.modules.get(self._module_name)
+        self._original_import = builtins.__import__
+        builtins.__import__ = self._import
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if sys.modules.get(self._module_name) is not self._module:
+            self.finish()
+        # relative and already-loaded imports are counted as part of whatever is importing them
+        if level != 0 or name in sys.modules:
+            return self._original_import(name, globals, locals, fromlist, level)
+
+        self._nested_times.append(0)
+        start = time.perf_counter()
+        try:
+            return self._original_import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = self._nested_times.pop()
+            package = name.partition('.')[0]
+            self.imports[package] = self.imports.get(package, 0) + elapsed - nested
+            if self._nested_times:
+                self._nested_times[-1] += elapsed
+
+    @contextlib.contextmanager
+    def time_client(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.clients[name] = self.clients.get(name, 0) + time.perf_counter() - start
+
+    def finish(self):
+        """Stop timing imports, called when the handler module is done initializing"""
+        if builtins.__import__ == self._import:
+            builtins.__import__ = self._original_import
+        if self.init_time is None:
+            self.init_time = time.perf_counter() - self.start_time
+
+    def get_profile(self):
+        return {
+            'imports': dict(sorted(self.imports.items(), key=lambda i: i[1], reverse=True)),
+            'clients': self.clients,
+        }
+
+    def add_to_log_event(self, log_event: dict):
+        """The first log event in the container gets the profile, they all get cold_start"""
+        if self.reported:
+            log_event['cold_start'] = False
+            return log_event
+        self.reported = True
+        log_event['cold_start'] = True
+        log_event['init_time'] = self.init_time
+        log_event['init_profile'] = self.get_profile()
+        return log_event
@@ -0,0 +1,93 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Debug logging for requests, payloads and responses.
+
+Dumping these for every request is too expensive at volume, so they're
+logged at DEBUG level, and a fraction of transactions (LOG_SAMPLE_RATE)
+can be logged at DEBUG regardless of the log level. The decision is made
+by hashing the transaction id, so a sampled transaction is traced through
+URL creation and all of its callbacks. Use LazyJson for arguments so they
+are only serialized when the message is actually emitted.
+"""
+
+import sys
+import json
+import hashlib
+import logging
+import contextvars
+
+from .common import get_log_level, get_log_sample_rate
+
+LOGGER_NAME = 'sfn_callback_urls'
+
+_TRANSACTION_ID = contextvars.ContextVar('transaction_id', default=None)
+
+def set_transaction_id(transaction_id):
+    """Set the transaction the current request is for, or None at the start of a request"""
+    _TRANSACTION_ID.set(transaction_id)
+
+def is_sampled(transaction_id: str, sample_rate: float):
+    """Deterministically decide if a transaction is sampled"""
+    if not transaction_id or sample_rate <= 0:
+        return False
+    if sample_rate >= 1:
+        return True
+    digest = hashlib.sha256(transaction_id.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') / 2**64 < sample_rate
+
+class LazyJson:
+    """Log message argument that isn't serialized unless it's emitted"""
+    __slots__ = ['value']
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return json.dumps(self.value, default=str)
+
+class _SamplingFilter(logging.Filter):
+    def __init__(self, level, sample_rate):
+        super().__init__()
+        self.level = level
+        self.sample_rate = sample_rate
+        self._last_transaction = (None, False)
+
+    def _is_sampled(self, transaction_id):
+        # the same transaction is checked repeatedly during a request
+        if transaction_id != self._last_transaction[0]:
+            self._last_transaction = (transaction_id, is_sampled(transaction_id, self.sample_rate))
+        return self._last_transaction[1]
+
+    def filter(self, record):
+        transaction_id = _TRANSACTION_ID.get()
+        record.transaction_id = transaction_id or '-'
+        return record.levelno >= self.level or self._is_sampled(transaction_id)
+
+def configure_logger(logger, level, sample_rate, stream=None):
+    level = logging.getLevelName(level) if isinstance(level, str) else level
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(logging.Formatter('[%(levelname)s] %(transaction_id)s %(message)s'))
+    handler.addFilter(_SamplingFilter(level, sample_rate))
+    logger.addHandler(handler)
+    # Without sampling, the logger level check drops filtered messages as early as possible.
+    # With sampling, messages below the level need to get as far as the filter.
+    logger.setLevel(logging.DEBUG if sample_rate > 0 else level)
+    # Lambda puts its own handler on the root logger
+    logger.propagate = False
+    return logger
+
+LOGGER = configure_logger(logging.getLogger(LOGGER_NAME), get_log_level(), get_log_sample_rate())
@@ -17,23 +17,72 @@ import sys
 import base64
 import json
 import datetime
+import hmac
+import hashlib
+import secrets
+import re
+import time
+import struct
+import functools
+import itertools
+import multiprocessing
+import concurrent.futures
 
-import aws_encryption_sdk
 import jsonschema
 
-from .common import get_force_disable_parameters
+from .common import get_force_disable_parameters, get_max_payload_length, get_payload_mac_keys, set_payload_mac_keys
 
 from .exceptions import (
     ParametersDisabled,
     InvalidPayload,
+    RejectedPayload,
     ExpiredPayload,
     EncryptionFailed,
     DecryptionUnsupported,
-    EncryptionRequired
+    EncryptionRequired,
+    ShortUrlsUnavailable,
+    PayloadTooLong
 )
 
 from .schemas.payload import payload_schema
 
+# aws_encryption_sdk is slow to import, and isn't needed when encryption is disabled,
+# so it's imported in the functions that use it (only the first import is slow)
+
+@functools.lru_cache(maxsize=None)
+def get_encryption_client():
+    import aws_encryption_sdk
+    return aws_encryption_sdk.EncryptionSDKClient()
+
+DATA_KEY_CACHE_CAPACITY = 10
+DATA_KEY_CACHE_MAX_MESSAGES = 10000
+
+def get_master_key_provider(key_id, botocore_session=None):
+    import aws_encryption_sdk
+    return aws_encryption_sdk.StrictAwsKmsMasterKeyProvider(
+        key_ids = [key_id],
+        botocore_session = botocore_session
+    )
+
+def get_caching_materials_manager(master_key_provider, max_age,
+        max_messages_encrypted=DATA_KEY_CACHE_MAX_MESSAGES):
+    """Wrap the master key provider so that a single data key is reused for
+    many payloads, rather than calling KMS for every one of them"""
+    import aws_encryption_sdk
+    return aws_encryption_sdk.CachingCryptoMaterialsManager(
+        master_key_provider=master_key_provider,
+        cache=aws_encryption_sdk.LocalCryptoMaterialsCache(DATA_KEY_CACHE_CAPACITY),
+        max_age=float(max_age),
+        max_messages_encrypted=max_messages_encrypted
+    )
+
+def _get_key_args(master_key_provider):
+    # encode_payload accepts either a master key provider or a materials manager
+    import aws_encryption_sdk.materials_managers.base
+    if isinstance(master_key_provider, aws_encryption_sdk.materials_managers.base.CryptoMaterialsManager):
+        return {'materials_manager': master_key_provider}
+    return {'key_provider': master_key_provider}
+
 class PayloadBuilder:
     def __init__(self,
             transaction_id,
@@ -77,16 +126,63 @@ class PayloadBuilder:
         
         return payload
 
+# With MAC keys set (PAYLOAD_MAC_KEYS, or PAYLOAD_MAC_KEYS_PARAMETER), encoded payloads end with .KEY_ID.TAG, an HMAC of the rest
+# of the payload, so that forgeries are rejected without a call to KMS
+PAYLOAD_MAC_SEPARATOR = '.'
+PAYLOAD_MAC_TAG_LENGTH = 16
+_PAYLOAD_MAC_KEY_DERIVATION_LABEL = b'sfn-callback-urls payload mac v1'
+# the format id and base64url of the payload, and base64url of the tag
+_PAYLOAD_MAC_INPUT_PATTERN = re.compile(r'^[A-Za-z0-9_=-]+$')
+
+@functools.lru_cache(maxsize=None)
+def _get_payload_mac_key(secret):
+    # derived, so the secret itself is only ever used for this
+    return hmac.new(secret.encode('utf-8'), _PAYLOAD_MAC_KEY_DERIVATION_LABEL, hashlib.sha256).digest()
+
+def _get_payload_mac_tag(key_id, secret, encoded_payload):
+    message = (key_id + PAYLOAD_MAC_SEPARATOR + encoded_payload).encode('ascii')
+    tag = hmac.new(_get_payload_mac_key(secret), message, hashlib.sha256).digest()[:PAYLOAD_MAC_TAG_LENGTH]
+    return str(base64.urlsafe_b64encode(tag), 'ascii').rstrip('=')
+
+def add_payload_mac(encoded_payload, mac_keys=None):
+    """Append the tag for the first of the MAC keys (by default, the configured ones), if there are any"""
+    mac_keys = get_payload_mac_keys() if mac_keys is None else mac_keys
+    if not mac_keys:
+        return encoded_payload
+    key_id, secret = mac_keys[0]
+    return PAYLOAD_MAC_SEPARATOR.join([encoded_payload, key_id, _get_payload_mac_tag(key_id, secret, encoded_payload)])
+
+def verify_payload_mac(payload, mac_keys=None):
+    """Check the payload's tag with the MAC key it names, returning the payload without it.
+    Without MAC keys, any tag is removed without checking it."""
+    mac_keys = get_payload_mac_keys() if mac_keys is None else mac_keys
+    parts = payload.rsplit(PAYLOAD_MAC_SEPARATOR, 2)
+    if not mac_keys:
+        return parts[0] if len(parts) == 3 else payload
+    if len(parts) != 3:
+        raise RejectedPayload('mac', 'Missing authentication tag')
+    encoded_payload, key_id, tag = parts
+    secret = dict(mac_keys).get(key_id)
+    if secret is None:
+        raise RejectedPayload('mac', 'Unknown authentication key')
+    # anything else in a URL would fail to encode for the HMAC
+    if not (_PAYLOAD_MAC_INPUT_PATTERN.match(encoded_payload) and _PAYLOAD_MAC_INPUT_PATTERN.match(tag)):
+        raise RejectedPayload('mac', 'Invalid authentication tag')
+    if not hmac.compare_digest(tag, _get_payload_mac_tag(key_id, secret, encoded_payload)):
+        raise RejectedPayload('mac', 'Invalid authentication tag')
+    return encoded_payload
+
 def encode_payload(payload, master_key_provider):
     payload_string = json.dumps(payload).encode()
     
     if not master_key_provider:
-        return '1-' + str(base64.urlsafe_b64encode(payload_string), 'ascii')
+        return add_payload_mac('1-' + str(base64.urlsafe_b64encode(payload_string), 'ascii'))
     else:
+        import aws_encryption_sdk
         try:
-            ciphertext, encryptor_header = aws_encryption_sdk.encrypt(
+            ciphertext, encryptor_header = get_encryption_client().encrypt(
                 source=payload_string,
-                key_provider=master_key_provider
+                **_get_key_args(master_key_provider)
             )
         except aws_encryption_sdk.exceptions.GenerateKeyError as e:
             # This can happen if the key policy does not allow the sfn-callback-urls IAM role
@@ -96,33 +192,227 @@ def encode_payload(payload, master_key_provider):
             # unexpected, turn into a 500 error
             raise 
 
-        return '2-' + str(base64.urlsafe_b64encode(ciphertext), 'ascii')
+        return add_payload_mac('2-' + str(base64.urlsafe_b64encode(ciphertext), 'ascii'))
+
+def _timed_encode_payload(payload, master_key_provider):
+    start = time.perf_counter()
+    encoded_payload = encode_payload(payload, master_key_provider)
+    return encoded_payload, time.perf_counter() - start
+
+# Set in each worker process of an EncryptionProcessPool
+_WORKER_KEY_PROVIDER = None
+
+def _init_encryption_worker(get_key_provider, args, payload_mac_keys):
+    global _WORKER_KEY_PROVIDER
+    _WORKER_KEY_PROVIDER = get_key_provider(*args)
+    # the keys may have been loaded from a parameter, which a new process doesn't do
+    set_payload_mac_keys(payload_mac_keys)
+
+def _timed_encode_payload_in_worker(payload):
+    return _timed_encode_payload(payload, _WORKER_KEY_PROVIDER)
+
+def get_kms_materials_manager(key_id, region=None, data_key_cache_max_age=None):
+    """The master key provider for the key, with a data key cache if max age is set"""
+    import botocore.session
+    botocore_session = botocore.session.get_session()
+    if region:
+        botocore_session.set_config_variable('region', region)
+    master_key_provider = get_master_key_provider(key_id, botocore_session)
+    if data_key_cache_max_age:
+        return get_caching_materials_manager(master_key_provider, data_key_cache_max_age)
+    return master_key_provider
+
+class EncryptionProcessPool(concurrent.futures.ProcessPoolExecutor):
+    """Worker processes for encrypting payloads, when encryption is limited
+    by CPU rather than by KMS. Key providers can't be sent to other processes,
+    so each worker gets its own from get_key_provider(*args), which must be
+    picklable, like get_kms_materials_manager. Each worker has its own data
+    key cache. Not for Lambda, which doesn't support multiprocessing."""
+    def __init__(self, processes, get_key_provider, *args):
+        # spawned rather than forked, since the server's threads may hold locks
+        super().__init__(max_workers=processes,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_encryption_worker,
+            initargs=(get_key_provider, args, get_payload_mac_keys()))
+
+def encode_payloads(payloads, master_key_provider, executor=None):
+    """encode_payload for each payload, returning (encoded payload, seconds)
+    for each in the same order. With an executor, the payloads are encrypted
+    concurrently: a thread pool encrypts with master_key_provider, an
+    EncryptionProcessPool with its workers' key providers."""
+    if executor is None or not master_key_provider or len(payloads) < 2:
+        return [_timed_encode_payload(payload, master_key_provider) for payload in payloads]
+    if isinstance(executor, EncryptionProcessPool):
+        return list(executor.map(_timed_encode_payload_in_worker, payloads))
+    # the first one alone, so that with a caching materials manager the threads don't
+    # all miss a cold cache at once and each generate their own data key
+    first = _timed_encode_payload(payloads[0], master_key_provider)
+    return [first] + list(executor.map(_timed_encode_payload, payloads[1:], itertools.repeat(master_key_provider)))
+
+@functools.lru_cache(maxsize=None)
+def get_payload_validator():
+    # built on first use rather than per payload, like jsonschema.validate would
+    return jsonschema.validators.validator_for(payload_schema)(payload_schema)
 
 def validate_payload_schema(payload):
-    try:
-        jsonschema.validate(payload, payload_schema)
-    except jsonschema.ValidationError as e:
-        raise InvalidPayload(f'Failed schema validation ({e})')
+    error = jsonschema.exceptions.best_match(get_payload_validator().iter_errors(payload))
+    if error is not None:
+        raise InvalidPayload(f'Failed schema validation ({error})')
 
 def validate_payload_expiration(payload, timestamp=None):
-    timestamp = timestamp or datetime.datetime.now()
+    timestamp = timestamp or datetime.datetime.now(datetime.timezone.utc)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.astimezone() # naive means local time
     if 'exp' in payload:
-        exp = datetime.datetime.fromtimestamp(payload['exp'])
+        exp = datetime.datetime.fromtimestamp(payload['exp'], datetime.timezone.utc)
         if exp < timestamp:
             raise ExpiredPayload(f'Response expired on {exp.isoformat()}')
 
-def decode_payload(payload, master_key_provider):
+# Checked before decrypting, so that a malformed payload is rejected without calling KMS.
+# Payloads are encrypted with a committing algorithm suite, which always uses
+# version 2 of the Encryption SDK message format.
+_BASE64_PATTERN = re.compile(r'^[A-Za-z0-9_-]*={0,2}$')
+_MESSAGE_FORMAT_VERSION = 2
+_COMMITTING_ALGORITHM_IDS = [0x0478, 0x0578]
+_ALGORITHM_SUITE_DATA_LENGTH = 32
+_HEADER_AUTH_TAG_LENGTH = 16
+_NON_FRAMED_CONTENT = 1
+_FRAMED_CONTENT = 2
+_CONTENT_TYPES = [_NON_FRAMED_CONTENT, _FRAMED_CONTENT]
+_IV_LENGTH = 12
+_AUTH_TAG_LENGTH = 16
+_FINAL_FRAME_SEQUENCE_NUMBER_END = 0xFFFFFFFF
+# the suites that sign the message, and so have a footer with the signature
+_SIGNING_ALGORITHM_IDS = [0x0578]
+# the service encrypts with a single key
+MAX_ENCRYPTED_DATA_KEYS = 1
+
+class _HeaderReader:
+    def __init__(self, data, part='header'):
+        self.data = data
+        self.offset = 0
+        self.part = part # the rejection reason
+
+    def read(self, length):
+        if self.offset + length > len(self.data):
+            raise RejectedPayload(self.part, f'Truncated encryption {self.part}')
+        value = self.data[self.offset:self.offset + length]
+        self.offset += length
+        return value
+
+    def read_int(self, fmt):
+        return struct.unpack('>' + fmt, self.read(struct.calcsize(fmt)))[0]
+
+    def read_field(self):
+        """A field with a 2-byte length prefix"""
+        return self.read(self.read_int('H'))
+
+def parse_encryption_header(binary_payload):
+    """Check the structure of the Encryption SDK message (the header, and that the body
+    and footer are complete), without decrypting anything, returning the
+    (provider id, key info) of each encrypted data key"""
+    reader = _HeaderReader(binary_payload)
+    if reader.read_int('B') != _MESSAGE_FORMAT_VERSION:
+        raise RejectedPayload('header', 'Unsupported message format version')
+    algorithm_id = reader.read_int('H')
+    if algorithm_id not in _COMMITTING_ALGORITHM_IDS:
+        raise RejectedPayload('header', 'Unsupported algorithm suite')
+    reader.read(32) # message id
+
+    aad = _HeaderReader(reader.read_field())
+    if aad.data:
+        for _ in range(aad.read_int('H')):
+            aad.read_field()
+            aad.read_field()
+        if aad.offset != len(aad.data):
+            raise RejectedPayload('header', 'Invalid encryption context')
+
+    num_data_keys = reader.read_int('H')
+    if not 1 <= num_data_keys <= MAX_ENCRYPTED_DATA_KEYS:
+        raise RejectedPayload('header', f'Invalid number of encrypted data keys ({num_data_keys})')
+    data_keys = []
+    for _ in range(num_data_keys):
+        provider_id = reader.read_field()
+        key_info = reader.read_field()
+        reader.read_field() # the encrypted data key
+        data_keys.append((provider_id, key_info))
+
+    content_type = reader.read_int('B')
+    if content_type not in _CONTENT_TYPES:
+        raise RejectedPayload('header', 'Invalid content type')
+    frame_length = reader.read_int('I')
+    reader.read(_ALGORITHM_SUITE_DATA_LENGTH)
+    reader.read(_HEADER_AUTH_TAG_LENGTH)
+
+    reader.part = 'body'
+    if content_type == _NON_FRAMED_CONTENT:
+        reader.read(_IV_LENGTH)
+        reader.read(reader.read_int('Q'))
+        reader.read(_AUTH_TAG_LENGTH)
+    else:
+        # regular frames, up to the final frame, which has the length of its content
+        while reader.read_int('I') != _FINAL_FRAME_SEQUENCE_NUMBER_END:
+            reader.read(_IV_LENGTH + frame_length + _AUTH_TAG_LENGTH)
+        reader.read_int('I') # sequence number
+        reader.read(_IV_LENGTH)
+        reader.read(reader.read_int('I'))
+        reader.read(_AUTH_TAG_LENGTH)
+
+    reader.part = 'footer'
+    if algorithm_id in _SIGNING_ALGORITHM_IDS:
+        reader.read_field() # signature
+    if reader.offset != len(binary_payload):
+        raise RejectedPayload('footer', 'Unexpected data after the encrypted message')
+    return data_keys
+
+def _is_key(key_id, key_info):
+    """If the key info in the message header is for key_id (a key id or ARN). KMS puts
+    the key ARN in the header, so aliases can't be checked without calling KMS."""
+    try:
+        key_arn = key_info.decode('utf-8')
+    except UnicodeDecodeError:
+        return False
+    return key_arn == key_id or key_arn.endswith(':key/' + key_id)
+
+def check_encryption_key(data_keys, key_id):
+    """Reject the payload if none of its data keys were encrypted with key_id"""
+    if not key_id or 'alias/' in key_id:
+        return
+    if not any(_is_key(key_id, key_info) for _, key_info in data_keys):
+        raise RejectedPayload('key_id', 'Encrypted with a different key')
+
+def check_url_payload_length(action_name, encoded_payload):
+    """Refuse to give out a URL with a payload that callbacks would reject as too long"""
+    if len(encoded_payload) > get_max_payload_length():
+        raise PayloadTooLong(f'The payload for action {action_name} is {len(encoded_payload)} characters, '
+            f'more than the {get_max_payload_length()} allowed in a callback URL; use short_urls')
+
+def check_payload_length(payload):
+    """Reject a payload from a callback URL that's longer than any URL that's given out,
+    before it's resolved or decoded. Only the URL is checked; stored payloads can be longer."""
+    if len(payload) > get_max_payload_length():
+        raise RejectedPayload('length', 'Payload is too long')
+
+def decode_payload(payload, master_key_provider, key_id=None):
+    """Decode (and decrypt) the payload from a callback URL, or from the store for short URLs.
+    Payloads that don't have a valid tag when there are MAC keys, that aren't base64, or
+    (if encrypted) that don't have a valid header or weren't encrypted with key_id,
+    are rejected without a call to KMS."""
     assert isinstance(payload, str)
+    payload = verify_payload_mac(payload)
+
     parts = payload.split('-', 1)
     if len(parts) != 2:
-        raise InvalidPayload('Missing format id')
+        raise RejectedPayload('format', 'Missing format id')
     
     version, base64_payload = parts
+    if version not in ['1', '2']:
+        raise RejectedPayload('format', 'Unknown format id')
 
-    try:
-        binary_payload = base64.urlsafe_b64decode(base64_payload)
-    except base64.binascii.Error as e:
-        raise InvalidPayload(f'Base64 error ({str(e)})')
+    # urlsafe_b64decode would skip over characters that aren't in the alphabet
+    if not _BASE64_PATTERN.match(base64_payload) or len(base64_payload) % 4:
+        raise RejectedPayload('base64', 'Base64 error (invalid characters or length)')
+    binary_payload = base64.urlsafe_b64decode(base64_payload)
 
     if version == '1':
         # sfn-callback-urls to make an authenticated call on behalf of an
@@ -139,10 +429,12 @@ def decode_payload(payload, master_key_provider):
     elif version == '2':
         if not master_key_provider:
             raise DecryptionUnsupported('No key found')
+        check_encryption_key(parse_encryption_header(binary_payload), key_id)
+        import aws_encryption_sdk
         try:
-            decrypted_payload, decrypted_header = aws_encryption_sdk.decrypt(
+            decrypted_payload, decrypted_header = get_encryption_client().decrypt(
                 source=binary_payload,
-                key_provider=master_key_provider
+                **_get_key_args(master_key_provider)
             )
         except aws_encryption_sdk.exceptions.AWSEncryptionSDKClientError as e:
             raise InvalidPayload(f'Decryption error ({type(e).__name__}:{str(e)})')
@@ -151,7 +443,44 @@ def decode_payload(payload, master_key_provider):
             loaded_payload = json.loads(decrypted_payload)
         except json.JSONDecodeError as e:
             raise InvalidPayload(f'JSON error ({str(e)})')
-    else:
-        raise InvalidPayload('Unknown format id')
 
     return loaded_payload
+
+# Stored payloads are kept in a payload store, and the URL only has their id
+STORED_PAYLOAD_VERSION = '3'
+STORED_PAYLOAD_ID_BYTES = 16
+STORED_PAYLOAD_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+# Step Functions executions (and therefore tokens) last at most a year
+STORED_PAYLOAD_MAX_TTL = 366 * 24 * 60 * 60
+
+def store_payload(encoded_payload, store, expiration=None, timestamp=None):
+    """Put an encoded payload in the store, returning a short payload that refers to it"""
+    if store is None:
+        raise ShortUrlsUnavailable('No payload store is configured')
+
+    ttl = STORED_PAYLOAD_MAX_TTL
+    if expiration:
+        timestamp = timestamp or datetime.datetime.now(datetime.timezone.utc)
+        # compare as unix timestamps, in case only one of them is naive
+        ttl = min(ttl, max(1, int(expiration.timestamp() - timestamp.timestamp()) + 1))
+
+    payload_id = secrets.token_urlsafe(STORED_PAYLOAD_ID_BYTES)
+    store.put('payload:' + payload_id, encoded_payload, ttl)
+
+    return STORED_PAYLOAD_VERSION + '-' + payload_id
+
+def resolve_payload(payload, store):
+    """If the payload refers to a stored payload, get it from the store"""
+    if not payload.startswith(STORED_PAYLOAD_VERSION + '-'):
+        return payload
+    if store is None:
+        raise InvalidPayload('Stored payloads are not supported')
+
+    payload_id = payload[len(STORED_PAYLOAD_VERSION) + 1:]
+    if not STORED_PAYLOAD_ID_PATTERN.match(payload_id):
+        raise InvalidPayload('Invalid payload id')
+
+    stored_payload = store.get('payload:' + payload_id)
+    if stored_payload is None:
+        raise InvalidPayload('Unknown payload id')
+    return stored_payload
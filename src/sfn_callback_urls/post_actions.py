@@ -1,10 +1,13 @@
 import json
+import binascii
+import functools
 
 import jsonschema
 import jsonschema.validators
-import jsonpath_rw
 
-from .common import get_header, get_disable_post_actions, is_verbose
+from .common import get_header, get_disable_post_actions
+from .events import get_method, get_body
+from .log import LOGGER, LazyJson
 from .callbacks import prepare_method_params
 
 from .exceptions import (
@@ -15,14 +18,45 @@ from .exceptions import (
     ReturnHttpResponse
 )
 
-def validate_post_action(action):
+# Parsing JSONPaths and checking schemas is slow, and the same outcomes are
+# typically seen over and over, so both are cached.
+JSON_PATH_CACHE_SIZE = 256
+OUTCOME_VALIDATOR_CACHE_SIZE = 256
+
+@functools.lru_cache(maxsize=JSON_PATH_CACHE_SIZE)
+def _parse_json_path(path):
+    # only imported when a post action is processed, it's not needed if they're disabled
+    import jsonpath_rw
+    return jsonpath_rw.parse(path)
+
+def prepare_json_path_parser():
+    """jsonpath_rw builds its parser the first time a path is parsed, which is slow"""
+    _parse_json_path('$')
+
+@functools.lru_cache(maxsize=OUTCOME_VALIDATOR_CACHE_SIZE)
+def _get_outcome_validator(schema_json):
+    schema = json.loads(schema_json)
+    validator_class = jsonschema.validators.validator_for(schema)
+    validator_class.check_schema(schema)
+    return validator_class(schema)
+
+def get_outcome_validator(schema):
+    return _get_outcome_validator(json.dumps(schema, sort_keys=True))
+
+def validate_post_action(action, validate_outcomes=True):
+    """Check a post action at URL creation time. Actions that have already
+    been validated, like those from action templates, can skip re-validating
+    their outcomes."""
     if get_disable_post_actions():
         raise PostActionsDisabled('Post actions are disabled')
+    if validate_outcomes:
+        validate_post_action_outcomes(action)
+
+def validate_post_action_outcomes(action):
     for outcome in action['outcomes']:
         schema = outcome['schema']
         try:
-            v = jsonschema.validators.validator_for(schema)
-            v.check_schema(schema)
+            get_outcome_validator(schema)
         except jsonschema.exceptions.SchemaError as e:
             raise InvalidPostActionOutcome(f'Bad schema: {str(e)}')
         except Exception as e:
@@ -31,15 +65,16 @@ def validate_post_action(action):
         for key in ['output_path', 'error_path', 'cause_path']:
             if key in outcome:
                 try:
-                    jsonpath_rw.parse(outcome[key])
+                    _parse_json_path(outcome[key])
                 except Exception as e:
                     raise InvalidJsonPath(f'Invalid JSONPath: {str(e)}')
 
 def load_post_action_body(request, log_event={}):
-    if request['httpMethod'] != 'POST':
+    method = get_method(request)
+    if method != 'POST':
         raise ReturnHttpResponse(
             'PostActionNotPosted',
-            f'HTTP method was {request["httpMethod"]}',
+            f'HTTP method was {method}',
             405,
             headers={
                 'Allow': 'POST'
@@ -49,8 +84,9 @@ def load_post_action_body(request, log_event={}):
     content_type = get_header(request, 'content-type')
     if content_type and content_type.split(';')[0].strip() == 'application/json':
         try:
-            return json.loads(request['body'])
-        except json.JSONDecodeError as e:
+            return json.loads(get_body(request))
+        # a base64 body may not decode, or not be UTF-8
+        except (json.JSONDecodeError, binascii.Error, UnicodeDecodeError) as e:
             raise ReturnHttpResponse(
                 'InvalidPostActionBody',
                 str(e),
@@ -79,10 +115,8 @@ def _process_post_action(action, body, parameters, log_event={}):
     log_event['post_outcomes_num'] = len(outcomes)
 
     for outcome_index, outcome in enumerate(outcomes):
-        outcome_body_schema = outcome['schema']
-        try:
-            jsonschema.validate(body, outcome_body_schema)
-        except jsonschema.ValidationError as e:
+        outcome_body_validator = get_outcome_validator(outcome['schema'])
+        if not outcome_body_validator.is_valid(body):
             continue
 
         outcome_name = outcome['name']
@@ -101,7 +135,7 @@ def _process_post_action(action, body, parameters, log_event={}):
                 outcome['output'] = None
             else:
                 try:
-                    path = jsonpath_rw.parse(outcome['output_path'])
+                    path = _parse_json_path(outcome['output_path'])
                 except Exception as e:
                     raise InvalidJsonPath(f'Invalid JSONPath: {str(e)}')
 
@@ -113,7 +147,7 @@ def _process_post_action(action, body, parameters, log_event={}):
             path_key = f'{key}_path'
             if path_key in outcome:
                 try:
-                    path = jsonpath_rw.parse(outcome[path_key])
+                    path = _parse_json_path(outcome[path_key])
                 except Exception as e:
                     raise InvalidJsonPath(f'Invalid JSONPath: {str(e)}')
                 value = [v.value for v in path.find(body)]
@@ -143,7 +177,6 @@ def process_post_action(action, request, parameters, log_event={}):
 
     body = load_post_action_body(request, log_event)
 
-    if is_verbose():
-        print(f'Post body: {json.dumps(body)}')
+    LOGGER.debug('Post body: %s', LazyJson(body))
 
     return _process_post_action(action, body, parameters, log_event=log_event)
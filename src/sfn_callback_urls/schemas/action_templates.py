@@ -0,0 +1,81 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from .action import action_schema, name_pattern
+
+skeleton = lambda: [
+    {
+        "name": "<template name>",
+        "version": "<template version>",
+        "actions": [
+            {
+                "name": "<action name 1>",
+                "type": "success",
+                "output": {
+                    "<user>": "<defined>"
+                }
+            },
+            {
+                "name": "<action name 2>",
+                "type": "failure",
+                "error": "MyErrorCode"
+            }
+        ]
+    }
+]
+
+template_version_schema = {
+    "type": ["string", "integer"]
+}
+
+action_templates_schema = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "name": {
+                "type": "string",
+                "pattern": name_pattern
+            },
+            "version": template_version_schema,
+            "actions": {
+                "type": "array",
+                "items": action_schema,
+                "minItems": 1,
+            }
+        },
+        "required": ["name", "version", "actions"],
+        "additionalProperties": False
+    }
+}
+
+# How a create URLs request refers to a template
+action_template_reference_schema = {
+    "type": "object",
+    "properties": {
+        "name": {
+            "type": "string"
+        },
+        "version": template_version_schema,
+        "overrides": {
+            # action name -> fields to replace in that action
+            "type": "object",
+            "additionalProperties": {
+                "type": "object"
+            }
+        }
+    },
+    "required": ["name", "version"],
+    "additionalProperties": False
+}
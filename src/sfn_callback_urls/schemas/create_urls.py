@@ -13,6 +13,7 @@
 # limitations under the License.
 
 from .action import action_schema
+from .action_templates import action_template_reference_schema
 
 skeleton = lambda: {
     "token": "<from Step Functions>",
@@ -59,6 +60,7 @@ create_urls_input_schema = {
             "items": action_schema,
             "minItems": 1,
         },
+        "template": action_template_reference_schema,
         "expiration": {
             "type": "string",
             "format": "date-time"
@@ -66,6 +68,14 @@ create_urls_input_schema = {
         "enable_output_parameters": {
             "type": "boolean"
         },
+        "short_urls": {
+            "type": "boolean"
+        },
+        "idempotency_key": {
+            "type": "string",
+            "minLength": 1,
+            "maxLength": 256
+        },
         "base_url": {
             "oneOf": [
                 {
@@ -90,6 +100,10 @@ create_urls_input_schema = {
             ]
         }
     },
-    "required": ["token", "actions"],
+    "required": ["token"],
+    "anyOf": [
+        {"required": ["actions"]},
+        {"required": ["template"]}
+    ],
     "additionalProperties": False
 }
@@ -0,0 +1,240 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Simple key-value stores with expiration, for state that outlives a request.
+
+Stores hold string values and implement get(key) and put(key, value, ttl=None),
+and get_with_expiration(key), which returns (value, expires) or None, where
+expires is the time.time() the value expires at, or None if it doesn't.
+They also implement increment(key, ttl=None), which atomically adds one to a
+counter and returns it; counters are separate from values, and are only
+read through increment. They are created from a spec string with get_store:
+    memory[:<capacity>]       in this container only
+    sqlite:<path>             shared between processes on one machine
+    dynamodb:<table name>     shared between containers
+"""
+
+import time
+import threading
+import sqlite3
+from collections import OrderedDict
+
+DEFAULT_MEMORY_STORE_CAPACITY = 1024
+
+class MemoryStore:
+    """An in-container store that evicts the least-recently used
+    items when it is full"""
+    def __init__(self, capacity=DEFAULT_MEMORY_STORE_CAPACITY):
+        self.capacity = capacity
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        item = self.get_with_expiration(key)
+        return item[0] if item else None
+
+    def get_with_expiration(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            value, expires = self._items[key]
+            if expires is not None and expires <= time.time():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value, expires
+
+    def put(self, key, value, ttl=None):
+        self.put_until(key, value, time.time() + ttl if ttl else None)
+
+    def put_until(self, key, value, expires):
+        """Put a value that expires at a time.time(), or never if it's None"""
+        with self._lock:
+            self._items[key] = (value, expires)
+            self._items.move_to_end(key)
+            while len(self._items) > self.capacity:
+                self._items.popitem(last=False)
+
+    def increment(self, key, ttl=None):
+        with self._lock:
+            count, expires = self._items.get(key, (0, None))
+            if expires is not None and expires <= time.time():
+                count, expires = 0, None
+            if expires is None and ttl:
+                expires = time.time() + ttl
+            self._items[key] = (count + 1, expires)
+            self._items.move_to_end(key)
+            while len(self._items) > self.capacity:
+                self._items.popitem(last=False)
+            return count + 1
+
+class SQLiteStore:
+    """A store in a SQLite database file"""
+    def __init__(self, path):
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS store (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL)')
+
+    def get(self, key):
+        item = self.get_with_expiration(key)
+        return item[0] if item else None
+
+    def get_with_expiration(self, key):
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT value, expires FROM store WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires = row
+        if expires is not None and expires <= time.time():
+            return None
+        return value, expires
+
+    def put(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO store (key, value, expires) VALUES (?, ?, ?)', (key, value, expires))
+
+    def increment(self, key, ttl=None):
+        now = time.time()
+        with self._lock:
+            # an immediate transaction locks the database against other processes between the read and the write
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._connection.execute(
+                    'SELECT value, expires FROM store WHERE key = ?', (key,)).fetchone()
+                count, expires = 0, None
+                if row is not None and (row[1] is None or row[1] > now):
+                    count, expires = int(row[0]), row[1]
+                if expires is None and ttl:
+                    expires = now + ttl
+                self._connection.execute(
+                    'INSERT OR REPLACE INTO store (key, value, expires) VALUES (?, ?, ?)', (key, str(count + 1), expires))
+                self._connection.execute('COMMIT')
+            except Exception:
+                self._connection.execute('ROLLBACK')
+                raise
+        return count + 1
+
+class DynamoDBStore:
+    """A store in a DynamoDB table with a string partition key named "key".
+    Expiration is stored in the "ttl" attribute, which should be set as the
+    table's TTL attribute, but is also checked on read since DynamoDB deletes
+    expired items lazily. Counters are in the "count" attribute; they aren't
+    reset when they expire, only when DynamoDB deletes them, so a counter
+    should be used for no longer than its ttl."""
+    def __init__(self, table_name, client=None, session=None):
+        if client is None:
+            import boto3
+            client = (session or boto3.Session()).client('dynamodb')
+        self.table_name = table_name
+        self.client = client
+
+    def get(self, key):
+        item = self.get_with_expiration(key)
+        return item[0] if item else None
+
+    def get_with_expiration(self, key):
+        response = self.client.get_item(
+            TableName=self.table_name,
+            Key={'key': {'S': key}},
+            ConsistentRead=True
+        )
+        item = response.get('Item')
+        if not item:
+            return None
+        expires = int(item['ttl']['N']) if 'ttl' in item else None
+        if expires is not None and expires <= time.time():
+            return None
+        return item['value']['S'], expires
+
+    def put(self, key, value, ttl=None):
+        item = {
+            'key': {'S': key},
+            'value': {'S': value},
+        }
+        if ttl:
+            item['ttl'] = {'N': str(int(time.time() + ttl))}
+        self.client.put_item(
+            TableName=self.table_name,
+            Item=item
+        )
+
+    def increment(self, key, ttl=None):
+        update_expression = 'ADD #count :one'
+        names = {'#count': 'count'}
+        values = {':one': {'N': '1'}}
+        if ttl:
+            update_expression += ' SET #ttl = if_not_exists(#ttl, :ttl)'
+            names['#ttl'] = 'ttl'
+            values[':ttl'] = {'N': str(int(time.time() + ttl))}
+        response = self.client.update_item(
+            TableName=self.table_name,
+            Key={'key': {'S': key}},
+            UpdateExpression=update_expression,
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+            ReturnValues='UPDATED_NEW'
+        )
+        return int(response['Attributes']['count']['N'])
+
+class CachingStore:
+    """A read-through cache in front of another store, for values that don't
+    change once they are written. Values are cached until they expire in the
+    other store."""
+    def __init__(self, store, capacity=DEFAULT_MEMORY_STORE_CAPACITY):
+        self.store = store
+        self.cache = MemoryStore(capacity)
+
+    def get(self, key):
+        item = self.get_with_expiration(key)
+        return item[0] if item else None
+
+    def get_with_expiration(self, key):
+        item = self.cache.get_with_expiration(key)
+        if item is None:
+            item = self.store.get_with_expiration(key)
+            if item is not None:
+                self.cache.put_until(key, *item)
+        return item
+
+    def put(self, key, value, ttl=None):
+        self.store.put(key, value, ttl)
+        self.cache.put(key, value, ttl)
+
+    def increment(self, key, ttl=None):
+        # counters change, so they aren't cached
+        return self.store.increment(key, ttl)
+
+def get_store(spec, session=None):
+    """Create a store from a spec string like memory:1000 or dynamodb:MyTable"""
+    kind, _, arg = spec.partition(':')
+    if kind == 'memory':
+        return MemoryStore(int(arg) if arg else DEFAULT_MEMORY_STORE_CAPACITY)
+    elif kind == 'sqlite':
+        if not arg:
+            raise ValueError(f'Missing path in store {spec}')
+        return SQLiteStore(arg)
+    elif kind == 'dynamodb':
+        if not arg:
+            raise ValueError(f'Missing table name in store {spec}')
+        return DynamoDBStore(arg, session=session)
+    raise ValueError(f'Unknown store type in {spec}')
@@ -0,0 +1,144 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import json
+
+from sfn_callback_urls.action_templates import (
+    ActionTemplates,
+    load_action_templates
+)
+from sfn_callback_urls.common import override_config
+from sfn_callback_urls.exceptions import (
+    InvalidAction,
+    InvalidActionTemplates,
+    UnknownActionTemplate
+)
+
+def get_templates():
+    return [
+        {
+            'name': 'approval',
+            'version': 1,
+            'actions': [
+                {
+                    'name': 'approve',
+                    'type': 'success',
+                    'output': {'approved': True}
+                },
+                {
+                    'name': 'reject',
+                    'type': 'failure',
+                    'error': 'Rejected'
+                }
+            ]
+        },
+        {
+            'name': 'approval',
+            'version': '2',
+            'actions': [
+                {
+                    'name': 'respond',
+                    'type': 'post',
+                    'outcomes': [
+                        {
+                            'name': 'approve',
+                            'type': 'success',
+                            'schema': {'type': 'object'},
+                            'output_path': '$.comment'
+                        }
+                    ]
+                }
+            ]
+        }
+    ]
+
+def test_get_actions():
+    templates = ActionTemplates(get_templates())
+    assert len(templates) == 2
+
+    actions = templates.get_actions({'name': 'approval', 'version': '1'})
+    assert [a['name'] for a in actions] == ['approve', 'reject']
+
+    actions = templates.get_actions({'name': 'approval', 'version': 2})
+    assert [a['name'] for a in actions] == ['respond']
+
+    with pytest.raises(UnknownActionTemplate):
+        templates.get_actions({'name': 'approval', 'version': 3})
+
+    with pytest.raises(UnknownActionTemplate):
+        templates.get_actions({'name': 'foo', 'version': 1})
+
+def test_overrides():
+    templates = ActionTemplates(get_templates())
+
+    actions = templates.get_actions({
+        'name': 'approval',
+        'version': 1,
+        'overrides': {
+            'approve': {'output': {'approved': 'yes'}, 'name': 'ignored'}
+        }
+    })
+    assert actions[0] == {'name': 'approve', 'type': 'success', 'output': {'approved': 'yes'}}
+    assert get_templates()[0]['actions'][1] == actions[1]
+
+    # the template itself is unchanged
+    actions = templates.get_actions({'name': 'approval', 'version': 1})
+    assert actions[0]['output'] == {'approved': True}
+
+    with pytest.raises(InvalidAction):
+        templates.get_actions({
+            'name': 'approval',
+            'version': 1,
+            'overrides': {'foo': {}}
+        })
+
+    with pytest.raises(InvalidAction):
+        templates.get_actions({
+            'name': 'approval',
+            'version': 1,
+            'overrides': {'reject': {'error': {}}}
+        })
+
+def test_invalid_templates():
+    templates = get_templates()
+    templates.append(templates[0])
+    with pytest.raises(InvalidActionTemplates):
+        ActionTemplates(templates)
+
+    templates = get_templates()
+    del templates[0]['actions'][0]['output']
+    with pytest.raises(InvalidActionTemplates):
+        ActionTemplates(templates)
+
+    templates = get_templates()
+    templates[1]['actions'][0]['outcomes'][0]['output_path'] = '$.['
+    with pytest.raises(InvalidActionTemplates):
+        ActionTemplates(templates)
+
+def test_load_action_templates(tmp_path):
+    with override_config(action_templates=None, action_templates_file=None):
+        assert len(load_action_templates()) == 0
+
+    with override_config(action_templates=json.dumps(get_templates())):
+        assert len(load_action_templates()) == 2
+
+    path = tmp_path / 'templates.json'
+    path.write_text(json.dumps(get_templates()[:1]))
+    with override_config(action_templates=None, action_templates_file=str(path)):
+        assert len(load_action_templates()) == 1
+
+    with override_config(action_templates='['):
+        with pytest.raises(InvalidActionTemplates):
+            load_action_templates()
@@ -0,0 +1,129 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+import json
+
+from sfn_callback_urls.admission import (
+    TokenBuckets,
+    SharedCounters,
+    AdmissionControl
+)
+from sfn_callback_urls.stores import MemoryStore
+from sfn_callback_urls.exceptions import TooManyRequests
+from sfn_callback_urls.fakes import get_proxy_event
+
+class Clock:
+    def __init__(self, now=1000):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+class FailingStore:
+    def increment(self, key, ttl=None):
+        raise ConnectionError('no store')
+
+def test_token_buckets():
+    clock = Clock()
+    buckets = TokenBuckets(2, 10, max_keys=2, clock=clock)
+    assert buckets.take('a') == 0
+    assert buckets.take('a') == 0
+    assert buckets.take('a') == pytest.approx(5)
+    assert buckets.take('b') == 0
+
+    clock.now += 5
+    assert buckets.take('a') == 0
+    assert buckets.take('a') == pytest.approx(5)
+
+    # a full bucket doesn't overflow
+    clock.now += 100
+    assert buckets.take('b') == 0
+    assert buckets.take('b') == 0
+    assert buckets.take('b') > 0
+
+    # c drops the least recently used bucket, so a starts full again
+    buckets.take('c')
+    assert len(buckets) == 2
+    assert buckets.take('a') == 0
+    assert buckets.take('a') == 0
+
+def test_shared_counters():
+    clock = Clock(1005)
+    store = MemoryStore()
+    counters = SharedCounters(store, 2, 10, clock=clock)
+    assert counters.take('a') == 0
+    # another container with the same store
+    assert SharedCounters(store, 2, 10, clock=clock).take('a') == 0
+    assert counters.take('a') == pytest.approx(5)
+
+    clock.now = 1010
+    assert counters.take('a') == 0
+
+    # the store failing doesn't fail the request
+    assert SharedCounters(FailingStore(), 1, 10).take('a') == 0
+
+def test_admission_control_source():
+    admission_control = AdmissionControl(source_limit=(1, 60))
+    request = get_proxy_event('https://example.com/respond')
+    log_event = {}
+    admission_control.check_source(request, log_event)
+    with pytest.raises(TooManyRequests) as exc_info:
+        admission_control.check_source(request, log_event)
+    assert log_event['throttled'] == 1
+    assert log_event['throttled_by'] == 'source_ip'
+
+    response = exc_info.value.get_response()
+    assert response['statusCode'] == 429
+    assert response['headers']['Retry-After'] == '60'
+    assert json.loads(response['body'])['error'] == 'TooManyRequests'
+
+    request['requestContext']['identity']['sourceIp'] = '192.0.2.2'
+    admission_control.check_source(request)
+
+    # no limit on transactions
+    assert admission_control.check_payload('2-abc') is None
+
+def test_admission_control_transaction():
+    admission_control = AdmissionControl(transaction_limit=(2, 60))
+    # unknown payloads are counted after they're decoded
+    assert admission_control.check_payload('2-abc') is None
+    admission_control.check_transaction('2-abc', 'tid')
+    assert admission_control.check_payload('2-def') is None
+    admission_control.check_transaction('2-def', 'tid')
+
+    # the payload is known now, and its transaction is over the limit before decoding
+    with pytest.raises(TooManyRequests):
+        admission_control.check_payload('2-abc')
+
+    # as is a new payload for it, after decoding
+    with pytest.raises(TooManyRequests):
+        admission_control.check_transaction('2-ghi', 'tid')
+    with pytest.raises(TooManyRequests):
+        admission_control.check_payload('2-ghi')
+
+    assert admission_control.check_payload('2-jkl') is None
+    admission_control.check_transaction('2-jkl', 'tid2')
+    assert admission_control.check_payload('2-jkl') == 'tid2'
+    # already counted
+    admission_control.check_transaction('2-jkl', 'tid2', 'tid2')
+
+def test_admission_control_shared_store():
+    store = MemoryStore()
+    request = get_proxy_event('https://example.com/respond')
+    AdmissionControl(source_limit=(1, 60), shared_store=store).check_source(request)
+    # a new container has a full bucket, but the shared count is over
+    with pytest.raises(TooManyRequests):
+        AdmissionControl(source_limit=(1, 60), shared_store=store).check_source(request)
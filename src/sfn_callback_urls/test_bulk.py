@@ -0,0 +1,99 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import io
+import json
+import urllib.parse
+
+from sfn_callback_urls.bulk import main
+from sfn_callback_urls.payload import decode_payload
+
+BASE_URL = 'https://example.com/v1'
+
+def get_input(num_requests):
+    lines = []
+    for i in range(num_requests):
+        lines.append(json.dumps({
+            'token': f'token{i}',
+            'actions': [
+                {
+                    'name': 'approve',
+                    'type': 'success',
+                    'output': {'index': i}
+                },
+                {
+                    'name': 'reject',
+                    'type': 'failure'
+                }
+            ]
+        }))
+    return '\n'.join(lines) + '\n'
+
+def run(input_text, *args):
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    exit_code = main(['--base-url', BASE_URL, '--no-encryption'] + list(args),
+        stdin=io.StringIO(input_text),
+        stdout=stdout,
+        stderr=stderr)
+    results = [json.loads(line) for line in stdout.getvalue().splitlines()]
+    return exit_code, results, stderr.getvalue()
+
+def get_payload(url):
+    query = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(url).query))
+    return decode_payload(query['data'], None)
+
+@pytest.mark.parametrize('workers', ['0', '2'])
+def test_bulk(workers):
+    num_requests = 25
+    exit_code, results, stats = run(get_input(num_requests), '--workers', workers, '--chunk-size', '4')
+
+    assert exit_code == 0
+    assert len(results) == num_requests
+    assert 'Done: 25 requests (0 errors)' in stats
+
+    for i, result in enumerate(results):
+        assert result['line'] == i + 1
+        assert list(result['urls']) == ['approve', 'reject']
+        assert result['urls']['approve'].startswith(BASE_URL + '/respond?')
+
+        payload = get_payload(result['urls']['approve'])
+        assert payload['token'] == f'token{i}'
+        assert payload['tid'] == result['transaction_id']
+        assert payload['action']['output'] == {'index': i}
+
+def test_bulk_errors():
+    input_text = get_input(1) + '\n{"foo"\n' + json.dumps({'token': 'foo', 'actions': []}) + '\n'
+    exit_code, results, stats = run(input_text, '--workers', '0')
+
+    assert exit_code == 1
+    assert [r['line'] for r in results] == [1, 3, 4]
+    assert 'urls' in results[0]
+    assert results[1]['error'] == 'InvalidJSON'
+    assert results[2]['error'] == 'InvalidJSON'
+
+def test_bulk_payload_too_long():
+    input_text = json.dumps({'token': 'foo', 'actions': [{'name': 'approve', 'type': 'success',
+        'output': {'data': 'x' * 20000}}]}) + '\n'
+    exit_code, results, stats = run(input_text, '--workers', '0')
+    assert exit_code == 1
+    assert results[0]['error'] == 'PayloadTooLong'
+
+def test_bulk_base_url():
+    input_text = json.dumps({'token': 'foo', 'base_url': 'https://other.example.com',
+        'actions': [{'name': 'approve', 'type': 'success', 'output': {}}]}) + '\n'
+    exit_code, results, stats = run(input_text, '--workers', '0')
+    assert exit_code == 0
+    assert results[0]['urls']['approve'].startswith('https://other.example.com/respond?')
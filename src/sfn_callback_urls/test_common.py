@@ -14,46 +14,179 @@
 
 import pytest
 
+import datetime
+
 import sfn_callback_urls.common
+from sfn_callback_urls.exceptions import InvalidConfig
+
+def test_load_config():
+    config = sfn_callback_urls.common.load_config({})
+    assert not config.force_disable_parameters
+    assert not config.disable_post_actions
+    assert config.key_id is None
+    assert config.data_key_cache_max_age == sfn_callback_urls.common.DEFAULT_DATA_KEY_CACHE_MAX_AGE
+    assert config.log_level == 'INFO'
+    assert config.log_sample_rate == 0
+    assert config.base_url is None
+    assert config.server_workers == sfn_callback_urls.common.DEFAULT_SERVER_WORKERS
+    assert not config.server_create_urls
+    assert config.encryption_threads == 1
+    assert config.encryption_processes == 0
+    assert config.max_payload_length == sfn_callback_urls.common.DEFAULT_MAX_PAYLOAD_LENGTH
+    assert config.payload_mac_keys == ()
+    assert config.payload_mac_keys_parameter is None
+    assert config.source_rate_limit is None
+    assert config.transaction_rate_limit is None
+
+    config = sfn_callback_urls.common.load_config({
+        'KEY_ID': 'alias/foo',
+        'IDEMPOTENCY_TTL': '0',
+        'LOG_LEVEL': 'debug',
+        'LOG_SAMPLE_RATE': '0.5',
+        'PAYLOAD_STORE': 'memory',
+        'BASE_URL': 'https://callbacks.example.com',
+        'SERVER_WORKERS': '32',
+        'ENCRYPTION_THREADS': '1',
+        'ENCRYPTION_PROCESSES': '2',
+        'PAYLOAD_MAC_KEYS': 'k2:0123456789abcdef0123, k1:fedcba9876543210fedc',
+        'PAYLOAD_MAC_KEYS_PARAMETER': '/callbacks/mac-keys',
+        'CALLBACK_SOURCE_RATE_LIMIT': '60/60',
+        'CALLBACK_TRANSACTION_RATE_LIMIT': '10 / 0.5',
+        'RATE_LIMIT_STORE': 'dynamodb:table',
+    })
+    assert config.key_id == 'alias/foo'
+    assert config.idempotency_ttl == 0
+    assert config.log_level == 'DEBUG'
+    assert config.log_sample_rate == 0.5
+    assert config.payload_store == 'memory'
+    assert config.base_url == 'https://callbacks.example.com'
+    assert config.server_workers == 32
+    assert config.encryption_threads == 1
+    assert config.encryption_processes == 2
+    assert config.payload_mac_keys == (('k2', '0123456789abcdef0123'), ('k1', 'fedcba9876543210fedc'))
+    assert config.payload_mac_keys_parameter == '/callbacks/mac-keys'
+    assert config.source_rate_limit == (60, 60)
+    assert config.transaction_rate_limit == (10, 0.5)
+    assert config.rate_limit_store == 'dynamodb:table'
+
+    assert sfn_callback_urls.common.load_config({'VERBOSE': 'true'}).log_level == 'DEBUG'
+    assert sfn_callback_urls.common.load_config({'VERBOSE': ''}).log_level == 'INFO'
+    # threads only help when data keys aren't cached
+    assert sfn_callback_urls.common.load_config({'DATA_KEY_CACHE_MAX_AGE': '0'}).encryption_threads == \
+        sfn_callback_urls.common.DEFAULT_ENCRYPTION_THREADS
+
+@pytest.mark.parametrize('field,var_name', [
+    ('force_disable_parameters', sfn_callback_urls.common.DISABLE_PARAMETERS_ENV_VAR_NAME),
+    ('disable_post_actions', sfn_callback_urls.common.DISABLE_POST_ACTION_ENV_VAR_NAME),
+])
+def test_load_config_disable(field, var_name):
+    load_config = sfn_callback_urls.common.load_config
+    assert not getattr(load_config({}), field)
+    for value in ['0', 'False']:
+        assert not getattr(load_config({var_name: value}), field)
+    # set but empty disables, as it always has
+    for value in ['1', 'True', 'true', '']:
+        assert getattr(load_config({var_name: value}), field)
+
+def test_load_config_invalid():
+    load_config = sfn_callback_urls.common.load_config
+    for environ in [
+            {'DISABLE_POST_ACTIONS': 'maybe'},
+            {'DATA_KEY_CACHE_MAX_AGE': 'forever'},
+            {'IDEMPOTENCY_TTL': '-1'},
+            {'LOG_LEVEL': 'LOUD'},
+            {'LOG_SAMPLE_RATE': '2'},
+            {'SERVER_WORKERS': '0'},
+            {'ENCRYPTION_THREADS': '0'},
+            {'PAYLOAD_MAC_KEYS': 'k1:short'},
+            {'PAYLOAD_MAC_KEYS': 'not a key id:0123456789abcdef0123'},
+            {'PAYLOAD_MAC_KEYS': 'k1:0123456789abcdef0123,k1:fedcba9876543210fedc'},
+            {'CALLBACK_SOURCE_RATE_LIMIT': '60'},
+            {'CALLBACK_SOURCE_RATE_LIMIT': '0/60'},
+            {'CALLBACK_TRANSACTION_RATE_LIMIT': '10/0'}]:
+        with pytest.raises(InvalidConfig):
+            load_config(environ)
+
+class FakeSsmSession:
+    def __init__(self, parameters):
+        self.parameters = parameters
+        self.requests = []
+
+    def client(self, service_name):
+        assert service_name == 'ssm'
+        return self
+
+    def get_parameter(self, **kwargs):
+        self.requests.append(kwargs)
+        return {'Parameter': {'Name': kwargs['Name'], 'Value': self.parameters[kwargs['Name']]}}
+
+def test_load_payload_mac_keys():
+    common = sfn_callback_urls.common
+    session = FakeSsmSession({
+        '/callbacks/mac-keys': 'k2:0123456789abcdef0123,k1:fedcba9876543210fedc',
+        '/callbacks/bad-keys': 'k1:short',
+    })
+    with common.override_config(payload_mac_keys=(('k0', 'from the environment'),),
+            payload_mac_keys_parameter='/callbacks/mac-keys'):
+        keys = common.load_payload_mac_keys(session)
+        assert keys == (('k2', '0123456789abcdef0123'), ('k1', 'fedcba9876543210fedc'))
+        assert common.get_payload_mac_keys() == keys
+    assert session.requests == [{'Name': '/callbacks/mac-keys', 'WithDecryption': True}]
+
+    with common.override_config(payload_mac_keys_parameter='/callbacks/bad-keys'):
+        with pytest.raises(InvalidConfig):
+            common.load_payload_mac_keys(session)
+
+def test_override_config():
+    common = sfn_callback_urls.common
+    original_config = common.get_config()
+    with common.override_config(disable_post_actions=True) as config:
+        assert common.get_disable_post_actions()
+        assert config.key_id == original_config.key_id
+    assert common.get_config() is original_config
+
+def test_add_metrics():
+    log_event = sfn_callback_urls.common.add_metrics({
+        'handler': 'process_callback',
+        'action_type': 'post',
+        'outcome_type': 'success',
+        'decode_time': 0.1,
+        'sfn_call_time': 0.2,
+    })
+    assert log_event['errors'] == 0
+    metadata = log_event['_aws']['CloudWatchMetrics'][0]
+    assert metadata['Namespace'] == sfn_callback_urls.common.get_config().metrics_namespace
+    assert [m['Name'] for m in metadata['Metrics']] == ['decode_time', 'sfn_call_time', 'errors']
+    assert metadata['Dimensions'] == [['handler'], ['handler', 'action_type', 'outcome_type']]
+
+    log_event = sfn_callback_urls.common.add_metrics({
+        'handler': 'process_callback',
+        'error': {
+            'type': 'RequestError',
+            'error': 'InvalidPayload',
+            'message': 'Missing payload',
+        },
+    })
+    assert log_event['errors'] == 1
+    assert log_event['error_code'] == 'InvalidPayload'
+    metadata = log_event['_aws']['CloudWatchMetrics'][0]
+    assert metadata['Dimensions'] == [['handler'], ['handler', 'error_code']]
+
+def test_parse_datetime():
+    parse_datetime = sfn_callback_urls.common.parse_datetime
+    utc = datetime.timezone.utc
+
+    assert parse_datetime('2020-01-02T03:04:05Z') == datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=utc)
+    assert parse_datetime('2020-01-02t03:04:05z') == datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=utc)
+    assert parse_datetime('2020-01-02 03:04:05') == datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=utc)
+    assert parse_datetime('2020-01-02T03:04:05.5Z') == datetime.datetime(2020, 1, 2, 3, 4, 5, 500000, tzinfo=utc)
+    assert parse_datetime('2020-01-02T03:04:05.123456789Z').microsecond == 123456
+
+    dt = parse_datetime('2020-01-02T03:04:05-08:00')
+    assert dt == datetime.datetime(2020, 1, 2, 11, 4, 5, tzinfo=utc)
+    assert dt.utcoffset() == datetime.timedelta(hours=-8)
 
-def test_force_disable_parameters(monkeypatch):
-    var_name = sfn_callback_urls.common.DISABLE_PARAMETERS_ENV_VAR_NAME
-    with monkeypatch.context() as mp:
-        mp.delenv(var_name, raising=False)
-        assert not sfn_callback_urls.common.get_force_disable_parameters()
-    with monkeypatch.context() as mp:
-        mp.setenv(var_name, '0')
-        assert not sfn_callback_urls.common.get_force_disable_parameters()
-    with monkeypatch.context() as mp:
-        mp.setenv(var_name, 'False')
-        assert not sfn_callback_urls.common.get_force_disable_parameters()
-    with monkeypatch.context() as mp:
-        mp.setenv(var_name, '1')
-        assert sfn_callback_urls.common.get_force_disable_parameters()
-    with monkeypatch.context() as mp:
-        mp.setenv(var_name, 'True')
-        assert sfn_callback_urls.common.get_force_disable_parameters()
-    with monkeypatch.context() as mp:
-        mp.setenv(var_name, 'true')
-        assert sfn_callback_urls.common.get_force_disable_parameters()
-
-def test_disable_post_actions(monkeypatch):
-    var_name = sfn_callback_urls.common.DISABLE_POST_ACTION_ENV_VAR_NAME
-    with monkeypatch.context() as mp:
-        mp.delenv(var_name, raising=False)
-        assert not sfn_callback_urls.common.get_disable_post_actions()
-    with monkeypatch.context() as mp:
-        mp.setenv(var_name, '0')
-        assert not sfn_callback_urls.common.get_disable_post_actions()
-    with monkeypatch.context() as mp:
-        mp.setenv(var_name, 'False')
-        assert not sfn_callback_urls.common.get_disable_post_actions()
-    with monkeypatch.context() as mp:
-        mp.setenv(var_name, '1')
-        assert sfn_callback_urls.common.get_disable_post_actions()
-    with monkeypatch.context() as mp:
-        mp.setenv(var_name, 'True')
-        assert sfn_callback_urls.common.get_disable_post_actions()
-    with monkeypatch.context() as mp:
-        mp.setenv(var_name, 'true')
-        assert sfn_callback_urls.common.get_disable_post_actions()
+    for value in ['2020-01-02', '2020-01-02T03:04', '2020-13-02T03:04:05Z', '2020-01-02T03:04:05+0800',
+            'Jan 2 2020 03:04:05', '2020-01-02T03:04:05Z ']:
+        with pytest.raises(ValueError):
+            parse_datetime(value)
@@ -0,0 +1,80 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+import base64
+
+from sfn_callback_urls.events import (
+    is_v2_event,
+    get_method,
+    get_query_parameters,
+    get_body,
+    get_source_ip,
+    get_api_url
+)
+from sfn_callback_urls.common import get_header
+from sfn_callback_urls.callbacks import get_url, load_from_request
+from sfn_callback_urls.fakes import get_proxy_event, get_http_api_event
+
+URL = 'https://abc123.execute-api.us-east-1.amazonaws.com/respond?action=foo&type=success&data=1-abc&x=1&x=2&y='
+
+@pytest.mark.parametrize('get_event', [get_proxy_event, get_http_api_event])
+def test_events(get_event):
+    event = get_event(URL, method='POST', body={'spam': 'eggs'}, headers={'Accept': 'text/html'})
+    assert is_v2_event(event) == (get_event is get_http_api_event)
+    assert get_method(event) == 'POST'
+    query_parameters = get_query_parameters(event)
+    # the fake v1 event drops blank values
+    query_parameters.pop('y', None)
+    assert query_parameters == {
+        'action': 'foo',
+        'type': 'success',
+        'data': '1-abc',
+        'x': '2',
+    }
+    assert get_body(event) == '{"spam": "eggs"}'
+    assert get_header(event, 'accept') == 'text/html'
+    assert get_header(event, 'Content-Type') == 'application/json'
+
+    action_name, action_type, payload, parameters = load_from_request(event)
+    assert (action_name, action_type, payload) == ('foo', 'success', '1-abc')
+    assert parameters['x'] == '2'
+
+def test_v2_event():
+    event = get_http_api_event(get_url('https://abc123.execute-api.us-east-1.amazonaws.com', 'foo', 'success',
+        '2-a+b/c=='), headers={'Cookie': 'a=1; b=2'})
+    # the raw query string is parsed, rather than queryStringParameters
+    assert get_query_parameters(event)['data'] == '2-a+b/c=='
+    assert get_header(event, 'cookie') == 'a=1; b=2'
+    assert get_source_ip(event) == '192.0.2.1'
+    assert get_api_url(event) == 'https://abc123.execute-api.us-east-1.amazonaws.com'
+
+    event['requestContext']['stage'] = 'prod'
+    assert get_api_url(event) == 'https://abc123.execute-api.us-east-1.amazonaws.com/prod'
+
+    event = get_http_api_event('https://abc123.execute-api.us-east-1.amazonaws.com/respond')
+    assert get_query_parameters(event) == {}
+    assert get_body(event) is None
+
+    event = get_http_api_event('https://abc123.lambda-url.us-east-1.on.aws/respond', method='POST', body='{}')
+    event['body'] = str(base64.b64encode(b'{"spam": "eggs"}'), 'ascii')
+    event['isBase64Encoded'] = True
+    assert get_body(event) == '{"spam": "eggs"}'
+
+def test_v1_event():
+    event = get_proxy_event('https://abc123.execute-api.us-east-1.amazonaws.com/respond')
+    assert get_query_parameters(event) == {}
+    assert get_api_url(event) is None
+    assert get_source_ip(event) == '192.0.2.1'
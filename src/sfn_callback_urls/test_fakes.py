@@ -0,0 +1,145 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+import os
+import sys
+import subprocess
+import time
+import asyncio
+
+import botocore.exceptions
+
+from .fakes import (
+    get_fake_kms_key_provider,
+    FakeStepFunctionsClient,
+    FakeAsyncStepFunctionsClient,
+    FakeAsyncPayloadDecoder,
+    get_proxy_event,
+    set_fake_environment
+)
+from . import common
+from .payload import encode_payload, decode_payload
+from .callbacks import get_url, load_from_request
+from .exceptions import EncryptionFailed, InvalidPayload
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_fake_kms():
+    key_provider = get_fake_kms_key_provider()
+    payload = {'tid': 'foo', 'token': 'bar'}
+    encoded_payload = encode_payload(payload, key_provider)
+    assert encoded_payload.startswith('2-')
+    assert decode_payload(encoded_payload, key_provider) == payload
+
+    # same key, different provider
+    assert decode_payload(encoded_payload, get_fake_kms_key_provider(key=key_provider.key)) == payload
+
+    with pytest.raises(InvalidPayload):
+        decode_payload(encoded_payload, get_fake_kms_key_provider())
+
+    with pytest.raises(EncryptionFailed):
+        encode_payload(payload, get_fake_kms_key_provider(fault_rate=1))
+
+    slow_key_provider = get_fake_kms_key_provider(latency=0.05)
+    start = time.perf_counter()
+    encode_payload(payload, slow_key_provider)
+    assert time.perf_counter() - start >= 0.05
+
+def test_fake_step_functions():
+    client = FakeStepFunctionsClient()
+    client.send_task_success(taskToken='foo', output='{}')
+    client.send_task_heartbeat(taskToken='bar')
+    assert client.calls == [
+        ('SendTaskSuccess', {'taskToken': 'foo', 'output': '{}'}),
+        ('SendTaskHeartbeat', {'taskToken': 'bar'}),
+    ]
+
+    client = FakeStepFunctionsClient(fault_rate=1, fault_code='TaskTimedOut')
+    with pytest.raises(botocore.exceptions.ClientError) as exc_info:
+        client.send_task_failure(taskToken='foo')
+    assert exc_info.value.response['Error']['Code'] == 'TaskTimedOut'
+    assert client.call_count == 0
+
+def test_fake_async_clients():
+    client = FakeAsyncStepFunctionsClient(latency=0.05)
+    key_provider = get_fake_kms_key_provider()
+    decoder = FakeAsyncPayloadDecoder(key_provider, latency=0.05)
+    encoded_payload = encode_payload({'tid': 'foo'}, key_provider)
+
+    async def run():
+        # the waits overlap, rather than blocking each other
+        return await asyncio.gather(
+            *[client.send_task_success(taskToken=str(i), output='{}') for i in range(10)],
+            *[decoder.decode(encoded_payload) for i in range(10)])
+    start = time.perf_counter()
+    results = asyncio.run(run())
+    assert time.perf_counter() - start < 0.5
+    assert results[10:] == [{'tid': 'foo'}] * 10
+    assert client.call_count == 10
+    assert decoder.decode_count == 10
+
+    client = FakeAsyncStepFunctionsClient(fault_rate=1, fault_code='TaskTimedOut')
+    with pytest.raises(botocore.exceptions.ClientError):
+        asyncio.run(client.send_task_heartbeat(taskToken='foo'))
+    with pytest.raises(InvalidPayload):
+        asyncio.run(FakeAsyncPayloadDecoder(key_provider, fault_rate=1).decode(encoded_payload))
+
+def test_proxy_event():
+    url = get_url('https://example.com/stage', 'foo', 'success', '1-abc')
+    event = get_proxy_event(url, method='POST', body={'spam': 'eggs'})
+    assert event['httpMethod'] == 'POST'
+    assert event['path'] == '/stage/respond'
+    assert event['headers']['Content-Type'] == 'application/json'
+    assert event['body'] == '{"spam": "eggs"}'
+    assert load_from_request(event) == ('foo', 'success', '1-abc', {'action': 'foo', 'type': 'success'})
+
+def test_set_fake_environment(monkeypatch):
+    monkeypatch.setattr(os, 'environ', dict(os.environ, **{
+        'KEY_ID': 'alias/foo',
+        'MAX_PAYLOAD_LENGTH': '100',
+        'CALLBACK_SOURCE_RATE_LIMIT': '1/60',
+        'LOG_LEVEL': 'debug',
+        'PATH': '/bin',
+    }))
+    monkeypatch.setattr(common, 'CONFIG', common.load_config())
+    assert common.get_config().key_id == 'alias/foo'
+
+    set_fake_environment('fakeapi', 'fake')
+    assert 'KEY_ID' not in os.environ
+    assert os.environ['PATH'] == '/bin'
+    assert os.environ['AWS_DEFAULT_REGION'] == 'us-east-1'
+
+    # the handlers get the defaults when they're imported after this
+    config = common.get_config()
+    assert config.key_id is None
+    assert config.api_id == 'fakeapi'
+    assert config.stage == 'fake'
+    assert config.max_payload_length == common.DEFAULT_MAX_PAYLOAD_LENGTH
+    assert config.source_rate_limit is None
+    assert config.log_level == common.DEFAULT_LOG_LEVEL
+
+def test_set_fake_environment_before_config():
+    # a shell environment that the config would fail to load from
+    env = dict(os.environ, LOG_LEVEL='LOUD', KEY_ID='alias/foo')
+    script = (
+        'from sfn_callback_urls.fakes import set_fake_environment\n'
+        'set_fake_environment("fakeapi", "fake")\n'
+        'from sfn_callback_urls.common import get_config\n'
+        'print(get_config().key_id, get_config().log_level)\n'
+    )
+    output = subprocess.run([sys.executable, '-c', script], env=env, cwd=SRC_DIR, check=True,
+        stdout=subprocess.PIPE, universal_newlines=True).stdout
+    assert output.split() == ['None', 'INFO']
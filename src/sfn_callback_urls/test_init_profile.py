@@ -0,0 +1,68 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+import sys
+import time
+import builtins
+
+from .init_profile import InitProfile
+
+def test_init_profile(tmp_path, monkeypatch):
+    (tmp_path / 'profiled_outer.py').write_text('import time\nimport profiled_inner\ntime.sleep(0.05)\n')
+    (tmp_path / 'profiled_inner.py').write_text('import time\ntime.sleep(0.1)\n')
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+    original_import = builtins.__import__
+    profile = InitProfile()
+    try:
+        __import__('profiled_outer')
+        with profile.time_client('foo'):
+            time.sleep(0.01)
+    finally:
+        profile.finish()
+        sys.modules.pop('profiled_outer', None)
+        sys.modules.pop('profiled_inner', None)
+    assert builtins.__import__ is original_import
+
+    assert 0.05 <= profile.imports['profiled_outer'] < 0.15
+    assert 0.1 <= profile.imports['profiled_inner']
+    assert list(profile.get_profile()['imports'])[:2] == ['profiled_inner', 'profiled_outer']
+    assert profile.clients['foo'] >= 0.01
+    assert profile.init_time >= 0.16
+
+    log_event = profile.add_to_log_event({})
+    assert log_event['cold_start'] is True
+    assert log_event['init_profile']['clients'] == profile.clients
+    assert profile.add_to_log_event({}) == {'cold_start': False}
+
+def test_init_profile_failed_init(tmp_path, monkeypatch):
+    (tmp_path / 'profiled_failing.py').write_text(
+        'from sfn_callback_urls.init_profile import InitProfile\n'
+        'INIT_PROFILE = InitProfile()\n'
+        'raise RuntimeError("init failed")\n'
+    )
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+    original_import = builtins.__import__
+    try:
+        with pytest.raises(RuntimeError):
+            __import__('profiled_failing')
+        assert 'profiled_failing' not in sys.modules
+        # the next import stops timing imports
+        __import__('json')
+        assert builtins.__import__ is original_import
+    finally:
+        builtins.__import__ = original_import
@@ -0,0 +1,67 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import uuid
+import logging
+
+from .log import configure_logger, is_sampled, set_transaction_id, LazyJson
+
+SERIALIZED = []
+
+class Unserializable:
+    """Records serialization, because logging swallows exceptions from it"""
+    def __str__(self):
+        SERIALIZED.append(self)
+        return 'serialized'
+
+def test_is_sampled():
+    transaction_ids = [uuid.uuid4().hex for _ in range(2000)]
+    assert not any(is_sampled(tid, 0) for tid in transaction_ids)
+    assert all(is_sampled(tid, 1) for tid in transaction_ids)
+    assert not is_sampled(None, 1)
+
+    sampled = [tid for tid in transaction_ids if is_sampled(tid, 0.25)]
+    assert 0.15 < len(sampled) / len(transaction_ids) < 0.35
+    assert sampled == [tid for tid in transaction_ids if is_sampled(tid, 0.25)]
+
+def test_levels():
+    stream = io.StringIO()
+    logger = configure_logger(logging.getLogger('test_levels'), 'INFO', 0, stream=stream)
+    set_transaction_id('foo')
+
+    logger.debug('Payload: %s', Unserializable())
+    assert stream.getvalue() == ''
+    assert not SERIALIZED
+
+    logger.info('Payload: %s', LazyJson({'spam': 'eggs'}))
+    assert stream.getvalue() == '[INFO] foo Payload: {"spam": "eggs"}\n'
+
+def test_sampling():
+    stream = io.StringIO()
+    logger = configure_logger(logging.getLogger('test_sampling'), 'INFO', 0.5, stream=stream)
+
+    transaction_ids = [uuid.uuid4().hex for _ in range(20)]
+    for tid in transaction_ids:
+        set_transaction_id(tid)
+        if is_sampled(tid, 0.5):
+            logger.debug('Payload: %s', LazyJson(tid))
+        else:
+            logger.debug('Payload: %s', Unserializable())
+    set_transaction_id(None)
+    logger.debug('Request: %s', Unserializable())
+    assert not SERIALIZED
+
+    lines = stream.getvalue().splitlines()
+    assert lines == [f'[DEBUG] {tid} Payload: "{tid}"' for tid in transaction_ids if is_sampled(tid, 0.5)]
@@ -17,6 +17,9 @@ import uuid
 import datetime
 import json
 import os
+import base64
+import struct
+import concurrent.futures
 
 import boto3
 import aws_encryption_sdk
@@ -26,10 +29,20 @@ from sfn_callback_urls.payload import (
     validate_payload_schema, InvalidPayload,
     validate_payload_expiration, ExpiredPayload,
     encode_payload,
-    decode_payload, DecryptionUnsupported, EncryptionRequired
+    encode_payloads,
+    EncryptionProcessPool,
+    get_master_key_provider,
+    get_caching_materials_manager,
+    decode_payload, DecryptionUnsupported, EncryptionRequired,
+    parse_encryption_header, check_encryption_key,
+    add_payload_mac, verify_payload_mac,
+    store_payload, resolve_payload,
+    check_payload_length, check_url_payload_length
 )
-from sfn_callback_urls.common import DISABLE_PARAMETERS_ENV_VAR_NAME
-from sfn_callback_urls.exceptions import ParametersDisabled
+from sfn_callback_urls.stores import MemoryStore
+from sfn_callback_urls.common import override_config
+from sfn_callback_urls.exceptions import ParametersDisabled, RejectedPayload, PayloadTooLong
+from sfn_callback_urls.fakes import get_fake_kms_key_provider
 
 PAYLOAD_SKELETON = {
     'iss': 'function name',
@@ -97,7 +110,12 @@ def test_build_exp():
     with pytest.raises(ExpiredPayload):
         validate_payload_expiration(payload, now)
 
-def test_build_parameters(monkeypatch):
+    with pytest.raises(ExpiredPayload):
+        validate_payload_expiration(payload, now.astimezone(datetime.timezone.utc))
+
+    validate_payload_expiration(payload, ts.astimezone(datetime.timezone.utc))
+
+def test_build_parameters():
     tid = uuid.uuid4().hex
     ts = datetime.datetime.now()
     token = uuid.uuid4().hex
@@ -110,14 +128,10 @@ def test_build_parameters(monkeypatch):
 
     pb = PayloadBuilder(tid, ts, token, enable_output_parameters=True)
 
-    with monkeypatch.context() as mp:
-        mp.delenv(DISABLE_PARAMETERS_ENV_VAR_NAME, raising=False)
-
+    with override_config(force_disable_parameters=False):
         payload = pb.build(action)
     
-    with monkeypatch.context() as mp:
-        mp.setenv(DISABLE_PARAMETERS_ENV_VAR_NAME, 'true')
-
+    with override_config(force_disable_parameters=True):
         with pytest.raises(ParametersDisabled):
             payload = pb.build(action)
 
@@ -205,10 +219,7 @@ def test_encrypted_payload_coding():
     key_id = os.environ['KEY_ID']
     session = boto3.Session()
     
-    mkp = aws_encryption_sdk.KMSMasterKeyProvider(
-        key_ids = [key_id],
-        botocore_session = session._session
-    )
+    mkp = get_master_key_provider(key_id, session._session)
 
     payload = {
         'iss': 'issuer',
@@ -241,3 +252,220 @@ def test_encrypted_payload_coding():
     assert encoded_payload.startswith('2-')
     with pytest.raises(DecryptionUnsupported):
         decoded_payload = decode_payload(encoded_payload, None)
+
+def test_cached_data_key_payload_coding():
+    mkp = get_fake_kms_key_provider()
+
+    cmm = get_caching_materials_manager(mkp, max_age=60)
+
+    payloads = []
+    encoded_payloads = []
+    for i in range(3):
+        payload = {
+            'tid': f'tid{i}',
+            'token': 'jkljkl',
+            'action': {
+                'name': 'foo',
+                'type': 'success',
+                'output': {'index': i}
+            },
+        }
+        payloads.append(payload)
+        encoded_payloads.append(encode_payload(payload, cmm))
+
+    assert len(set(encoded_payloads)) == 3
+    for payload, encoded_payload in zip(payloads, encoded_payloads):
+        assert encoded_payload.startswith('2-')
+        assert_dicts_equal(payload, decode_payload(encoded_payload, mkp))
+
+def test_concurrent_payload_coding():
+    key = os.urandom(32)
+    key_provider = get_fake_kms_key_provider(key)
+
+    payloads = [{
+        'tid': 'asdf',
+        'token': 'jkljkl',
+        'action': {
+            'name': f'action{i}',
+            'type': 'success',
+            'output': {'index': i}
+        },
+    } for i in range(6)]
+
+    def assert_decodes(encoded_payloads):
+        assert len(encoded_payloads) == len(payloads)
+        for payload, (encoded_payload, encryption_time) in zip(payloads, encoded_payloads):
+            assert encryption_time >= 0
+            assert_dicts_equal(payload, decode_payload(encoded_payload, key_provider))
+
+    assert_decodes(encode_payloads(payloads, key_provider))
+
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        assert_decodes(encode_payloads(payloads, key_provider, executor))
+        # unencrypted payloads aren't worth sending to the executor
+        assert [p for p, _ in encode_payloads(payloads, None, executor)] == [encode_payload(p, None) for p in payloads]
+
+    # the workers make their own key provider, with the same key
+    with EncryptionProcessPool(2, get_fake_kms_key_provider, key) as executor:
+        assert_decodes(encode_payloads(payloads, key_provider, executor))
+
+    # and the MAC keys the pool was created with, which may not be the ones in their environment
+    with override_config(payload_mac_keys=(('k1', 'secret-one-0123456789'),)):
+        with EncryptionProcessPool(2, get_fake_kms_key_provider, key) as executor:
+            encoded_payloads = [p for p, _ in encode_payloads(payloads, key_provider, executor)]
+        assert all(verify_payload_mac(p) for p in encoded_payloads)
+
+def test_concurrent_payload_coding_data_key_cache(monkeypatch):
+    key_provider = get_fake_kms_key_provider()
+    generated = []
+    generate_data_key = type(key_provider.master_key(b'fake-kms-key'))._generate_data_key
+    def count_generate_data_key(self, *args, **kwargs):
+        generated.append(1)
+        return generate_data_key(self, *args, **kwargs)
+    monkeypatch.setattr(type(key_provider.master_key(b'fake-kms-key')), '_generate_data_key', count_generate_data_key)
+
+    payloads = [{'tid': 'asdf', 'token': 'jkljkl', 'action': {'name': f'action{i}', 'type': 'success'}}
+        for i in range(8)]
+    materials_manager = get_caching_materials_manager(key_provider, 300)
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        encode_payloads(payloads, materials_manager, executor)
+    # one data key for the batch, the threads don't all miss the cold cache
+    assert len(generated) == 1
+
+def test_stored_payload_coding():
+    payload = {
+        'tid': 'asdf',
+        'token': 'jkljkl',
+        'action': {
+            'name': 'foo',
+            'type': 'success',
+            'output': {}
+        },
+    }
+    encoded_payload = encode_payload(payload, None)
+
+    store = MemoryStore()
+    stored_payload = store_payload(encoded_payload, store)
+    assert stored_payload.startswith('3-')
+    assert len(stored_payload) < 32
+
+    # each call stores the payload once, under its own id
+    assert len(store) == 1
+    assert store_payload(encoded_payload, store) != stored_payload
+    assert len(store) == 2
+
+    assert resolve_payload(stored_payload, store) == encoded_payload
+    assert resolve_payload(encoded_payload, store) == encoded_payload
+    assert_dicts_equal(decode_payload(resolve_payload(stored_payload, store), None), payload)
+
+    with pytest.raises(InvalidPayload):
+        resolve_payload('3-unknown', store)
+    with pytest.raises(InvalidPayload):
+        resolve_payload('3-not/valid', store)
+    with pytest.raises(InvalidPayload):
+        resolve_payload(stored_payload, None)
+
+def test_payload_rejection():
+    # the fake KMS fails every call, so anything that gets as far as decrypting is a decryption error
+    key_provider = get_fake_kms_key_provider()
+    payload = {'tid': 'asdf', 'token': 'jkljkl', 'action': {'name': 'foo', 'type': 'success'}}
+    encoded_payload = encode_payload(payload, key_provider)
+    key_provider = get_fake_kms_key_provider(key_provider.key, fault_rate=1)
+
+    def assert_rejected(encoded_payload, reason, key_id=None):
+        with pytest.raises(RejectedPayload) as exc_info:
+            decode_payload(encoded_payload, key_provider, key_id)
+        assert exc_info.value.reason == reason
+        assert exc_info.value.code() == 'InvalidPayload'
+
+    with override_config(max_payload_length=100):
+        with pytest.raises(RejectedPayload) as exc_info:
+            check_payload_length(encoded_payload)
+        assert exc_info.value.reason == 'length'
+        with pytest.raises(PayloadTooLong):
+            check_url_payload_length('foo', encoded_payload)
+        # stored payloads are only checked in the URL
+        assert decode_payload(encoded_payload, get_fake_kms_key_provider(key_provider.key))['tid'] == 'asdf'
+    check_payload_length(encoded_payload)
+    assert_rejected('abc', 'format')
+    assert_rejected('4-abc', 'format')
+    assert_rejected(encoded_payload[:-1], 'base64')
+    assert_rejected(encoded_payload[:10] + '.' + encoded_payload[11:], 'base64')
+    assert_rejected(encoded_payload[:10] + '/' + encoded_payload[11:], 'base64')
+
+    binary_payload = base64.urlsafe_b64decode(encoded_payload[2:])
+    def encode(binary_payload):
+        return '2-' + str(base64.urlsafe_b64encode(binary_payload), 'ascii')
+    # truncated anywhere in the header
+    for length in [0, 1, 20, 40, 100, 200]:
+        assert_rejected(encode(binary_payload[:length]), 'header')
+    # version 1 of the message format, which only has non-committing algorithms
+    assert_rejected(encode(b'\x01' + binary_payload[1:]), 'header')
+    assert_rejected(encode(binary_payload[:1] + struct.pack('>H', 0x0178) + binary_payload[3:]), 'header')
+    # garbage that's base64
+    assert_rejected(encode(os.urandom(500)), 'header')
+    # truncated after the header, in the body or the signature in the footer, or with more after it
+    assert_rejected(encode(binary_payload[:-110]), 'body')
+    assert_rejected(encode(binary_payload[:-1]), 'footer')
+    assert_rejected(encode(binary_payload + b'\x00'), 'footer')
+
+    data_keys = parse_encryption_header(binary_payload)
+    assert [provider_id for provider_id, _ in data_keys] == [b'fake-kms']
+    assert_rejected(encoded_payload, 'key_id', key_id='arn:aws:kms:us-east-1:123456789012:key/other')
+
+    # with a valid header, the payload gets to KMS
+    with pytest.raises(InvalidPayload) as exc_info:
+        decode_payload(encoded_payload, key_provider)
+    assert not isinstance(exc_info.value, RejectedPayload)
+
+def test_check_encryption_key():
+    key_arn = 'arn:aws:kms:us-east-1:123456789012:key/1234abcd-12ab-34cd-56ef-1234567890ab'
+    data_keys = [(b'aws-kms', key_arn.encode())]
+    check_encryption_key(data_keys, key_arn)
+    check_encryption_key(data_keys, '1234abcd-12ab-34cd-56ef-1234567890ab')
+    # aliases aren't in the header
+    check_encryption_key(data_keys, 'alias/foo')
+    check_encryption_key(data_keys, None)
+    for key_id in ['abcd-12ab-34cd-56ef-1234567890ab', key_arn.replace('1234abcd', '5678abcd')]:
+        with pytest.raises(RejectedPayload):
+            check_encryption_key(data_keys, key_id)
+
+def test_payload_mac():
+    key_provider = get_fake_kms_key_provider()
+    payload = {'tid': 'asdf', 'token': 'jkljkl', 'action': {'name': 'foo', 'type': 'success'}}
+    old_keys = (('k1', 'secret-one-0123456789'),)
+    new_keys = (('k2', 'secret-two-0123456789'),) + old_keys
+
+    with override_config(payload_mac_keys=old_keys):
+        encoded_payload = encode_payload(payload, key_provider)
+        unencrypted_payload = encode_payload(payload, None)
+    assert encoded_payload.rsplit('.', 2)[1] == 'k1'
+
+    # rotated: new payloads get the new key, and the old key is still accepted
+    with override_config(payload_mac_keys=new_keys):
+        assert_dicts_equal(payload, decode_payload(encoded_payload, key_provider))
+        assert_dicts_equal(payload, decode_payload(unencrypted_payload, None))
+        assert encode_payload(payload, key_provider).rsplit('.', 2)[1] == 'k2'
+
+    # forgeries don't get as far as KMS
+    key_provider = get_fake_kms_key_provider(key_provider.key, fault_rate=1)
+    body, key_id, tag = encoded_payload.rsplit('.', 2)
+    forged_tag = ('A' if tag[0] != 'A' else 'B') + tag[1:]
+    with override_config(payload_mac_keys=new_keys[:1]):
+        for forged_payload in [
+                body,
+                '.'.join([body, 'k1', tag]), # the key has been retired
+                '.'.join([body, 'k2', tag]),
+                '.'.join([body, key_id, forged_tag]),
+                '.'.join([body[:-4] + 'AAAA', key_id, tag]),
+                # not base64, which a URL can still have
+                '.'.join([body, 'k2', 'é' + tag[1:]]),
+                '.'.join([body[:-1] + 'é', 'k2', tag])]:
+            with pytest.raises(RejectedPayload) as exc_info:
+                decode_payload(forged_payload, key_provider)
+            assert exc_info.value.reason == 'mac'
+
+    # without keys, tags are ignored
+    assert verify_payload_mac(encoded_payload, ()) == body
+    assert add_payload_mac(body, ()) == body
+    assert verify_payload_mac(add_payload_mac(body, new_keys), new_keys) == body
@@ -0,0 +1,191 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import time
+
+from sfn_callback_urls.stores import (
+    MemoryStore,
+    SQLiteStore,
+    DynamoDBStore,
+    CachingStore,
+    get_store
+)
+from sfn_callback_urls.idempotency import IdempotencyCache, get_idempotency_key
+
+class FakeDynamoDBClient:
+    def __init__(self):
+        self.items = {}
+
+    def get_item(self, TableName, Key, ConsistentRead=False):
+        item = self.items.get((TableName, Key['key']['S']))
+        return {'Item': item} if item else {}
+
+    def put_item(self, TableName, Item):
+        self.items[(TableName, Item['key']['S'])] = Item
+
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues,
+            ReturnValues):
+        # only the expression increment uses
+        item = self.items.setdefault((TableName, Key['key']['S']), dict(Key))
+        item['count'] = {'N': str(int(item.get('count', {'N': '0'})['N']) + 1)}
+        if ':ttl' in ExpressionAttributeValues:
+            item.setdefault('ttl', ExpressionAttributeValues[':ttl'])
+        return {'Attributes': {'count': item['count']}}
+
+def test_memory_store():
+    store = MemoryStore(capacity=2)
+    assert store.get('foo') is None
+
+    store.put('foo', 'bar')
+    assert store.get('foo') == 'bar'
+
+    store.put('spam', 'eggs')
+    store.get('foo')
+    store.put('baz', 'qux') # evicts spam, the least recently used
+    assert len(store) == 2
+    assert store.get('spam') is None
+    assert store.get('foo') == 'bar'
+
+    store.put('foo', 'bar', ttl=0.01)
+    time.sleep(0.02)
+    assert store.get('foo') is None
+
+def test_dynamodb_store():
+    client = FakeDynamoDBClient()
+    store = DynamoDBStore('table', client=client)
+    assert store.get('foo') is None
+
+    store.put('foo', 'bar')
+    assert store.get('foo') == 'bar'
+    assert 'ttl' not in client.items[('table', 'foo')]
+
+    store.put('foo', 'bar', ttl=60)
+    assert store.get('foo') == 'bar'
+
+    # expired but not yet deleted by DynamoDB
+    client.items[('table', 'foo')]['ttl'] = {'N': str(int(time.time() - 1))}
+    assert store.get('foo') is None
+
+def test_get_store():
+    store = get_store('memory')
+    assert isinstance(store, MemoryStore)
+
+    store = get_store('memory:10')
+    assert store.capacity == 10
+
+    with pytest.raises(ValueError):
+        get_store('dynamodb')
+
+    with pytest.raises(ValueError):
+        get_store('foo:bar')
+
+def test_idempotency_cache():
+    event = {'token': 'foo', 'actions': []}
+    base_url = 'https://example.com'
+    key = get_idempotency_key(event, base_url)
+    assert key == get_idempotency_key({'actions': [], 'token': 'foo'}, base_url)
+    assert key != get_idempotency_key({'token': 'bar', 'actions': []}, base_url)
+    assert key != get_idempotency_key(event, 'https://example.org')
+    assert get_idempotency_key(dict(event, idempotency_key='a'), base_url) == get_idempotency_key({'token': 'foo', 'idempotency_key': 'a'}, base_url)
+    # the same key for another token, or another base URL
+    assert get_idempotency_key(dict(event, idempotency_key='a'), base_url) != get_idempotency_key({'token': 'bar', 'idempotency_key': 'a'}, base_url)
+    assert get_idempotency_key(dict(event, idempotency_key='a'), base_url) != get_idempotency_key({'token': 'foo', 'idempotency_key': 'a'}, 'https://example.org')
+
+    shared_store = DynamoDBStore('table', client=FakeDynamoDBClient())
+    cache = IdempotencyCache(60, shared_store=shared_store)
+    assert cache.get(key) is None
+    cache.put(key, {'transaction_id': 'tid'})
+    assert cache.get(key) == {'transaction_id': 'tid'}
+
+    # another container with the same shared store
+    cache = IdempotencyCache(60, shared_store=shared_store)
+    assert cache.get(key) == {'transaction_id': 'tid'}
+
+def test_sqlite_store(tmp_path):
+    path = str(tmp_path / 'store.db')
+    store = get_store('sqlite:' + path)
+    assert store.get('foo') is None
+
+    store.put('foo', 'bar')
+    assert store.get('foo') == 'bar'
+
+    store.put('foo', 'baz', ttl=60)
+    assert SQLiteStore(path).get('foo') == 'baz'
+
+    store.put('foo', 'bar', ttl=0.01)
+    time.sleep(0.02)
+    assert store.get('foo') is None
+
+def test_caching_store():
+    backing_store = MemoryStore()
+    store = CachingStore(backing_store)
+
+    backing_store.put('foo', 'bar')
+    assert store.get('foo') == 'bar'
+
+    backing_store.put('foo', 'baz')
+    assert store.get('foo') == 'bar' # cached
+
+    store.put('spam', 'eggs')
+    assert backing_store.get('spam') == 'eggs'
+
+def test_caching_store_expiration(tmp_path):
+    backing_stores = [
+        MemoryStore(),
+        SQLiteStore(str(tmp_path / 'store.db')),
+        DynamoDBStore('table', client=FakeDynamoDBClient()),
+    ]
+    for backing_store in backing_stores:
+        store = CachingStore(backing_store)
+
+        backing_store.put('foo', 'bar', ttl=60)
+        value, expires = store.get_with_expiration('foo')
+        assert value == 'bar'
+        assert time.time() < expires <= time.time() + 60
+        # cached with the expiration from the other store
+        assert store.cache.get_with_expiration('foo') == (value, expires)
+
+        backing_store.put('spam', 'eggs')
+        assert store.get_with_expiration('spam') == ('eggs', None)
+
+    # an expired value isn't returned from the cache
+    backing_store = MemoryStore()
+    store = CachingStore(backing_store)
+    backing_store.put('foo', 'bar', ttl=0.01)
+    assert store.get('foo') == 'bar'
+    time.sleep(0.02)
+    assert store.get('foo') is None
+    assert len(store.cache) == 0
+
+def test_increment(tmp_path):
+    stores = [
+        MemoryStore(),
+        SQLiteStore(str(tmp_path / 'store.db')),
+        DynamoDBStore('table', client=FakeDynamoDBClient()),
+        CachingStore(MemoryStore()),
+    ]
+    for store in stores:
+        assert store.increment('foo') == 1
+        assert store.increment('foo') == 2
+        assert store.increment('bar', ttl=60) == 1
+
+    # expired counters start again
+    for store in stores[:2]:
+        store.increment('baz', ttl=0.01)
+        time.sleep(0.02)
+        assert store.increment('baz', ttl=0.01) == 1
+
+    # another process with the same database
+    assert SQLiteStore(str(tmp_path / 'store.db')).increment('foo') == 3
@@ -0,0 +1,51 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+from .warmup import is_warmup_event, handle_warmup_event
+
+def test_is_warmup_event():
+    assert is_warmup_event({'warmup': True})
+    assert is_warmup_event({
+        'source': 'aws.events',
+        'detail-type': 'Scheduled Event',
+        'detail': {},
+    })
+    assert not is_warmup_event({'warmup': 'true'})
+    assert not is_warmup_event({'source': 'aws.events', 'detail-type': 'EC2 Instance State-change Notification'})
+    assert not is_warmup_event({'token': 'foo'})
+    assert not is_warmup_event([{'warmup': True}])
+
+def test_handle_warmup_event(capsys):
+    warmed = []
+    def fail():
+        raise ValueError('spam')
+
+    response = handle_warmup_event('foo', [
+        ('bar', lambda: warmed.append('bar')),
+        ('baz', fail),
+        ('qux', lambda: warmed.append('qux')),
+    ])
+    assert response == {'warmup': True, 'warmed': ['bar', 'baz', 'qux']}
+    assert warmed == ['bar', 'qux']
+
+    log_event = json.loads(capsys.readouterr().out)
+    assert log_event['handler'] == 'foo'
+    assert list(log_event['warmed']) == ['bar', 'baz', 'qux']
+    assert list(log_event['warmup_errors']) == ['baz']
+    assert 'total_time' in log_event
+    # logged, but not counted in the request metrics
+    assert '_aws' not in log_event
+    assert 'errors' not in log_event
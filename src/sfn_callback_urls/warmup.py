@@ -0,0 +1,83 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Warm-up events, for scheduled warmers and provisioned concurrency.
+
+A warm-up event is {"warmup": true}, or an EventBridge scheduled event.
+Instead of being treated as a request, it runs the handler's warm-up steps,
+which do the work that would otherwise slow down the first real request
+(building validators, fetching a data key, opening connections).
+"""
+
+import os
+import sys
+import time
+import datetime
+from collections import OrderedDict
+
+from .common import send_log_event
+
+# Lambda sets this during init for provisioned concurrency
+INITIALIZATION_TYPE_ENV_VAR_NAME = 'AWS_LAMBDA_INITIALIZATION_TYPE'
+
+def is_warmup_event(event):
+    if not isinstance(event, dict):
+        return False
+    if event.get('warmup') is True:
+        return True
+    return event.get('source') == 'aws.events' and event.get('detail-type') == 'Scheduled Event'
+
+def is_provisioned_concurrency_init():
+    return os.environ.get(INITIALIZATION_TYPE_ENV_VAR_NAME) == 'provisioned-concurrency'
+
+def run_warmup_steps(steps):
+    """Run (name, function) steps, returning the time each took. A failed step
+    is reported but doesn't stop the others, the request will just be slower"""
+    warmed = OrderedDict()
+    errors = OrderedDict()
+    for name, func in steps:
+        start = time.perf_counter()
+        try:
+            func()
+        except Exception as e:
+            error_class_name = type(e).__module__ + '.' + type(e).__name__
+            print(f'Warm-up step {name} failed: {error_class_name}: {str(e)}', file=sys.stderr)
+            errors[name] = f'{error_class_name}: {str(e)}'
+        warmed[name] = time.perf_counter() - start
+    return warmed, errors
+
+def handle_warmup_event(handler_name, steps, init_profile=None):
+    """Run the warm-up steps, log what was warmed, and return the response for the event"""
+    start_time = time.perf_counter()
+
+    log_event = {
+        'handler': handler_name,
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'warmup': True,
+    }
+    if init_profile:
+        init_profile.add_to_log_event(log_event)
+
+    warmed, errors = run_warmup_steps(steps)
+    log_event['warmed'] = warmed
+    if errors:
+        log_event['warmup_errors'] = errors
+
+    # not metrics, which would count warmer pings as requests, and their times in the latencies
+    send_log_event(log_event, start_time, metrics=False)
+
+    return {
+        'warmup': True,
+        'warmed': list(warmed),
+    }
@@ -15,13 +15,35 @@
 import pytest
 
 import json
+import base64
+import time
+import urllib.parse
+import concurrent.futures
 
 import jsonschema
 
 import create_urls
+from sfn_callback_urls.common import override_config
+from sfn_callback_urls.action_templates import ActionTemplates
+from sfn_callback_urls.stores import MemoryStore
+from sfn_callback_urls.idempotency import IdempotencyCache, get_idempotency_key
+from sfn_callback_urls.payload import resolve_payload, decode_payload
+from sfn_callback_urls.fakes import get_fake_kms_key_provider, get_http_api_event
 from sfn_callback_urls.schemas.action import action_schema
 from sfn_callback_urls.schemas.create_urls import create_urls_input_schema
 
+@pytest.fixture(autouse=True)
+def idempotency_cache(monkeypatch):
+    # a cache for each test, so they don't get each other's responses
+    cache = IdempotencyCache(create_urls.get_idempotency_ttl())
+    monkeypatch.setattr(create_urls, 'IDEMPOTENCY_CACHE', cache)
+    return cache
+
+@pytest.fixture
+def api_config():
+    with override_config(api_id='gy415nuibc', stage='testStage'):
+        yield
+
 def assert_dicts_equal(a, b):
     assert json.dumps(a, sort_keys=True) == json.dumps(b, sort_keys=True)
 
@@ -370,6 +392,20 @@ def test_invalid_json():
     body = json.loads(resp['body'])
     assert body['error'] == 'InvalidJSON'
 
+def test_invalid_base64_body():
+    for body in [
+            str(base64.b64encode(b'{"foo": "\xff"}'), 'ascii'), # not UTF-8
+            'not base64!']:
+        req = get_request()
+        req['body'] = body
+        req['isBase64Encoded'] = True
+
+        resp = create_urls.api_handler(req, None)
+
+        assert resp['statusCode'] == 400
+        body = json.loads(resp['body'])
+        assert body['error'] == 'InvalidJSON'
+
 def test_invalid_event():
     req = get_request()
 
@@ -402,10 +438,28 @@ def test_basic_request():
     assert 'urls' in body
     assert len(body['urls']) == 3
 
-def test_basic_event(monkeypatch):
-    monkeypatch.setenv('API_ID', 'gy415nuibc')
-    monkeypatch.setenv('STAGE', 'testStage')
-    
+def test_http_api_request():
+    event = get_event(actions=[
+        get_success('foo', {'spam': 'eggs'}),
+    ])
+    req = get_http_api_event('https://abc123.execute-api.us-east-1.amazonaws.com/urls', method='POST', body=event)
+
+    resp = create_urls.api_handler(req, None)
+    assert resp['statusCode'] == 200
+    # on the API the request came through
+    url = json.loads(resp['body'])['urls']['foo']
+    assert url.startswith('https://abc123.execute-api.us-east-1.amazonaws.com/respond?')
+
+    # a different token, so it isn't the idempotent response to the first
+    event['token'] = 'qwer'
+    req = get_http_api_event('https://callbacks.example.com/prod/urls', method='POST', body=event, stage='prod')
+    url = json.loads(create_urls.api_handler(req, None)['body'])['urls']['foo']
+    assert url.startswith('https://callbacks.example.com/prod/respond?')
+
+    req = get_http_api_event('https://abc123.execute-api.us-east-1.amazonaws.com/urls')
+    assert create_urls.api_handler(req, None)['statusCode'] == 405
+
+def test_basic_event(api_config):
     event = get_event(actions=[
         get_success('foo', {'spam': 'eggs'}),
         get_failure('bar'),
@@ -415,3 +469,265 @@ def test_basic_event(monkeypatch):
     resp = create_urls.direct_handler(event, None)
     assert 'urls' in resp
     assert len(resp['urls']) == 3
+
+def test_batch_event(api_config):
+    events = [
+        get_event(actions=[
+            get_success('foo', {'spam': 'eggs'}),
+            get_failure('bar'),
+        ]),
+        get_event(actions=[
+            get_heartbeat('baz'),
+            get_heartbeat('baz'),
+        ]),
+        {
+            'token': 1,
+        },
+        get_event(actions=[
+            get_heartbeat('baz'),
+        ]),
+    ]
+
+    resp = create_urls.direct_handler(events, None)
+    assert 'batch_id' in resp
+    results = resp['results']
+    assert len(results) == 4
+
+    assert len(results[0]['urls']) == 2
+    assert results[1]['error'] == 'DuplicateActionName'
+    assert results[2]['error'] == 'InvalidJSON'
+    assert len(results[3]['urls']) == 1
+
+    assert len(set(r.get('transaction_id') for r in [results[0], results[1], results[3]])) == 3
+
+def test_batch_request():
+    req = get_request()
+
+    req['body'] = json.dumps([
+        get_event(actions=[
+            get_success('foo', {'spam': 'eggs'}),
+        ]),
+        get_event(actions=[
+            get_failure('bar'),
+        ]),
+    ])
+
+    resp = create_urls.api_handler(req, None)
+    assert resp['statusCode'] == 200
+
+    body = json.loads(resp['body'])
+    assert [list(r['urls']) for r in body['results']] == [['foo'], ['bar']]
+
+    req['body'] = json.dumps([])
+
+    resp = create_urls.api_handler(req, None)
+    assert resp['statusCode'] == 400
+
+def test_template_event(monkeypatch, api_config):
+    monkeypatch.setattr(create_urls, 'ACTION_TEMPLATES', ActionTemplates([
+        {
+            'name': 'approval',
+            'version': 1,
+            'actions': [
+                get_success('approve', {'approved': True}),
+                get_failure('reject'),
+            ]
+        }
+    ]))
+
+    event = {
+        'token': 'asdf',
+        'template': {
+            'name': 'approval',
+            'version': 1,
+            'overrides': {
+                'reject': {'error': 'Rejected'},
+            }
+        },
+        'actions': [
+            get_heartbeat('baz'),
+        ]
+    }
+
+    resp = create_urls.direct_handler(event, None)
+    assert list(resp['urls']) == ['approve', 'reject', 'baz']
+
+    event['template']['version'] = 2
+    resp = create_urls.direct_handler(event, None)
+    assert resp['error'] == 'UnknownActionTemplate'
+
+    event = {
+        'token': 'asdf',
+        'template': {
+            'name': 'approval',
+            'version': 1,
+        },
+        'actions': [
+            get_heartbeat('approve'),
+        ]
+    }
+    resp = create_urls.direct_handler(event, None)
+    assert resp['error'] == 'DuplicateActionName'
+
+def test_idempotent_event(api_config):
+    event = get_event(actions=[
+        get_success('foo', {'spam': 'eggs'}),
+    ])
+
+    resp1 = create_urls.direct_handler(event, None)
+    resp2 = create_urls.direct_handler(event, None)
+    assert_dicts_equal(resp1, resp2)
+
+    event['actions'][0]['output'] = {'spam': 'ham'}
+    resp3 = create_urls.direct_handler(event, None)
+    assert resp3['transaction_id'] != resp1['transaction_id']
+
+    event['idempotency_key'] = 'foo'
+    resp4 = create_urls.direct_handler(event, None)
+    resp5 = create_urls.direct_handler(event, None)
+    assert resp4['transaction_id'] != resp3['transaction_id']
+    assert resp5['transaction_id'] == resp4['transaction_id']
+
+    # the same key for another task doesn't get the first task's URLs
+    event['token'] = 'other-token'
+    resp6 = create_urls.direct_handler(event, None)
+    assert resp6['transaction_id'] != resp4['transaction_id']
+
+def test_idempotent_event_base_url(api_config):
+    event = get_event(actions=[
+        get_success('foo', {'spam': 'eggs'}),
+    ])
+    event['idempotency_key'] = 'foo'
+
+    resp1 = create_urls.direct_handler(event, None)
+
+    # the same request for another API doesn't get URLs for the first one
+    event['base_url'] = 'https://example.com/callback'
+    resp2 = create_urls.direct_handler(event, None)
+    assert resp2['transaction_id'] != resp1['transaction_id']
+    assert resp2['urls']['foo'].startswith('https://example.com/callback')
+
+    resp3 = create_urls.direct_handler(event, None)
+    assert resp3['transaction_id'] == resp2['transaction_id']
+
+def test_idempotent_event_expired(api_config, idempotency_cache):
+    base_url = 'https://example.com/callback'
+    event = get_event(actions=[
+        get_success('foo', {'spam': 'eggs'}),
+    ], expiration='2000-01-01T00:00:00Z', base_url=base_url)
+
+    # a response cached while the request was still valid
+    key = get_idempotency_key(event, base_url)
+    idempotency_cache.put(key, {
+        'transaction_id': 'cached',
+        'urls': {'foo': base_url + '?data=cached'},
+        'expiration': '2000-01-01T00:00:00+00:00',
+    })
+
+    resp = create_urls.direct_handler(event, None)
+    assert resp['error'] == 'InvalidDate'
+
+def test_short_urls_event(monkeypatch, api_config):
+    event = get_event(actions=[
+        get_success('foo', {'spam': 'eggs' * 100}),
+    ])
+    event['short_urls'] = True
+
+    monkeypatch.setattr(create_urls, 'PAYLOAD_STORE', None)
+    resp = create_urls.direct_handler(event, None)
+    assert resp['error'] == 'ShortUrlsUnavailable'
+
+    store = MemoryStore()
+    monkeypatch.setattr(create_urls, 'PAYLOAD_STORE', store)
+    resp = create_urls.direct_handler(event, None)
+    url = resp['urls']['foo']
+    assert len(url) < 200
+
+    payload = url.split('data=')[1]
+    assert payload.startswith('3-')
+    payload = decode_payload(resolve_payload(payload, store), None)
+    assert payload['tid'] == resp['transaction_id']
+
+def test_payload_too_long(monkeypatch, api_config):
+    monkeypatch.setattr(create_urls, 'PAYLOAD_STORE', MemoryStore())
+    event = get_event(actions=[
+        get_success('foo', {'spam': 'eggs' * 5000}),
+    ])
+    resp = create_urls.direct_handler(event, None)
+    assert resp['error'] == 'PayloadTooLong'
+
+    event['short_urls'] = True
+    resp = create_urls.direct_handler(event, None)
+    assert 'foo' in resp['urls']
+
+def test_phase_timings(monkeypatch, api_config):
+    log_events = []
+    monkeypatch.setattr(create_urls, 'send_log_event', lambda log_event, start_time: log_events.append(log_event))
+
+    event = get_event(actions=[
+        get_success('foo', {'spam': 'eggs'}),
+        get_failure('bar'),
+    ])
+    event['expiration'] = '2100-01-01T00:00:00'
+
+    resp = create_urls.direct_handler(event, None)
+    assert len(resp['urls']) == 2
+
+    log_event = log_events[0]
+    for name in ['schema_validation_time', 'expiration_parse_time', 'post_action_validation_time',
+            'payload_build_time', 'encryption_time', 'url_time']:
+        assert log_event[name] >= 0
+    assert 'store_time' not in log_event
+    assert sorted(log_event['encryption_times']) == ['bar', 'foo']
+    assert log_event['encryption_time'] == pytest.approx(sum(log_event['encryption_times'].values()))
+
+def test_warmup_event(monkeypatch):
+    log_events = []
+    monkeypatch.setattr('sfn_callback_urls.warmup.send_log_event', lambda log_event, start_time, metrics=True: log_events.append(log_event))
+
+    resp = create_urls.direct_handler({'warmup': True}, None)
+    assert resp['warmup'] is True
+    assert 'create_urls_input_validator' in resp['warmed']
+
+    resp = create_urls.api_handler({'source': 'aws.events', 'detail-type': 'Scheduled Event'}, None)
+    assert resp['warmup'] is True
+
+    assert [e['warmup'] for e in log_events] == [True, True]
+    assert not any('warmup_errors' in e for e in log_events)
+
+def test_base_url_event(api_config):
+    event = get_event(actions=[
+        get_success('foo', {'spam': 'eggs'}),
+    ])
+    event['base_url'] = 'https://example.com/callbacks/'
+
+    resp = create_urls.direct_handler(event, None)
+    assert resp['urls']['foo'].startswith('https://example.com/callbacks/respond?')
+
+def test_concurrent_encryption(monkeypatch, api_config):
+    key_provider = get_fake_kms_key_provider(latency=0.05)
+    monkeypatch.setattr(create_urls, 'MATERIALS_MANAGER', key_provider)
+    monkeypatch.setattr(create_urls, 'IDEMPOTENCY_CACHE', None)
+    log_events = []
+    monkeypatch.setattr(create_urls, 'send_log_event', lambda log_event, start_time: log_events.append(log_event))
+
+    names = [f'action{i}' for i in range(8)]
+    event = get_event(actions=[get_success(name, {'name': name}) for name in names])
+
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        monkeypatch.setattr(create_urls, 'ENCRYPTION_EXECUTOR', executor)
+        start = time.perf_counter()
+        resp = create_urls.direct_handler(event, None)
+        elapsed = time.perf_counter() - start
+
+    # each encryption calls the fake KMS, which takes 50 ms
+    assert elapsed < 8 * 0.05
+    log_event = log_events[0]
+    assert log_event['encryption_wall_time'] < log_event['encryption_time']
+
+    # in the order of the actions, whichever finished first
+    assert list(resp['urls']) == names
+    for name, url in resp['urls'].items():
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query)
+        payload = decode_payload(query['data'][0], key_provider)
+        assert payload['action']['output'] == {'name': name}
@@ -0,0 +1,266 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+import os
+import json
+import base64
+import time
+import asyncio
+
+# process_callback creates its Step Functions client at import, which needs a region
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import create_urls
+import process_callback
+from sfn_callback_urls.common import override_config
+from sfn_callback_urls.admission import AdmissionControl
+from sfn_callback_urls.stores import MemoryStore
+from sfn_callback_urls.fakes import (
+    get_fake_kms_key_provider,
+    FakeStepFunctionsClient,
+    FakeAsyncStepFunctionsClient,
+    FakeAsyncPayloadDecoder,
+    get_proxy_event,
+    get_http_api_event
+)
+
+@pytest.fixture
+def key_provider(monkeypatch):
+    key_provider = get_fake_kms_key_provider()
+    monkeypatch.setattr(create_urls, 'MATERIALS_MANAGER', key_provider)
+    monkeypatch.setattr(create_urls, 'IDEMPOTENCY_CACHE', None)
+    monkeypatch.setattr(process_callback, 'MASTER_KEY_PROVIDER', key_provider)
+    return key_provider
+
+@pytest.fixture
+def async_clients(monkeypatch, key_provider):
+    step_functions_client = FakeAsyncStepFunctionsClient()
+    payload_decoder = FakeAsyncPayloadDecoder(key_provider)
+    monkeypatch.setattr(process_callback, 'ASYNC_STEP_FUNCTIONS_CLIENT', step_functions_client)
+    monkeypatch.setattr(process_callback, 'ASYNC_PAYLOAD_DECODER', payload_decoder)
+    return step_functions_client, payload_decoder
+
+def create_url(action, token='token'):
+    response = create_urls.process_event({'token': token, 'actions': [action]}, None,
+        create_urls.DefaultApiInfo('us-east-1', 'api', 'stage'), lambda status_code, headers, body: body)
+    return response['urls'][action['name']]
+
+def test_async_handler(async_clients):
+    step_functions_client, payload_decoder = async_clients
+    url = create_url({'name': 'approve', 'type': 'success', 'output': {'foo': 'bar'}})
+
+    response = asyncio.run(process_callback.async_handler(get_proxy_event(url)))
+    assert response['statusCode'] == 200
+    assert json.loads(response['body'])['action'] == {'name': 'approve', 'type': 'success'}
+    assert step_functions_client.calls == [('SendTaskSuccess', {'output': '{"foo": "bar"}', 'taskToken': 'token'})]
+    assert payload_decoder.decode_count == 1
+
+def test_async_handler_post(async_clients):
+    step_functions_client, _ = async_clients
+    url = create_url({
+        'name': 'choose',
+        'type': 'post',
+        'outcomes': [
+            {'name': 'yes', 'type': 'success', 'schema': {'required': ['yes']}, 'output_body': True},
+            {'name': 'no', 'type': 'failure', 'schema': {'required': ['no']}, 'error': 'Declined'},
+        ],
+    })
+
+    response = asyncio.run(process_callback.async_handler(get_proxy_event(url, method='POST', body={'no': 1})))
+    assert response['statusCode'] == 200
+    assert step_functions_client.calls == [('SendTaskFailure', {'error': 'Declined', 'taskToken': 'token'})]
+
+    response = asyncio.run(process_callback.async_handler(get_proxy_event(url, method='POST', body={})))
+    assert response['statusCode'] == 400
+    assert json.loads(response['body'])['error'] == 'InvalidPostActionBody'
+
+def test_async_handler_errors(async_clients, key_provider):
+    step_functions_client, payload_decoder = async_clients
+    url = create_url({'name': 'approve', 'type': 'success', 'output': {}})
+
+    step_functions_client.fault_rate = 1
+    step_functions_client.fault_code = 'TaskTimedOut'
+    response = asyncio.run(process_callback.async_handler(get_proxy_event(url)))
+    assert response['statusCode'] == 400
+    assert json.loads(response['body'])['error'] == 'StepFunctionsError'
+
+    step_functions_client.fault_code = 'ServiceUnavailable'
+    response = asyncio.run(process_callback.async_handler(get_proxy_event(url)))
+    assert response['statusCode'] == 500
+
+    payload_decoder.fault_rate = 1
+    response = asyncio.run(process_callback.async_handler(get_proxy_event(url)))
+    assert response['statusCode'] == 400
+    assert json.loads(response['body'])['error'] == 'InvalidPayload'
+
+def test_async_handler_overlaps_callbacks(async_clients):
+    step_functions_client, payload_decoder = async_clients
+    step_functions_client.latency = 0.1
+    payload_decoder.latency = 0.1
+    urls = [create_url({'name': 'approve', 'type': 'success', 'output': {}}, token=f'token{i}') for i in range(50)]
+
+    async def run():
+        return await asyncio.gather(*[process_callback.async_handler(get_proxy_event(url)) for url in urls])
+    start = time.perf_counter()
+    responses = asyncio.run(run())
+    # one at a time, this would take 10 seconds
+    assert time.perf_counter() - start < 2
+    assert [r['statusCode'] for r in responses] == [200] * 50
+    assert sorted(params['taskToken'] for _, params in step_functions_client.calls) == sorted(f'token{i}' for i in range(50))
+
+def test_async_handler_threaded_clients(monkeypatch, key_provider):
+    # without async clients, the blocking ones are run in threads
+    step_functions_client = FakeStepFunctionsClient()
+    monkeypatch.setattr(process_callback, 'STEP_FUNCTIONS_CLIENT', step_functions_client)
+    url = create_url({'name': 'beat', 'type': 'heartbeat'})
+
+    response = asyncio.run(process_callback.async_handler(get_proxy_event(url)))
+    assert response['statusCode'] == 200
+    assert step_functions_client.calls == [('SendTaskHeartbeat', {'taskToken': 'token'})]
+
+def test_handler_http_api_events(monkeypatch, key_provider):
+    step_functions_client = FakeStepFunctionsClient()
+    monkeypatch.setattr(process_callback, 'STEP_FUNCTIONS_CLIENT', step_functions_client)
+    url = create_url({'name': 'approve', 'type': 'success', 'output': {'foo': 'bar'}})
+
+    response = process_callback.handler(get_http_api_event(url, headers={'Accept': 'text/html'}), None)
+    assert response['statusCode'] == 200
+    assert response['headers']['Content-Type'] == 'text/html'
+    assert step_functions_client.calls == [('SendTaskSuccess', {'output': '{"foo": "bar"}', 'taskToken': 'token'})]
+
+    url = create_url({
+        'name': 'choose',
+        'type': 'post',
+        'outcomes': [
+            {'name': 'yes', 'type': 'success', 'schema': {'required': ['yes']}, 'output_body': True},
+        ],
+    })
+    response = process_callback.handler(get_http_api_event(url, method='POST', body={'yes': 1}), None)
+    assert response['statusCode'] == 200
+    assert step_functions_client.calls[-1] == ('SendTaskSuccess', {'output': '{"yes": 1}', 'taskToken': 'token'})
+
+    response = process_callback.handler(get_http_api_event(url), None)
+    assert response['statusCode'] == 405
+
+    # a base64 body that isn't UTF-8
+    event = get_http_api_event(url, method='POST', body='{"yes": "\xff"}', headers={'Content-Type': 'application/json'})
+    event['body'] = str(base64.b64encode(event['body'].encode('latin-1')), 'ascii')
+    event['isBase64Encoded'] = True
+    response = process_callback.handler(event, None)
+    assert response['statusCode'] == 400
+    assert json.loads(response['body'])['error'] == 'InvalidJSON'
+
+def test_handler_rejected_payload(monkeypatch, key_provider):
+    monkeypatch.setattr(process_callback, 'STEP_FUNCTIONS_CLIENT', FakeStepFunctionsClient())
+    log_events = []
+    monkeypatch.setattr(process_callback, 'send_log_event', lambda log_event, start_time: log_events.append(log_event))
+    url = create_url({'name': 'approve', 'type': 'success', 'output': {}})
+
+    response = process_callback.handler(get_proxy_event(url.replace('data=2-', 'data=2-AAAA')), None)
+    assert response['statusCode'] == 400
+    assert json.loads(response['body'])['error'] == 'InvalidPayload'
+    assert log_events[-1]['payload_rejected'] == 1
+    assert log_events[-1]['payload_rejection_reason'] == 'header'
+
+    with override_config(payload_mac_keys=(('k1', 'secret-one-0123456789'),)):
+        url = create_url({'name': 'approve', 'type': 'success', 'output': {}})
+        response = process_callback.handler(get_proxy_event(url), None)
+        assert response['statusCode'] == 200
+
+        # a valid payload, without a tag
+        url = url.rsplit('.', 2)[0]
+        response = process_callback.handler(get_proxy_event(url), None)
+        assert response['statusCode'] == 400
+        assert log_events[-1]['payload_rejection_reason'] == 'mac'
+
+def test_handler_long_short_url(monkeypatch, key_provider):
+    monkeypatch.setattr(process_callback, 'STEP_FUNCTIONS_CLIENT', FakeStepFunctionsClient())
+    store = MemoryStore()
+    monkeypatch.setattr(create_urls, 'PAYLOAD_STORE', store)
+    monkeypatch.setattr(process_callback, 'PAYLOAD_STORE', store)
+    response = create_urls.process_event({'token': 'token', 'short_urls': True,
+            'actions': [{'name': 'approve', 'type': 'success', 'output': {'data': 'x' * 20000}}]}, None,
+        create_urls.DefaultApiInfo('us-east-1', 'api', 'stage'), lambda status_code, headers, body: body)
+    url = response['urls']['approve']
+    assert len(url) < 200
+
+    # the stored payload is longer than any URL, but only the URL is checked
+    response = process_callback.handler(get_proxy_event(url), None)
+    assert response['statusCode'] == 200
+
+    with override_config(max_payload_length=10):
+        response = process_callback.handler(get_proxy_event(url), None)
+        assert response['statusCode'] == 400
+
+def test_handler_rate_limits(monkeypatch, key_provider):
+    step_functions_client = FakeStepFunctionsClient()
+    monkeypatch.setattr(process_callback, 'STEP_FUNCTIONS_CLIENT', step_functions_client)
+    log_events = []
+    monkeypatch.setattr(process_callback, 'send_log_event', lambda log_event, start_time: log_events.append(log_event))
+    monkeypatch.setattr(process_callback, 'ADMISSION_CONTROL', AdmissionControl(transaction_limit=(1, 60)))
+    url = create_url({'name': 'approve', 'type': 'success', 'output': {}})
+
+    response = process_callback.handler(get_proxy_event(url), None)
+    assert response['statusCode'] == 200
+
+    # the payload's transaction is known, so it's turned away before decoding
+    response = process_callback.handler(get_proxy_event(url), None)
+    assert response['statusCode'] == 429
+    assert json.loads(response['body'])['error'] == 'TooManyRequests'
+    assert log_events[-1]['throttled_by'] == 'transaction'
+    assert 'decode_time' not in log_events[-1]
+    assert len(step_functions_client.calls) == 1
+
+    monkeypatch.setattr(process_callback, 'ADMISSION_CONTROL', AdmissionControl(source_limit=(1, 60)))
+    response = process_callback.handler(get_http_api_event(url), None)
+    assert response['statusCode'] == 200
+    response = process_callback.handler(get_http_api_event(url), None)
+    assert response['statusCode'] == 429
+    assert response['headers']['Retry-After'] == '60'
+    assert log_events[-1]['throttled_by'] == 'source_ip'
+    assert log_events[-1]['throttled'] == 1
+    assert log_events[-1]['error']['error'] == 'TooManyRequests'
+
+def test_handler_rate_limits_failed_callbacks(monkeypatch, key_provider):
+    monkeypatch.setattr(process_callback, 'STEP_FUNCTIONS_CLIENT', FakeStepFunctionsClient())
+    log_events = []
+    monkeypatch.setattr(process_callback, 'send_log_event', lambda log_event, start_time: log_events.append(log_event))
+    monkeypatch.setattr(process_callback, 'ADMISSION_CONTROL', AdmissionControl(transaction_limit=(1, 60)))
+    url = create_url({'name': 'approve', 'type': 'success', 'output': {}})
+    # fails after decoding, like an expired URL would
+    url = url.replace('action=approve', 'action=other')
+
+    response = process_callback.handler(get_proxy_event(url), None)
+    assert response['statusCode'] == 400
+    assert log_events[-1]['error']['error'] == 'ActionMismatched'
+
+    # the transaction was still learned, so the repeat isn't decrypted
+    response = process_callback.handler(get_proxy_event(url), None)
+    assert response['statusCode'] == 429
+    assert 'decode_time' not in log_events[-1]
+
+def test_async_handler_rate_limits(monkeypatch, async_clients):
+    step_functions_client, payload_decoder = async_clients
+    monkeypatch.setattr(process_callback, 'ADMISSION_CONTROL',
+        AdmissionControl(transaction_limit=(1, 60), shared_store=MemoryStore()))
+    url = create_url({'name': 'approve', 'type': 'success', 'output': {}})
+
+    async def callback():
+        return await process_callback.async_handler(get_proxy_event(url))
+
+    assert asyncio.run(callback())['statusCode'] == 200
+    assert asyncio.run(callback())['statusCode'] == 429
+    assert len(step_functions_client.calls) == 1
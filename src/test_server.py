@@ -0,0 +1,157 @@
+# Copyright 2019 Ben Kehoe
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+import os
+import io
+import json
+import asyncio
+import threading
+import urllib.parse
+import urllib.request
+import urllib.error
+
+# process_callback creates its Step Functions client at import, which needs a region
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import create_urls
+import process_callback
+import server
+from sfn_callback_urls.common import override_config
+from sfn_callback_urls.fakes import get_fake_kms_key_provider, FakeStepFunctionsClient
+
+BASE_URL = 'https://callbacks.example.com/prefix'
+
+@pytest.fixture
+def handlers(monkeypatch):
+    key_provider = get_fake_kms_key_provider()
+    sfn_client = FakeStepFunctionsClient()
+    monkeypatch.setattr(create_urls, 'MATERIALS_MANAGER', key_provider)
+    monkeypatch.setattr(create_urls, 'IDEMPOTENCY_CACHE', None)
+    monkeypatch.setattr(process_callback, 'MASTER_KEY_PROVIDER', key_provider)
+    monkeypatch.setattr(process_callback, 'STEP_FUNCTIONS_CLIENT', sfn_client)
+    with override_config(base_url=BASE_URL, server_create_urls=True):
+        yield sfn_client
+
+def call_wsgi(method, url, body=None, headers=None):
+    parsed_url = urllib.parse.urlsplit(url)
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': parsed_url.path,
+        'QUERY_STRING': parsed_url.query,
+        'REMOTE_ADDR': '127.0.0.1',
+        'wsgi.input': io.BytesIO(body or b''),
+    }
+    if body:
+        environ['CONTENT_LENGTH'] = str(len(body))
+    for name, value in (headers or {}).items():
+        if name.lower() == 'content-type':
+            environ['CONTENT_TYPE'] = value
+        else:
+            environ['HTTP_' + name.upper().replace('-', '_')] = value
+
+    response = {}
+    def start_response(status, headers):
+        response['status'] = int(status.split()[0])
+        response['headers'] = dict(headers)
+    response['body'] = b''.join(server.application(environ, start_response))
+    return response
+
+def create_url(action):
+    response = call_wsgi('POST', BASE_URL + '/urls',
+        json.dumps({'token': 'server-token', 'actions': [action]}).encode(),
+        {'Content-Type': 'application/json'})
+    assert response['status'] == 200, response
+    assert response['headers']['Content-Type'] == 'application/json'
+    return json.loads(response['body'])['urls'][action['name']]
+
+def test_wsgi_callback(handlers):
+    url = create_url({'name': 'approve', 'type': 'success', 'output': {'foo': 'bar'}})
+    assert url.startswith(BASE_URL + '/respond?')
+
+    response = call_wsgi('GET', url)
+    assert response['status'] == 200
+    assert json.loads(response['body'])['action']['name'] == 'approve'
+    assert handlers.calls == [('SendTaskSuccess', {'output': '{"foo": "bar"}', 'taskToken': 'server-token'})]
+
+def test_wsgi_post_callback(handlers):
+    url = create_url({
+        'name': 'choose',
+        'type': 'post',
+        'outcomes': [{'name': 'ok', 'type': 'success', 'schema': {}, 'output_body': True}],
+    })
+    response = call_wsgi('POST', url, b'{"choice": 1}', {'Content-Type': 'application/json'})
+    assert response['status'] == 200
+    assert handlers.calls[0][1]['output'] == '{"choice": 1}'
+
+def test_wsgi_routing(handlers):
+    assert call_wsgi('GET', BASE_URL + '/other')['status'] == 404
+    assert call_wsgi('GET', 'https://callbacks.example.com/respond')['status'] == 404
+
+    response = call_wsgi('GET', BASE_URL + '/urls')
+    assert response['status'] == 405
+    assert response['headers']['Allow'] == 'POST'
+
+    with override_config(server_create_urls=False):
+        assert call_wsgi('POST', BASE_URL + '/urls', b'{}', {'Content-Type': 'application/json'})['status'] == 404
+
+def test_asgi_callback(handlers):
+    url = create_url({'name': 'approve', 'type': 'success', 'output': {'foo': 'bar'}})
+    parsed_url = urllib.parse.urlsplit(url)
+    scope = {
+        'type': 'http',
+        'method': 'GET',
+        'path': parsed_url.path,
+        'query_string': parsed_url.query.encode(),
+        'headers': [(b'accept', b'application/json')],
+        'client': ('127.0.0.1', 12345),
+    }
+    messages = []
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(server.asgi_application(scope, receive, send))
+    assert messages[0]['status'] == 200
+    assert (b'content-type', b'application/json') in messages[0]['headers']
+    assert json.loads(messages[1]['body'])['action']['name'] == 'approve'
+    assert len(handlers.calls) == 1
+
+def test_server_concurrent_requests(handlers):
+    handlers.latency = 0.1
+    urls = [create_url({'name': 'approve', 'type': 'success', 'output': {}}) for _ in range(4)]
+    urls = [url.replace(BASE_URL, '') for url in urls]
+
+    http_server = server.make_server('127.0.0.1', 0, workers=4)
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        base_url = f'http://127.0.0.1:{http_server.server_address[1]}/prefix'
+        statuses = []
+        def call(path):
+            with urllib.request.urlopen(base_url + path, timeout=5) as response:
+                statuses.append(response.status)
+        threads = [threading.Thread(target=call, args=(path,)) for path in urls]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert statuses == [200] * 4
+        assert handlers.call_count == 4
+    finally:
+        http_server.shutdown()
+        http_server.server_close()